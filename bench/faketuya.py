@@ -0,0 +1,229 @@
+"""
+A fleet of fake Tuya devices for benchmarking.
+
+Every device listens on its own port (base_port + index) and speaks the 3.1/3.3 framing that TuyaDevice uses: control
+commands (7) with `null` dps values are status queries, anything else sets the dps. Replies can be delayed (latency +
+random jitter) or dropped, to simulate slow and flaky devices. With --push-interval, a random device has its button
+pressed every that many seconds and pushes its new status (command 8) to its open connections.
+
+    python -m bench.faketuya --count 1000 --base-port 20000 --latency 0.02 --jitter 0.01 --drop-rate 0.001
+
+With --config, the hsapid device configuration and the `/api/device/sync` payload for the fleet are written to a JSON
+file (see bench.load).
+"""
+import argparse
+import asyncore
+import binascii
+import json
+import random
+import socket
+import sys
+
+from homeswitch import asyncorepp
+from homeswitch.hw.tuya import TuyaCodec, FRAME_HEADER, FRAME_TRAILER, HEADER_SIZE, PREFIX_VALUE, SUFFIX_VALUE, \
+    PROTOCOL_VERSION_BYTES_31, PROTOCOL_VERSION_BYTES_33, CMD_CONTROL, CMD_STATUS, CMD_HEART_BEAT
+
+
+def device_id(index):
+    return 'fake{:018d}'.format(index)
+
+
+def device_key(index):
+    return '{:016x}'.format(index * 2654435761 & 0xffffffffffffffff)
+
+
+class FakeTuyaDevice(object):
+    def __init__(self, index, host, port, version=3.3, dps='1'):
+        self.id = device_id(index)
+        self.key = device_key(index)
+        self.host = host
+        self.port = port
+        self.version = version
+        self.codec = TuyaCodec(self.key, version)
+        self.dps = {dps: False}
+        self.commands = 0
+        self.connections = set()
+
+    def handle(self, command, payload):
+        # Returns the reply payload (None for no reply)
+        self.commands += 1
+        if command == CMD_HEART_BEAT:
+            return ''
+        if command == CMD_CONTROL and payload.get('dps'):
+            for dps, value in payload.get('dps').items():
+                if value is not None:
+                    self.dps[dps] = value
+        return {'devId': self.id, 'dps': self.dps, 't': payload.get('t')}
+
+    def press_button(self):
+        # Toggles the switch and tells every open connection about it, like the real thing
+        for dps in self.dps:
+            self.dps[dps] = not self.dps[dps]
+        frame = self.encode(0, CMD_STATUS, {'devId': self.id, 'dps': self.dps, 't': 0})
+        for connection in self.connections:
+            connection._send(frame)
+
+    def decode(self, command, body):
+        if len(body) == 0:
+            return {}
+        if body.startswith(b'{'):
+            return json.loads(body)
+        if self.version == 3.3:
+            if body.startswith(PROTOCOL_VERSION_BYTES_33):
+                body = body[15:]
+            return self.codec.decrypt_json(body, False)
+        if body.startswith(PROTOCOL_VERSION_BYTES_31):
+            return self.codec.decrypt_json(body[19:], True)
+        raise ValueError("Can't decode command {} for a {} device".format(command, self.version))
+
+    def encode(self, sequence, command, payload):
+        if payload == '':
+            body = b''
+        elif self.version == 3.3:
+            body = PROTOCOL_VERSION_BYTES_33 + b'\0' * 12 + self.codec.cipher.encrypt(json.dumps(payload), False)
+        else:
+            # 3.1 devices reply in plain text
+            body = json.dumps(payload)
+        # Replies have a 4 byte return code before the payload
+        body = b'\0\0\0\0' + body
+        header = FRAME_HEADER.pack(PREFIX_VALUE, sequence, command, len(body) + 8)
+        crc = binascii.crc32(header + body) & 0xffffffff
+        return header + body + FRAME_TRAILER.pack(crc, SUFFIX_VALUE)
+
+    def json(self):
+        return {'id': self.id, 'key': self.key, 'ip': self.host, 'port': self.port, 'version': str(self.version)}
+
+
+class FakeTuyaListener(asyncore.dispatcher):
+    def __init__(self, device, fleet):
+        asyncore.dispatcher.__init__(self)
+        self.device = device
+        self.fleet = fleet
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((device.host, device.port))
+        self.listen(128)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            FakeTuyaConnection(pair[0], self.device, self.fleet)
+
+
+class FakeTuyaConnection(asyncore.dispatcher):
+    def __init__(self, sock, device, fleet):
+        asyncore.dispatcher.__init__(self, sock)
+        self.device = device
+        self.fleet = fleet
+        self.in_buffer = bytearray()
+        self.out_buffer = bytearray()
+        device.connections.add(self)
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+        self.in_buffer.extend(data)
+        while len(self.in_buffer) >= HEADER_SIZE:
+            prefix, sequence, command, size = FRAME_HEADER.unpack_from(bytes(self.in_buffer[:HEADER_SIZE]))
+            if prefix != PREFIX_VALUE:
+                self.close()
+                return
+            if len(self.in_buffer) < HEADER_SIZE + size:
+                return
+            body = bytes(self.in_buffer[HEADER_SIZE:HEADER_SIZE + size - 8])
+            del self.in_buffer[:HEADER_SIZE + size]
+            self._on_command(sequence, command, body)
+
+    def _on_command(self, sequence, command, body):
+        fleet = self.fleet
+        reply = self.device.handle(command, self.device.decode(command, body))
+        if reply is None or (fleet.drop_rate and random.random() < fleet.drop_rate):
+            fleet.dropped += 1
+            return
+        frame = self.device.encode(sequence, command, reply)
+        delay = fleet.latency + (random.uniform(0, fleet.jitter) if fleet.jitter else 0)
+        if delay > 0:
+            asyncorepp.set_timeout(lambda: self._send(frame), delay)
+        else:
+            self._send(frame)
+
+    def _send(self, frame):
+        if self.connected:
+            self.out_buffer.extend(frame)
+
+    def writable(self):
+        return len(self.out_buffer) > 0
+
+    def handle_write(self):
+        sent = self.send(bytes(self.out_buffer))
+        del self.out_buffer[:sent]
+
+    def close(self):
+        self.device.connections.discard(self)
+        asyncore.dispatcher.close(self)
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        self.close()
+
+
+class FakeTuyaFleet(object):
+    def __init__(self, count=100, host='127.0.0.1', base_port=20000, version=3.3, latency=0, jitter=0, drop_rate=0,
+                 push_interval=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.drop_rate = drop_rate
+        self.dropped = 0
+        self.devices = [FakeTuyaDevice(i, host, base_port + i, version=version) for i in range(count)]
+        self.listeners = [FakeTuyaListener(dev, self) for dev in self.devices]
+        if push_interval:
+            asyncorepp.set_interval(lambda: random.choice(self.devices).press_button(), push_interval)
+
+    def hsapid_devices(self):
+        # The `devices` section of the hsapid configuration
+        return dict((dev.id, {
+            'hw': 'tuya',
+            'key': dev.key,
+            'ip': dev.host,
+            'port': dev.port,
+            'get_status_on_start': False,
+        }) for dev in self.devices)
+
+    def sync_payload(self):
+        # The `/api/device/sync` body that hslookupd would post for these devices
+        return dict((dev.id, {'ip': dev.host, 'gwId': dev.id, 'version': str(dev.version)}) for dev in self.devices)
+
+    def run(self):
+        asyncorepp.loop(timeout=0.1, use_poll=True, use_epoll=True)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Run a fleet of fake Tuya devices')
+    parser.add_argument('--count', type=int, default=100)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--base-port', type=int, default=20000)
+    parser.add_argument('--version', type=float, default=3.3, choices=[3.1, 3.3])
+    parser.add_argument('--latency', type=float, default=0, help='seconds before replying')
+    parser.add_argument('--jitter', type=float, default=0, help='random extra delay (up to this many seconds)')
+    parser.add_argument('--drop-rate', type=float, default=0, help='fraction of the commands left unreplied')
+    parser.add_argument('--push-interval', type=float, default=0, help='seconds between random button presses')
+    parser.add_argument('--config', help='write the hsapid devices and the sync payload to this file')
+    opts = parser.parse_args(args)
+
+    fleet = FakeTuyaFleet(count=opts.count, host=opts.host, base_port=opts.base_port, version=opts.version,
+                          latency=opts.latency, jitter=opts.jitter, drop_rate=opts.drop_rate,
+                          push_interval=opts.push_interval)
+    if opts.config:
+        with open(opts.config, 'w') as config_file:
+            json.dump({'devices': fleet.hsapid_devices(), 'sync': fleet.sync_payload()}, config_file)
+    sys.stderr.write('Fake Tuya fleet with {} devices listening on {}:{}-{}\n'.format(
+        opts.count, opts.host, opts.base_port, opts.base_port + opts.count - 1))
+    sys.stderr.flush()
+    fleet.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+"""
+End-to-end load benchmark: runs hsapid against a fleet of fake Tuya devices (bench.faketuya) and drives it through the
+native protocol and HTTP.
+
+    python -m bench.load --devices 500 --concurrency 32 --duration 20 --mode get --latency 0.01
+
+Modes:
+    get   native `get` requests for a random device
+    set   native `set` requests for a random device
+    http  `POST /api/device/sync` requests (what hslookupd sends)
+
+Reports throughput, latency percentiles and the CPU time hsapid spent per request (from /proc, so Linux only).
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from homeswitch import proto
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+def process_cpu_time(pid):
+    # utime + stime of a process, in seconds
+    try:
+        with open('/proc/{}/stat'.format(pid)) as stat_file:
+            fields = stat_file.read().rsplit(')', 1)[1].split()
+    except IOError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+
+def wait_for_port(host, port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), 1).close()
+            return True
+        except socket.error:
+            time.sleep(0.05)
+    return False
+
+
+def http_request(sock, method, url, body):
+    sock.sendall('{} {} HTTP/1.1\r\nHost: hsapid\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n{}'.format(
+        method, url, len(body), body))
+    buf = b''
+    while b'\r\n\r\n' not in buf:
+        data = sock.recv(65536)
+        if not data:
+            raise socket.error('Connection closed')
+        buf += data
+    head, rest = buf.split(b'\r\n\r\n', 1)
+    length = 0
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'content-length':
+            length = int(value)
+    while len(rest) < length:
+        data = sock.recv(65536)
+        if not data:
+            raise socket.error('Connection closed')
+        rest += data
+    return head.split(b' ', 2)[1], json.loads(rest[:length])
+
+
+class NativeClient(object):
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buf = bytearray()
+        self.next_id = 0
+
+    def request(self, body):
+        self.next_id += 1
+        body['id'] = self.next_id
+        self.sock.sendall(proto.serialise(body))
+        while True:
+            for message in proto.parse_messages(self.buf):
+                # Skip status update broadcasts
+                if message.get('id') == self.next_id:
+                    return message
+            data = self.sock.recv(65536)
+            if not data:
+                raise socket.error('Connection closed')
+            self.buf.extend(data)
+
+    def close(self):
+        self.sock.close()
+
+
+class LoadWorker(threading.Thread):
+    def __init__(self, opts, device_ids, sync_payload, deadline):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.opts = opts
+        self.device_ids = device_ids
+        self.sync_body = json.dumps(sync_payload)
+        self.deadline = deadline
+        self.latencies = []
+        self.errors = 0
+
+    def run(self):
+        opts = self.opts
+        if opts.mode == 'http':
+            sock = socket.create_connection((opts.host, opts.port))
+        else:
+            client = NativeClient(opts.host, opts.port)
+        while time.time() < self.deadline:
+            started = time.time()
+            try:
+                if opts.mode == 'http':
+                    status, reply = http_request(sock, 'POST', '/api/device/sync', self.sync_body)
+                    ok = status == b'200'
+                else:
+                    dev_id = random.choice(self.device_ids)
+                    if opts.mode == 'set':
+                        reply = client.request({'method': 'set', 'devices': {dev_id: random.random() < 0.5}})
+                    else:
+                        reply = client.request({'method': 'get', 'devices': [dev_id]})
+                    ok = not reply.get('error') and reply.get('devices', {}).get(dev_id, {}).get('status') is not None
+            except socket.error:
+                self.errors += 1
+                return
+            if ok:
+                self.latencies.append(time.time() - started)
+            else:
+                self.errors += 1
+
+
+def run_load(opts):
+    workdir = tempfile.mkdtemp(prefix='hsbench')
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    fleet_config = os.path.join(workdir, 'fleet.json')
+    processes = []
+    try:
+        # Start the fake devices and wait for them to be listening
+        processes.append(subprocess.Popen([
+            sys.executable, '-m', 'bench.faketuya',
+            '--count', str(opts.devices), '--base-port', str(opts.base_port), '--version', str(opts.version),
+            '--latency', str(opts.latency), '--jitter', str(opts.jitter), '--drop-rate', str(opts.drop_rate),
+            '--config', fleet_config,
+        ], env=env, cwd=ROOT))
+        if not wait_for_port('127.0.0.1', opts.base_port + opts.devices - 1):
+            raise Exception('The fake Tuya fleet did not start')
+        with open(fleet_config) as config_file:
+            fleet = json.load(config_file)
+
+        # Start hsapid with the fleet's devices
+        os.mkdir(os.path.join(workdir, 'conf'))
+        with open(os.path.join(workdir, 'conf', 'hsapid.json'), 'w') as config_file:
+            config = {'host': opts.host, 'port': opts.port, 'devices': fleet['devices']}
+            if opts.log_level:
+                config['logging'] = {'level': opts.log_level, 'buffer_size': 65536}
+            json.dump(config, config_file)
+        with open(os.path.join(workdir, 'hsapid.log'), 'w') as log_file:
+            hsapid = subprocess.Popen([sys.executable, '-c', 'from homeswitch.api import main; main()'],
+                                      env=env, cwd=workdir, stdout=log_file, stderr=subprocess.STDOUT)
+        processes.append(hsapid)
+        if not wait_for_port(opts.host, opts.port):
+            raise Exception('hsapid did not start (see {})'.format(os.path.join(workdir, 'hsapid.log')))
+
+        # Tell hsapid where the devices are (like hslookupd does)
+        sock = socket.create_connection((opts.host, opts.port))
+        http_request(sock, 'POST', '/api/device/sync', json.dumps(fleet['sync']))
+        sock.close()
+
+        # Warm up (connects to the devices) and measure
+        device_ids = sorted(fleet['devices'].keys())
+        for measure, duration in ((False, opts.warmup), (True, opts.duration)):
+            if duration <= 0:
+                continue
+            deadline = time.time() + duration
+            workers = [LoadWorker(opts, device_ids, fleet['sync'], deadline) for _ in range(opts.concurrency)]
+            cpu_before = process_cpu_time(hsapid.pid)
+            started = time.time()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = time.time() - started
+            cpu_after = process_cpu_time(hsapid.pid)
+        return report(opts, workers, elapsed, cpu_before, cpu_after)
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+        if opts.keep:
+            sys.stderr.write('Kept {}\n'.format(workdir))
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def report(opts, workers, elapsed, cpu_before, cpu_after):
+    latencies = [latency for worker in workers for latency in worker.latencies]
+    requests = len(latencies)
+    cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+    return {
+        'mode': opts.mode,
+        'devices': opts.devices,
+        'concurrency': opts.concurrency,
+        'duration': elapsed,
+        'requests': requests,
+        'errors': sum(worker.errors for worker in workers),
+        'throughput': requests / elapsed if elapsed else 0,
+        'latency_p50_ms': percentile(latencies, 50) * 1000 if requests else None,
+        'latency_p99_ms': percentile(latencies, 99) * 1000 if requests else None,
+        'latency_max_ms': max(latencies) * 1000 if requests else None,
+        'cpu_seconds': cpu,
+        'cpu_ms_per_request': cpu * 1000 / requests if cpu is not None and requests else None,
+    }
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Load test hsapid against a fleet of fake Tuya devices')
+    parser.add_argument('--mode', default='get', choices=['get', 'set', 'http'])
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=17776)
+    parser.add_argument('--base-port', type=int, default=20000)
+    parser.add_argument('--version', type=float, default=3.3, choices=[3.1, 3.3])
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--jitter', type=float, default=0)
+    parser.add_argument('--drop-rate', type=float, default=0)
+    parser.add_argument('--log-level', choices=['DBUG', 'INFO', 'WARN', 'ERRO'], help='hsapid log level (buffered output)')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    parser.add_argument('--keep', action='store_true', help="don't delete the work directory (configuration and logs)")
+    opts = parser.parse_args(args)
+
+    results = run_load(opts)
+    if opts.json:
+        print(json.dumps(results, indent=4, sort_keys=True))
+        return
+    for name in ('mode', 'devices', 'concurrency', 'requests', 'errors', 'throughput', 'latency_p50_ms',
+                 'latency_p99_ms', 'latency_max_ms', 'cpu_ms_per_request'):
+        value = results[name]
+        print('{:<20} {}'.format(name, '{:.3f}'.format(value) if isinstance(value, float) else value))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,377 @@
+"""
+Micro-benchmarks for the byte level hot paths (protocol codecs, request parsers and AES).
+
+    python -m bench.micro --output before.json
+    python -m bench.micro --output after.json
+    python -m bench.micro --compare before.json after.json --threshold 0.1
+
+Every benchmark runs on a fixed corpus (small and max-size messages, data fragmented into 1-byte chunks, many frames per
+read), so runs are comparable across changes and machines. Results are in nanoseconds per operation; the best of
+`--rounds` rounds is used for comparisons. --compare exits with status 1 if anything got slower than the threshold.
+"""
+import argparse
+from collections import OrderedDict
+import binascii
+from hashlib import md5
+import json
+import os
+import platform
+import sys
+import time
+
+from homeswitch import proto
+from homeswitch.aes import AESCipher, BACKENDS
+from homeswitch.hybridserver import HomeSwitchRequest, HTTPRequest
+from homeswitch.hw.tuya import TuyaDevice, TuyaDeviceListener, FRAME_HEADER, FRAME_TRAILER, PREFIX_VALUE, \
+    SUFFIX_VALUE, PROTOCOL_VERSION_BYTES_33
+
+
+KEY = b'0123456789abcdef'
+UDP_KEY = 'yGAdlopoPVldABfn'
+MAX_PROTO_BODY = 0xffff
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    # Registers a benchmark. The decorated function builds the corpus and returns the function to time
+    def register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return register
+
+
+# Corpora
+
+def small_request():
+    return {'id': 1, 'method': 'get', 'devices': ['bf5d0abdb1e6210180duku'], 'user': 'bench', 'client': 'bench'}
+
+
+def max_size_request():
+    request = {'id': 1, 'method': 'set', 'devices': {}, 'user': 'bench'}
+    filler = MAX_PROTO_BODY - len(json.dumps(request)) - len(', "filler": ""')
+    request['filler'] = 'x' * filler
+    assert len(json.dumps(request)) == MAX_PROTO_BODY
+    return request
+
+
+def http_request(body):
+    return ('POST /api/device/sync HTTP/1.1\r\nHost: hsapid\r\nContent-Type: application/json\r\n'
+            'Content-Length: {}\r\n\r\n{}'.format(len(body), body))
+
+
+def tuya_reply(version=3.3, dps=None):
+    # A status reply as a device sends it
+    payload = json.dumps({'devId': 'bf5d0abdb1e6210180duku', 'dps': dps or {'1': True}, 't': 1600000000})
+    body = b'\0\0\0\0'
+    if version == 3.3:
+        body += PROTOCOL_VERSION_BYTES_33 + b'\0' * 12 + AESCipher(KEY).encrypt(payload, False)
+    else:
+        body += payload
+    header = FRAME_HEADER.pack(PREFIX_VALUE, 1, 7, len(body) + 8)
+    return header + body + FRAME_TRAILER.pack(binascii.crc32(header + body) & 0xffffffff, SUFFIX_VALUE)
+
+
+def tuya_broadcast():
+    payload = AESCipher(md5(UDP_KEY).digest()).encrypt(json.dumps({
+        'ip': '192.168.1.10', 'gwId': 'bf5d0abdb1e6210180duku', 'active': 2, 'ability': 0, 'mode': 0,
+        'encrypt': True, 'productKey': 'keyjup78v54myhan', 'version': '3.3',
+    }), False)
+    body = b'\0\0\0\0' + payload
+    header = FRAME_HEADER.pack(PREFIX_VALUE, 0, 19, len(body) + 8)
+    return header + body + FRAME_TRAILER.pack(binascii.crc32(header + body) & 0xffffffff, SUFFIX_VALUE)
+
+
+def tuya_device(version='3.3'):
+    return TuyaDevice(id='bench', config={'key': KEY}, hw_metadata={'version': version})
+
+
+class FrameReader(object):
+    # Stands for SyncProto in TuyaDevice._read_and_parse_message()
+    def __init__(self, data):
+        self.data = data
+        self.buffer = bytearray(data)
+        self.reply_sequence = None
+
+    def reset(self):
+        self.buffer[:] = self.data
+
+    def read(self, num_bytes):
+        if len(self.buffer) < num_bytes:
+            return None
+        rv = self.buffer[0:num_bytes]
+        del self.buffer[0:num_bytes]
+        return rv
+
+    def put_back(self, data):
+        self.buffer[0:0] = data
+
+
+# Native protocol
+
+@benchmark('proto.serialise/small')
+def bench_proto_serialise_small():
+    body = small_request()
+    return lambda: proto.serialise(body)
+
+
+@benchmark('proto.serialise/max')
+def bench_proto_serialise_max():
+    body = max_size_request()
+    return lambda: proto.serialise(body)
+
+
+def _parse_messages(data, count):
+    def run():
+        buf = bytearray(data)
+        parsed = sum(1 for _ in proto.parse_messages(buf))
+        assert parsed == count
+    return run
+
+
+@benchmark('proto.parse_messages/small')
+def bench_proto_parse_small():
+    return _parse_messages(bytes(proto.serialise(small_request())), 1)
+
+
+@benchmark('proto.parse_messages/max')
+def bench_proto_parse_max():
+    return _parse_messages(bytes(proto.serialise(max_size_request())), 1)
+
+
+@benchmark('proto.parse_messages/100-frames')
+def bench_proto_parse_many():
+    return _parse_messages(bytes(proto.serialise(small_request())) * 100, 100)
+
+
+@benchmark('proto.parse_messages/1-byte-chunks')
+def bench_proto_parse_fragmented():
+    data = bytes(proto.serialise(small_request()))
+
+    def run():
+        buf = bytearray()
+        parsed = 0
+        for i in range(len(data)):
+            buf.extend(data[i:i + 1])
+            parsed += sum(1 for _ in proto.parse_messages(buf))
+        assert parsed == 1
+    return run
+
+
+# Server side request parsers
+
+def _push_data(new_request, chunks):
+    def run():
+        request = new_request()
+        for chunk in chunks:
+            request.push_data(chunk)
+        assert request.is_ready
+    return run
+
+
+@benchmark('HomeSwitchRequest.push_data/small')
+def bench_hs_push_small():
+    return _push_data(HomeSwitchRequest, [bytes(proto.serialise(small_request()))])
+
+
+@benchmark('HomeSwitchRequest.push_data/max')
+def bench_hs_push_max():
+    return _push_data(HomeSwitchRequest, [bytes(proto.serialise(max_size_request()))])
+
+
+@benchmark('HomeSwitchRequest.push_data/1-byte-chunks')
+def bench_hs_push_fragmented():
+    data = bytes(proto.serialise(small_request()))
+    return _push_data(HomeSwitchRequest, [data[i:i + 1] for i in range(len(data))])
+
+
+@benchmark('HTTPRequest.push_data/small')
+def bench_http_push_small():
+    return _push_data(HTTPRequest, [http_request(json.dumps({'bf5d0abdb1e6210180duku': {'ip': '192.168.1.10'}}))])
+
+
+@benchmark('HTTPRequest.push_data/large')
+def bench_http_push_large():
+    body = json.dumps(dict(('dev{:04d}'.format(i), {'ip': '10.0.0.1', 'gwId': 'dev{:04d}'.format(i), 'version': '3.3'})
+                           for i in range(1000)))
+    return _push_data(HTTPRequest, [http_request(body)])
+
+
+@benchmark('HTTPRequest.push_data/1-byte-chunks')
+def bench_http_push_fragmented():
+    data = http_request(json.dumps({'bf5d0abdb1e6210180duku': {'ip': '192.168.1.10'}}))
+    return _push_data(HTTPRequest, [data[i:i + 1] for i in range(len(data))])
+
+
+# Tuya
+
+@benchmark('TuyaDevice._serialise_message/3.3')
+def bench_tuya_serialise_33():
+    device = tuya_device('3.3')
+    return lambda: device._serialise_message({'command': 7, 'payload': {'devId': 'bench', 'dps': {'1': True}}})
+
+
+@benchmark('TuyaDevice._serialise_message/3.1')
+def bench_tuya_serialise_31():
+    device = tuya_device('3.1')
+    return lambda: device._serialise_message({'command': 7, 'payload': {'devId': 'bench', 'dps': {'1': True}}})
+
+
+def _read_and_parse(device, reader, count):
+    def run():
+        reader.reset()
+        for _ in range(count):
+            assert device._read_and_parse_message(reader) is not None
+    return run
+
+
+@benchmark('TuyaDevice._read_and_parse_message/3.3')
+def bench_tuya_parse_33():
+    return _read_and_parse(tuya_device('3.3'), FrameReader(tuya_reply(3.3)), 1)
+
+
+@benchmark('TuyaDevice._read_and_parse_message/3.1')
+def bench_tuya_parse_31():
+    return _read_and_parse(tuya_device('3.1'), FrameReader(tuya_reply(3.1)), 1)
+
+
+@benchmark('TuyaDevice._read_and_parse_message/3.3-max')
+def bench_tuya_parse_33_max():
+    dps = dict((str(i), 'x' * 8) for i in range(1, 10))
+    return _read_and_parse(tuya_device('3.3'), FrameReader(tuya_reply(3.3, dps)), 1)
+
+
+@benchmark('TuyaDevice._read_and_parse_message/100-frames')
+def bench_tuya_parse_many():
+    return _read_and_parse(tuya_device('3.3'), FrameReader(tuya_reply(3.3) * 100), 100)
+
+
+@benchmark('TuyaDeviceListener.parse_packet')
+def bench_tuya_parse_packet():
+    listener = TuyaDeviceListener(udp_key=UDP_KEY)
+    packet = tuya_broadcast()
+    return lambda: listener.get_payload(listener.parse_packet(packet).payload)
+
+
+# AES
+
+def _aes_benchmarks():
+    for backend in sorted(BACKENDS):
+        for size_name, size in (('small', 64), ('max', 1024)):
+            def setup(backend=backend, size=size):
+                cipher = AESCipher(KEY, backend=backend)
+                text = b'x' * size
+                return lambda: cipher.encrypt(text, False)
+            BENCHMARKS['AESCipher.encrypt/{}/{}'.format(backend, size_name)] = setup
+
+            def setup(backend=backend, size=size):
+                cipher = AESCipher(KEY, backend=backend)
+                data = cipher.encrypt(b'x' * size, False)
+                return lambda: cipher.decrypt(data, False)
+            BENCHMARKS['AESCipher.decrypt/{}/{}'.format(backend, size_name)] = setup
+
+_aes_benchmarks()
+
+
+# Runner
+
+def measure(fn, rounds=5, min_time=0.1):
+    # Calibrate the number of calls per round so that each round takes at least `min_time`
+    number = 1
+    while True:
+        started = time.time()
+        for _ in xrange(number):
+            fn()
+        elapsed = time.time() - started
+        if elapsed >= min_time:
+            break
+        number *= 2 if elapsed <= 0 else max(2, int(min_time / elapsed * 1.2))
+
+    timings = []
+    for _ in range(rounds):
+        started = time.time()
+        for _ in xrange(number):
+            fn()
+        timings.append((time.time() - started) / number * 1e9)
+    timings.sort()
+    return {'ns_per_op': timings[0], 'median_ns_per_op': timings[len(timings) // 2], 'calls': number, 'rounds': rounds}
+
+
+def run(names, rounds=5, min_time=0.1):
+    results = OrderedDict()
+    # Silence the debug output of the code under test (it still gets formatted, as in production)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        for name in names:
+            results[name] = measure(BENCHMARKS[name](), rounds=rounds, min_time=min_time)
+            sys.stderr.write('{:<55} {:>14.0f} ns/op\n'.format(name, results[name]['ns_per_op']))
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return {
+        'meta': {
+            'time': time.time(),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'aes_backends': sorted(BACKENDS),
+        },
+        'results': results,
+    }
+
+
+def compare(before, after, threshold=0.1):
+    # Returns the names of the benchmarks that got slower than the threshold (a fraction, 0.1 is 10%)
+    regressions = []
+    print('{:<55} {:>14} {:>14} {:>8}'.format('benchmark', 'before ns/op', 'after ns/op', 'change'))
+    for name, result in after['results'].items():
+        previous = before['results'].get(name)
+        if previous is None:
+            print('{:<55} {:>14} {:>14.0f} {:>8}'.format(name, '-', result['ns_per_op'], 'new'))
+            continue
+        change = result['ns_per_op'] / previous['ns_per_op'] - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('{:<55} {:>14.0f} {:>14.0f} {:>+7.1f}%{}'.format(name, previous['ns_per_op'], result['ns_per_op'],
+                                                               change * 100, flag))
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Run the micro-benchmarks or compare two runs')
+    parser.add_argument('--filter', help='only run the benchmarks whose name contains this')
+    parser.add_argument('--list', action='store_true', help='list the benchmarks and exit')
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.1, help='minimum duration of each round, in seconds')
+    parser.add_argument('--output', help='write the results (JSON) to this file instead of stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two results files')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown that counts as a regression (0.1=10%%)')
+    opts = parser.parse_args(args)
+
+    if opts.compare:
+        with open(opts.compare[0]) as before_file, open(opts.compare[1]) as after_file:
+            regressions = compare(json.load(before_file, object_pairs_hook=OrderedDict),
+                                  json.load(after_file, object_pairs_hook=OrderedDict), opts.threshold)
+        if regressions:
+            print('{} regression(s) beyond {:.0f}%'.format(len(regressions), opts.threshold * 100))
+            sys.exit(1)
+        return
+
+    names = [name for name in BENCHMARKS if not opts.filter or opts.filter in name]
+    if opts.list:
+        print('\n'.join(names))
+        return
+
+    results = run(names, rounds=opts.rounds, min_time=opts.min_time)
+    if opts.output:
+        with open(opts.output, 'w') as output_file:
+            json.dump(results, output_file, indent=4)
+    else:
+        print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -2,21 +2,89 @@ import base64
 import pyaes  # https://github.com/ricmoo/pyaes
 
 
-class AESCipher(object):
+# Use a C implementation of AES when one is installed (pycryptodome, pycrypto or cryptography), falling back to pyaes
+try:
+    from Cryptodome.Cipher import AES as _CryptoAES
+except ImportError:
+    try:
+        from Crypto.Cipher import AES as _CryptoAES
+    except ImportError:
+        _CryptoAES = None
+
+try:
+    from cryptography.hazmat.backends import default_backend as _default_backend
+    from cryptography.hazmat.primitives.ciphers import Cipher as _Cipher, algorithms as _algorithms, modes as _modes
+except ImportError:
+    _Cipher = None
+
+
+class PyAESBackend(object):
+    name = 'pyaes'
+
     def __init__(self, key):
+        # The mode object holds the expanded key, and ECB keeps no state between blocks
+        self.aes = pyaes.AESModeOfOperationECB(key)
+
+    def encrypt(self, data):
+        encrypt = self.aes.encrypt
+        return b''.join([encrypt(data[i:i+16]) for i in range(0, len(data), 16)])
+
+    def decrypt(self, data):
+        decrypt = self.aes.decrypt
+        return b''.join([decrypt(data[i:i+16]) for i in range(0, len(data), 16)])
+
+
+class PyCryptoBackend(object):
+    name = 'pycrypto'
+
+    def __init__(self, key):
+        self.aes = _CryptoAES.new(key, _CryptoAES.MODE_ECB)
+
+    def encrypt(self, data):
+        return self.aes.encrypt(data)
+
+    def decrypt(self, data):
+        return self.aes.decrypt(data)
+
+
+class CryptographyBackend(object):
+    name = 'cryptography'
+
+    def __init__(self, key):
+        self.cipher = _Cipher(_algorithms.AES(key), _modes.ECB(), backend=_default_backend())
+
+    def encrypt(self, data):
+        encryptor = self.cipher.encryptor()
+        return encryptor.update(data) + encryptor.finalize()
+
+    def decrypt(self, data):
+        decryptor = self.cipher.decryptor()
+        return decryptor.update(data) + decryptor.finalize()
+
+
+BACKENDS = {
+    'pyaes': PyAESBackend,
+}
+if _CryptoAES is not None:
+    BACKENDS['pycrypto'] = PyCryptoBackend
+if _Cipher is not None:
+    BACKENDS['cryptography'] = CryptographyBackend
+
+DEFAULT_BACKEND = 'pycrypto' if 'pycrypto' in BACKENDS else 'cryptography' if 'cryptography' in BACKENDS else 'pyaes'
+
+
+class AESCipher(object):
+    """
+    AES-ECB with PKCS7 padding. The backend (and the expanded key) is created once, so keep the AESCipher object
+    around instead of creating one per message.
+    """
+    def __init__(self, key, backend=None):
         self.bs = 16
         self.key = key
+        self.backend = BACKENDS[backend or DEFAULT_BACKEND](key)
 
     def encrypt(self, raw, use_base64 = True):
-        # if Crypto:
-        #     raw = self._pad(raw)
-        #     cipher = AES.new(self.key, mode=AES.MODE_ECB)
-        #     crypted_text = cipher.encrypt(raw)
-        # else:
-        _ = self._pad(raw)
-        cipher = pyaes.blockfeeder.Encrypter(pyaes.AESModeOfOperationECB(self.key))
-        crypted_text = cipher.feed(raw)
-        crypted_text += cipher.feed()
+        crypted_text = self.backend.encrypt(self._pad(raw))
 
         if use_base64:
             return base64.b64encode(crypted_text)
@@ -27,15 +95,7 @@ class AESCipher(object):
         if use_base64:
             enc = base64.b64decode(enc)
 
-        # if Crypto:
-        #     cipher = AES.new(self.key, AES.MODE_ECB)
-        #     raw = cipher.decrypt(enc)
-        #     return self._unpad(raw).decode('utf-8')
-        # else:
-        cipher = pyaes.blockfeeder.Decrypter(pyaes.AESModeOfOperationECB(self.key))
-        plain_text = cipher.feed(enc)
-        plain_text += cipher.feed()
-        return plain_text
+        return self._unpad(self.backend.decrypt(enc))
 
     def _pad(self, s):
         padnum = self.bs - len(s) % self.bs
@@ -43,4 +103,7 @@ class AESCipher(object):
 
     @staticmethod
     def _unpad(s):
-        return s[:-ord(s[len(s)-1:])]
\ No newline at end of file
+        padnum = ord(s[len(s)-1:])
+        if padnum < 1 or padnum > 16:
+            raise ValueError('Invalid padding')
+        return s[:-padnum]
@@ -1,4 +1,5 @@
 import asyncorepp
+from collections import OrderedDict
 import json
 import time
 import traceback
@@ -8,21 +9,51 @@ from hooks import HooksClient
 
 import async
 from .device import Device
-from .util import debug
+from .refresh import RefreshScheduler
+from .asyncsocket.pool import configure as configure_connection_pool
+from . import metrics
+from .util import debug, debugf, configure_logging
+
+
+REQUEST_LATENCY = metrics.histogram('homeswitch_request_seconds', 'Time taken to reply to API requests', ('proto', 'method', 'status'))
+HOOK_NOTIFICATIONS = metrics.counter('homeswitch_hook_notifications_total', 'Notifications sent to the hooks server', ('hook',))
+PENDING_STATUS_UPDATES = metrics.gauge('homeswitch_pending_status_updates', 'Device status updates waiting to be broadcast and sent to the hooks')
+# Request labels (for the request metrics)
+HS_METHODS = ('get', 'set', 'put', 'ping', 'subscribe')
+HTTP_METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'DELETE', 'PATCH', 'OPTIONS')
+HTTP_ROUTES = (('POST', '/api/device/sync'), ('PUT', '/api/device/'), ('GET', '/api/metrics'))
 
 
 class HomeSwitchAPI(object):
-    def __init__(self, host='0.0.0.0', port=7776, debug=False, devices={}, clients={}, hooks_server={}, requires_id=False):
+    def __init__(self, host='0.0.0.0', port=7776, debug=False, devices={}, clients={}, hooks_server={}, requires_id=False, read_buffer_size=65536, status_update_window=0, slow_callback_threshold=0.1, logging={}, max_concurrent_devices=32, max_concurrent_per_device=4, bulk_deadline=None, refresh={}, connection_pool=None):
+        if logging:
+            configure_logging(**logging)
         self.host = host
         self.port = port
         self.debug = debug
-        self.server = HybridServer(host=host, port=port)
+        self.server = HybridServer(host=host, port=port, read_buffer_size=read_buffer_size)
         self.running = True
         self.clients = clients
         self.devices = devices
         self.hooks_client = HooksClient(hooks_server) if hooks_server else None
         self.requires_id = requires_id
+        self.status_update_window = status_update_window
+        asyncorepp.MONITOR.slow_callback_threshold = slow_callback_threshold
+        self._pending_status_updates = []
+        self._status_update_timer = None
+        # Device operations from every request share these limits (so a `get` of everything doesn't connect to every
+        # device at once) and, after `bulk_deadline` seconds, requests are replied with whatever results they got
+        self.device_limiter = async.Limiter(limit=max_concurrent_devices, per_key_limit=max_concurrent_per_device)
+        self.bulk_deadline = bulk_deadline
+        # With `connection_pool` (the pool options, or {} for the defaults), device connections are kept open (and
+        # alive) by the connection pool
+        if connection_pool is not None and connection_pool is not False:
+            configure_connection_pool(**connection_pool)
+        # Devices with `refresh_status` are refreshed by a single scheduler (see RefreshScheduler for the options)
+        self.refresh_scheduler = RefreshScheduler(**refresh)
         self.server.on('request', self.on_request)
+        self.server.on('reply', self.on_reply)
+        PENDING_STATUS_UPDATES.set_function(lambda: len(self._pending_status_updates))
 
         # Initialise devices
         for dev_id, config in devices.items():
@@ -31,32 +62,64 @@ class HomeSwitchAPI(object):
             devices[dev_id] = self._create_device(dev_id, config)
 
     def _create_device(self, dev_id, config):
-        dev = Device(id=dev_id, hw=config.get('hw'), config=config)
-        dev.on('status_update', lambda status, ctx: self._broadcast_status_update(dev_id, status, ctx))
-        dev.on('status_update', lambda status, ctx: self._run_hooks(dev_id, status, ctx))
+        dev = Device(id=dev_id, hw=config.get('hw'), config=config, scheduler=self.refresh_scheduler)
+        dev.on('status_update', lambda status, ctx: self._queue_status_update(dev_id, status, ctx))
         return dev
 
-    def _broadcast_status_update(self, dev_id, status, ctx):
-        dev = self.devices[dev_id]
-        self.server.broadcast({'devices': {dev_id: {'status': status, 'ctx': ctx}}})
-
-    def _run_hooks(self, dev_id, status, ctx):
+    def _queue_status_update(self, dev_id, status, ctx):
+        # Status updates happening in the same loop iteration (or status_update_window) are sent together, in the
+        # order they happened (a device changing more than once in the meantime has all its changes sent)
+        self._pending_status_updates.append((dev_id, status, ctx))
+        if self._status_update_timer is None:
+            self._status_update_timer = asyncorepp.set_timeout(self._flush_status_updates, self.status_update_window)
+
+    def _flush_status_updates(self):
+        updates = self._pending_status_updates
+        self._pending_status_updates = []
+        self._status_update_timer = None
+        if len(updates) == 0:
+            return
+        self._broadcast_status_updates(updates)
+        self._run_hooks(updates)
+
+    def _broadcast_status_updates(self, updates):
+        # As few broadcasts as possible: a device that changed again goes in the next one
+        broadcasts = []
+        for dev_id, status, ctx in updates:
+            for devices in broadcasts:
+                if dev_id not in devices:
+                    break
+            else:
+                devices = {}
+                broadcasts.append(devices)
+            devices[dev_id] = {'status': status, 'ctx': ctx}
+        for devices in broadcasts:
+            self.server.broadcast({'devices': devices})
+
+    def _run_hooks(self, updates):
+        # A single notification per hook, with every update for it
         if self.hooks_client is None:
             return
-        dev = self.devices[dev_id]
-        debug("INFO", "Running hooks for device {}:".format(dev_id), dev.hooks)
-        for hook_name in dev.hooks:
-            self.hooks_client.notify(hook_name, 'status_update', {
-                'device': dev.json(),
-                'status': status,
-                'ctx': ctx,
-            })
+        notifications = OrderedDict()
+        for dev_id, status, ctx in updates:
+            dev = self.devices[dev_id]
+            debugf("INFO", "Running hooks for device {}:", dev_id, dev.hooks)
+            for hook_name in dev.hooks:
+                notifications.setdefault(hook_name, []).append({
+                    'device': dev.json(),
+                    'status': status,
+                    'ctx': ctx,
+                })
+        for hook_name, data in notifications.items():
+            HOOK_NOTIFICATIONS.labels(hook_name).inc(len(data))
+            self.hooks_client.notify_all(hook_name, 'status_update', data)
 
     def on_request(self, client, req, error):
+        req.received_at = time.time()
         if req.proto == "http":
-            debug("DBUG", "[Client {}] Proto {} Request: {} {}".format(client.id, req.proto, req.method, req.url))
+            debugf("DBUG", "[Client {}] Proto {} Request: {} {}", client.id, req.proto, req.method, req.url)
         else:
-            debug("DBUG", "[Client {}] Proto {} Request: {}".format(client.id, req.proto, req.method), req.body)
+            debugf("DBUG", "[Client {}] Proto {} Request: {}", client.id, req.proto, req.method, req.body)
 
         # If we had an error parsing the request, just get rid of it now!
         if error is not None:
@@ -72,6 +135,23 @@ class HomeSwitchAPI(object):
         else:
             return self.on_hs_request(client, req, error)
 
+    def on_reply(self, client, req, body):
+        received_at = getattr(req, 'received_at', None)
+        if received_at is None or body.get('partial'):
+            return
+        status = body.get('error', 'ok')
+        proto = 'http' if req.proto == 'http' else 'hs'
+        REQUEST_LATENCY.labels(proto, self._request_label(req), status).observe(time.time() - received_at)
+
+    def _request_label(self, req):
+        # Only known methods and routes become labels (anything a client sends could be a new one)
+        if req.proto != 'http':
+            return req.method if req.method in HS_METHODS else 'other'
+        path = req.url.split('?', 1)[0] if req.url is not None else None
+        if (req.method, path) in HTTP_ROUTES:
+            return '{} {}'.format(req.method, path)
+        return req.method if req.method in HTTP_METHODS else 'other'
+
     def _request_has_valid_auth(self, client, req):
         client_id = req.get_client()
         return client_id is not None and isinstance(client_id, basestring) and client_id in self.clients
@@ -86,6 +166,8 @@ class HomeSwitchAPI(object):
                 return self.put(client, req)
             if req.method == 'ping':
                 return self.ping(client, req)
+            if req.method == 'subscribe':
+                return self.subscribe(client, req)
         except Exception as e:
             err = {'error': 'internal', 'description': str(e)}
             if self.debug:
@@ -93,17 +175,33 @@ class HomeSwitchAPI(object):
             return client.reply(err)
 
     def on_http_request(self, client, req, error):
-        debug("DBUG", "HTTP Request: {} {}:".format(req.method, req.url), req.post_data)
+        debugf("DBUG", "HTTP Request: {} {}:", req.method, req.url, req.post_data)
         if req.method == 'POST' and req.url == '/api/device/sync':
             return self.sync(client, req)
         if req.method == 'PUT' and req.url == '/api/device/':
             return self.put(client, req)
+        if req.method == 'GET' and req.url.split('?', 1)[0] == '/api/metrics':
+            return self.metrics(client, req)
 
         client.reply({'error': 'not_found'})
 
+    def metrics(self, client, req):
+        # Prometheus text format, unless JSON is asked for (with ?format=json or an Accept header)
+        if 'format=json' in req.url or 'application/json' in req.headers.get('accept', ''):
+            return client.reply_http(200, metrics.to_json(), request=req)
+        return client.reply_http(200, metrics.prometheus(), content_type='text/plain; version=0.0.4', request=req)
+
     def ping(self, client, req):
         return client.reply({'ping': 'ping'})
 
+    def subscribe(self, client, req):
+        # Only get status updates about some devices (or all of them, if no devices are specified)
+        devices = req.body.get('devices', None)
+        if devices is not None and type(devices) is not list:
+            return client.reply({'error': 'request_error', 'description': 'Invalid devices `devices` value'})
+        client.subscribe(devices)
+        return client.reply({'ok': True, 'devices': sorted(client.subscriptions) if client.subscriptions else None})
+
     def sync(self, client, req):
         for dev_id, value in req.post_data.items():
             # Ignore devices that we didn't configure
@@ -131,25 +229,36 @@ class HomeSwitchAPI(object):
         if len(devices) == 0:
             return client.reply({'error': 'not_found', 'description': 'No devices were found'})
 
+        # Devices read in 'snapshot' mode (because the request asks for it or because of their `read_mode`) are
+        # served from their last known status, without contacting them
+        read_mode = req.body.get('read_mode', None)
+        if read_mode not in (None, 'device', 'snapshot'):
+            return client.reply({'error': 'request_error', 'description': 'Invalid read mode `read_mode` value'})
+        max_age = req.body.get('max_age', None)
+        if max_age is not None and (type(max_age) not in (int, float) or max_age < 0):
+            return client.reply({'error': 'request_error', 'description': 'Invalid maximum age `max_age` value'})
+        snapshot = self._snapshot(filter(lambda dev_id: (read_mode or self.devices[dev_id].read_mode) == 'snapshot', devices), max_age)
+        devices = filter(lambda dev_id: dev_id not in snapshot, devices)
+        if len(devices) == 0:
+            return client.reply({'devices': snapshot, 'ok': True}, req)
+
         debug("INFO", "Getting status for devices:", devices)
 
         errors = []
         def reply(err, results):
             if err:
                 debug("ERRO", "Error getting device statuses: ", err)
-                return client.reply(err)
+                return client.reply(err, req)
             if len(errors) > 0:
                 debug("WARN", "Found the following errors while getting the status of each device:", errors)
 
-            response = {'devices': {}, 'ok': True}
-            for res in results:
-                dev_id, status = res
-                dev = self.devices[dev_id]
-                response['devices'][dev_id] = {
-                    'metadata': dev.metadata,
-                    'status': status,
-                }
-            client.reply(response)
+            response = {'devices': snapshot, 'ok': True}
+            for dev_id, res in zip(devices, results):
+                response['devices'][dev_id] = self._device_status_entry(dev_id, res[1] if res else None, res is None)
+            client.reply(response, req)
+
+        def _on_dev_result(idx, dev_id, status):
+            client.reply({'partial': True, 'devices': {dev_id: self._device_status_entry(dev_id, status)}}, req)
 
         def _get_each_dev_status(dev_id, callback):
             def _on_dev_reply(err, status, ctx):
@@ -157,7 +266,46 @@ class HomeSwitchAPI(object):
                     errors.append(err)
                 callback(None, dev_id, None if err else status)
             self.devices[dev_id].get_status(_on_dev_reply, ctx=req.get_ctx())
-        async.each(devices, _get_each_dev_status, reply)
+        self._each_device(client, req, devices, lambda dev_id: dev_id, _get_each_dev_status, reply, _on_dev_result)
+
+    def _snapshot(self, dev_ids, max_age=None):
+        # All entries are read at once (in the same loop iteration), so they're a consistent view of the devices.
+        # The ones older than `max_age` (or the device's `snapshot_max_age`) are refreshed in the background, for the
+        # next reads (stale-while-revalidate).
+        now = time.time()
+        entries = {}
+        for dev_id in dev_ids:
+            dev = self.devices[dev_id]
+            status, age = dev.snapshot(now)
+            entries[dev_id] = self._device_status_entry(dev_id, status)
+            entries[dev_id]['age'] = age
+            if dev.is_stale(age, max_age) and dev.revalidate(lambda task, dev_id=dev_id: self.device_limiter.run(dev_id, task)):
+                debugf("DBUG", "Status snapshot of device {} is stale ({}s old). Refreshing it...", dev_id, age)
+        return entries
+
+    def _device_status_entry(self, dev_id, status, timed_out=False):
+        entry = {
+            'metadata': self.devices[dev_id].metadata,
+            'status': status,
+        }
+        if timed_out:
+            entry['error'] = 'timeout'
+        return entry
+
+    def _each_device(self, client, req, items, key, each_fn, final_callback, on_result):
+        # Runs a device operation for every item, within the device concurrency limits and the request deadline.
+        # Native clients asking for `stream` get each device's result as soon as it's available.
+        deadline = req.body.get('deadline', self.bulk_deadline) if req.proto != 'http' else self.bulk_deadline
+        if deadline is not None and (type(deadline) not in (int, float) or deadline <= 0):
+            deadline = self.bulk_deadline
+        stream = req.proto != 'http' and req.body.get('stream') is True
+        def _on_finish(err, results):
+            # Errors raised by the device operations are internal errors
+            if isinstance(err, Exception):
+                err = {'error': 'internal', 'description': str(err)}
+            final_callback(err, results)
+        async.each_limit(items, each_fn, _on_finish, limiter=self.device_limiter, key=key, deadline=deadline,
+                         on_result=on_result if stream else None)
 
     def set(self, client, req):
         # Validate and clean up payload
@@ -187,14 +335,17 @@ class HomeSwitchAPI(object):
         def _finish(err, results):
             if err:
                 debug("ERRO", "Error setting device statuses: ", err)
-                return client.reply(err)
+                return client.reply(err, req)
             if len(errors) > 0:
                 debug("WARN", "Found the following errors while settings the status of each device:", errors)
 
             response = {'devices': {}}
-            for dev_id, status in results:
-                response['devices'][dev_id] = {'status': status}
-            client.reply(response)
+            for (dev_id, _), res in zip(device_updates, results):
+                response['devices'][dev_id] = {'status': res[1]} if res else {'status': None, 'error': 'timeout'}
+            client.reply(response, req)
+
+        def _on_dev_result(idx, dev_id, status):
+            client.reply({'partial': True, 'devices': {dev_id: {'status': status}}}, req)
 
         def _set_each_dev_status(id_status, callback):
             dev_id, status = id_status
@@ -205,7 +356,7 @@ class HomeSwitchAPI(object):
             self.devices[dev_id].set_status(status, ctx=req.get_ctx(), callback=_on_dev_reply)
 
         # Set the status of all devices
-        async.each(device_updates, _set_each_dev_status, _finish)
+        self._each_device(client, req, device_updates, lambda id_status: id_status[0], _set_each_dev_status, _finish, _on_dev_result)
 
     def put(self, client, req):
         if 'devices' in req.body and type(req.body.get('devices')) != dict:
@@ -252,7 +403,7 @@ class HomeSwitchAPI(object):
 
     def run(self):
         debug("INFO", "Starting API...")
-        asyncorepp.loop(use_poll=True)
+        asyncorepp.loop(use_poll=True, use_epoll=True)
 
 
 
@@ -1,3 +1,6 @@
+from collections import deque
+
+from .asyncorepp import set_timeout, cancel_timeout
 from .util import DO_NOTHING, debug
 
 
@@ -31,3 +34,166 @@ def each(items, eachFn, finalCallback=DO_NOTHING):
 		_run(x)
 
 	return results
+
+
+class Limiter(object):
+	"""
+	Runs tasks with at most `limit` of them running at once and at most `per_key_limit` at once with the same key
+	(None means no limit). Tasks are started in the order they were added, unless the ones before them are waiting
+	for their key to have room.
+	"""
+	def __init__(self, limit=None, per_key_limit=None):
+		self.limit = limit
+		self.per_key_limit = per_key_limit
+		self.running = 0
+		self.running_by_key = {}
+		self.waiting = deque()
+		self._draining = False
+
+	def run(self, key, task):
+		# Calls task(done) once there's room for it. The task must call done() when it's finished.
+		# Returns a handle that can be used to cancel() the task if it didn't start yet.
+		handle = LimiterTask(key, task)
+		self.waiting.append(handle)
+		self._drain()
+		return handle
+
+	def cancel(self, handle):
+		if handle.state != 'waiting':
+			return False
+		handle.state = 'cancelled'
+		self.waiting.remove(handle)
+		return True
+
+	def _can_run(self, key):
+		if self.limit is not None and self.running >= self.limit:
+			return False
+		return self.per_key_limit is None or self.running_by_key.get(key, 0) < self.per_key_limit
+
+	def _next_runnable(self):
+		if self.limit is not None and self.running >= self.limit:
+			return None
+		for idx, handle in enumerate(self.waiting):
+			if self._can_run(handle.key):
+				del self.waiting[idx]
+				return handle
+		return None
+
+	def _drain(self):
+		# Tasks that finish right away call done() from inside this loop, so instead of starting the next task from
+		# there (and recursing), we just let this loop carry on
+		if self._draining:
+			return
+		self._draining = True
+		try:
+			while True:
+				handle = self._next_runnable()
+				if handle is None:
+					return
+				self._start(handle)
+		finally:
+			self._draining = False
+
+	def _start(self, handle):
+		handle.state = 'running'
+		self.running += 1
+		self.running_by_key[handle.key] = self.running_by_key.get(handle.key, 0) + 1
+
+		def done():
+			if handle.state != 'running':
+				return
+			handle.state = 'done'
+			self.running -= 1
+			count = self.running_by_key[handle.key] - 1
+			if count == 0:
+				del self.running_by_key[handle.key]
+			else:
+				self.running_by_key[handle.key] = count
+			self._drain()
+
+		try:
+			handle.task(done)
+		except Exception as e:
+			debug("ERRO", "Caught error starting a limited task:", e)
+			done()
+
+
+class LimiterTask(object):
+	__slots__ = ('key', 'task', 'state')
+
+	def __init__(self, key, task):
+		self.key = key
+		self.task = task
+		self.state = 'waiting'
+
+
+def each_limit(items, eachFn, finalCallback=DO_NOTHING, limiter=None, key=None, deadline=None, on_result=None):
+	"""
+	Like each(), but the items are run through a Limiter (using key(item) as the limiter key) and, if a `deadline`
+	(in seconds) is set, finalCallback is called when it's reached, with None as the result of the unfinished items.
+	on_result(idx, *results) is called as soon as each item finishes. An exception raised by eachFn is the error of
+	its item.
+	"""
+	results = [None] * len(items)
+	handles = []
+	shared = {'finished': 0, 'finalCalled': False, 'timer': None}
+
+	def _finish(err):
+		shared['finalCalled'] = True
+		if shared['timer'] is not None:
+			cancel_timeout(shared['timer'])
+			shared['timer'] = None
+		# Whatever didn't start yet won't be needed anymore
+		if limiter is not None:
+			for handle in handles:
+				limiter.cancel(handle)
+		finalCallback(err, results)
+
+	def _on_each_done(idx, done, rvs):
+		done()
+		if shared['finalCalled']:
+			return
+		args = list(rvs)
+		err = args.pop(0)
+		if err:
+			debug("ERRO", "Caught error during each_limit() execution:", err)
+			return _finish(err)
+
+		results[idx] = tuple(args)
+		shared['finished'] += 1
+		if on_result is not None:
+			on_result(idx, *args)
+		if shared['finished'] == len(items):
+			_finish(None)
+
+	def _on_deadline():
+		shared['timer'] = None
+		if not shared['finalCalled']:
+			debug("WARN", "Deadline reached with {} of {} items finished".format(shared['finished'], len(items)))
+			_finish(None)
+
+	def _task(idx):
+		def _run(done):
+			try:
+				eachFn(items[idx], lambda *args: _on_each_done(idx, done, args))
+			except Exception as e:
+				if results[idx] is not None:
+					raise
+				_on_each_done(idx, done, (e,))
+		return _run
+
+	if len(items) == 0:
+		return finalCallback(None, [])
+
+	if deadline is not None:
+		shared['timer'] = set_timeout(_on_deadline, deadline)
+
+	for idx in range(0, len(items)):
+		if shared['finalCalled']:
+			break
+		if limiter is None:
+			_task(idx)(DO_NOTHING)
+		else:
+			handles.append(limiter.run(key(items[idx]) if key else None, _task(idx)))
+
+	return results
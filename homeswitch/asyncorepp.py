@@ -1,85 +1,363 @@
 import asyncore
+from collections import deque
+from errno import EINTR
+import heapq
+import itertools
 import select
 import time
-import uuid
 
-from .util import debug
+from . import metrics
+from .util import debug, flush_log, log_in_background
 
 
+# Timers live in a min-heap of [when, timer_id] entries ordered by deadline. TIMERS maps each live timer id to its
+# (callback, interval, when) record, so cancelling a timer is just dropping it from TIMERS: the heap entry is skipped
+# (lazily) when it reaches the top. Interval timers are rescheduled by pushing a new entry with the same id.
 TIMERS = {}
+_TIMER_HEAP = []
+_TIMER_IDS = itertools.count(1)
 
+LOOP_BUSY = metrics.histogram('homeswitch_loop_busy_seconds', 'Time each loop iteration spent handling events and timers')
+TIMER_LATENESS = metrics.histogram('homeswitch_timer_lateness_seconds', 'Time between when timers were due and when they ran')
+SLOW_CALLBACKS = metrics.counter('homeswitch_slow_callbacks_total', 'Callbacks that blocked the loop for longer than the threshold', ('callback',))
+LOOP_BUSY_RECENT = metrics.gauge('homeswitch_loop_busy_recent_seconds', 'Percentiles of the recent loop iteration busy times', ('quantile',))
+TIMER_LATENESS_RECENT = metrics.gauge('homeswitch_timer_lateness_recent_seconds', 'Percentiles of the recent timer lateness', ('quantile',))
 
-def loop(timeout=1, use_poll=False, map=None, count=None):
+POLL_EVENT_NAMES = (
+    (select.POLLIN | select.POLLPRI, 'read'),
+    (select.POLLOUT, 'write'),
+    (select.POLLHUP | select.POLLERR | select.POLLNVAL, 'close'),
+)
+
+
+class LoopMonitor(object):
+    """
+    Measures how long each loop iteration is busy (handling events and timers, not waiting for them), how late timers
+    run and how long each dispatcher and timer callback takes. Callbacks slower than `slow_callback_threshold` seconds
+    are reported with their name (set it to None to stop timing callbacks). The latest `window` samples are kept for
+    the recent percentiles.
+    """
+    def __init__(self, slow_callback_threshold=0.1, window=1024):
+        self.slow_callback_threshold = slow_callback_threshold
+        self.busy = deque(maxlen=window)
+        self.lateness = deque(maxlen=window)
+        for quantile in (0.5, 0.99, 1):
+            LOOP_BUSY_RECENT.labels(str(quantile)).set_function(lambda quantile=quantile: self.percentile(self.busy, quantile))
+            TIMER_LATENESS_RECENT.labels(str(quantile)).set_function(lambda quantile=quantile: self.percentile(self.lateness, quantile))
+
+    def record_busy(self, elapsed):
+        self.busy.append(elapsed)
+        LOOP_BUSY.observe(elapsed)
+
+    def record_lateness(self, lateness):
+        self.lateness.append(lateness)
+        TIMER_LATENESS.observe(lateness)
+
+    def slow_dispatcher(self, obj, flags, elapsed):
+        events = [name for flag, name in POLL_EVENT_NAMES if flags & flag]
+        address = getattr(obj, 'addr', None)
+        self._report(callable_name(type(obj)), elapsed, '({}{})'.format('/'.join(events), ' from/to {}'.format(address) if address else ''))
+
+    def slow_timer(self, callback, elapsed):
+        self._report(callable_name(callback), elapsed, '(timer)')
+
+    def _report(self, name, elapsed, detail):
+        SLOW_CALLBACKS.labels(name).inc()
+        debug("WARN", "Slow callback {} {} blocked the loop for {:.3f}s".format(name, detail, elapsed))
+
+    @staticmethod
+    def percentile(samples, quantile):
+        if len(samples) == 0:
+            return 0
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))]
+
+    def stats(self):
+        return dict(
+            ('{}_p{}'.format(name, int(quantile * 100)), self.percentile(samples, quantile))
+            for name, samples in (('busy', self.busy), ('lateness', self.lateness))
+            for quantile in (0.5, 0.99, 1)
+        )
+
+
+MONITOR = LoopMonitor()
+
+
+def callable_name(fn):
+    # A name to find a callable by: module.Class.method, module.function or module.<lambda>:line
+    owner = getattr(fn, '__self__', None) or getattr(fn, 'im_self', None)
+    func = getattr(fn, '__func__', None) or getattr(fn, 'im_func', None) or fn
+    name = getattr(func, '__name__', None) or type(fn).__name__
+    if owner is not None:
+        cls = owner if isinstance(owner, type) else type(owner)
+        return '{}.{}.{}'.format(cls.__module__, cls.__name__, name)
+    if name == '<lambda>':
+        code = getattr(func, '__code__', None)
+        return '{}.<lambda>:{}'.format(getattr(func, '__module__', '?'), code.co_firstlineno if code else '?')
+    return '{}.{}'.format(getattr(func, '__module__', '?'), name)
+
+
+def loop(timeout=1, use_poll=False, map=None, count=None, use_epoll=False):
     if map is None:
         map = asyncore.socket_map
 
-    if use_poll and hasattr(select, 'poll'):
-        poll_fun = asyncore.poll2
+    # The pollers tell how long they waited for events, which isn't busy time
+    if use_epoll and hasattr(select, 'epoll'):
+        poller = EpollPoller()
+    elif use_poll and hasattr(select, 'poll'):
+        poller = PollPoller()
     else:
-        poll_fun = asyncore.poll
+        poller = SelectPoller()
 
-    if count is None:
-        while map:
-            poll_fun(timeout, map)
-            _check_timers()
-    else:
-        while map and count > 0:
-            poll_fun(timeout, map)
-            _check_timers()
+    while map and (count is None or count > 0):
+        started = time.time()
+        poller.poll(_poll_timeout(timeout), map)
+        _check_timers()
+        MONITOR.record_busy(time.time() - started - poller.last_wait)
+        # Buffered log lines are written once per iteration, unless the log has its own writer thread
+        if not log_in_background():
+            flush_log()
+        if count is not None:
             count = count - 1
 
 
+def _poll_timeout(timeout):
+    # Never wait longer than it takes for the next timer to be due
+    next_when = next_timer()
+    if next_when is None:
+        return timeout
+    wait = next_when - time.time()
+    if wait <= 0:
+        return 0
+    return wait if timeout is None or wait < timeout else timeout
+
+
+class Poller(object):
+    """
+    Waits for events on the dispatchers of a map and handles them, like asyncore's poll functions do, keeping how long
+    the last wait took in `last_wait` and timing the dispatchers for the monitor. Subclasses register the dispatchers
+    with _register(map) and wait with _wait(timeout, registered), which returns the (fd, poll flags) events.
+    """
+    def __init__(self):
+        self.last_wait = 0
+
+    def poll(self, timeout=0.0, map=None):
+        if map is None:
+            map = asyncore.socket_map
+
+        registered = self._register(map)
+        started = time.time()
+        try:
+            events = self._wait(timeout, registered)
+        except (IOError, select.error) as e:
+            if e.args[0] != EINTR:
+                raise
+            events = []
+        self.last_wait = time.time() - started
+
+        threshold = MONITOR.slow_callback_threshold
+        for fd, flags in events:
+            obj = map.get(fd)
+            if obj is None:
+                continue
+            if threshold is None:
+                asyncore.readwrite(obj, flags)
+                continue
+            started = time.time()
+            asyncore.readwrite(obj, flags)
+            elapsed = time.time() - started
+            if elapsed > threshold:
+                MONITOR.slow_dispatcher(obj, flags, elapsed)
+
+    def _register(self, map):
+        raise NotImplementedError()
+
+    def _wait(self, timeout, registered):
+        raise NotImplementedError()
+
+
+class SelectPoller(Poller):
+    """
+    asyncore.poll() as a Poller: select() results are turned into poll flags.
+    """
+    def _register(self, map):
+        r = []
+        w = []
+        e = []
+        for fd, obj in map.items():
+            is_r = obj.readable()
+            is_w = obj.writable()
+            if is_r:
+                r.append(fd)
+            # accepting sockets should not be writable
+            if is_w and not obj.accepting:
+                w.append(fd)
+            if is_r or is_w:
+                e.append(fd)
+        return r, w, e
+
+    def _wait(self, timeout, registered):
+        r, w, e = registered
+        if [] == r == w == e:
+            time.sleep(timeout)
+            return []
+
+        r, w, e = select.select(r, w, e, timeout)
+        events = {}
+        for fds, flag in ((r, select.POLLIN), (w, select.POLLOUT), (e, select.POLLPRI)):
+            for fd in fds:
+                events[fd] = events.get(fd, 0) | flag
+        return events.items()
+
+
+class PollPoller(Poller):
+    """
+    asyncore.poll2() as a Poller.
+    """
+    def _register(self, map):
+        pollster = select.poll()
+        for fd, obj in map.items():
+            flags = 0
+            if obj.readable():
+                flags |= select.POLLIN | select.POLLPRI
+            # accepting sockets should not be writable
+            if obj.writable() and not obj.accepting:
+                flags |= select.POLLOUT
+            if flags:
+                pollster.register(fd, flags | select.POLLERR | select.POLLHUP | select.POLLNVAL)
+        return pollster
+
+    def _wait(self, timeout, pollster):
+        return pollster.poll(None if timeout is None else int(timeout * 1000))
+
+
+class EpollPoller(Poller):
+    """
+    A drop-in replacement for asyncore.poll2() that keeps the file descriptor registrations in a single (level
+    triggered) epoll object across loop iterations. Dispatchers are only re-registered when their readable()/writable()
+    state changes, they leave the map or their file descriptor gets reused by another dispatcher.
+    """
+    def __init__(self):
+        Poller.__init__(self)
+        self.epoll = select.epoll()
+        self.registered = {}
+
+    def _register(self, map):
+        self._update_registrations(map)
+
+    def _wait(self, timeout, registered):
+        return self.epoll.poll(-1 if timeout is None else timeout)
+
+    def _update_registrations(self, map):
+        registered = self.registered
+        in_map = 0
+        for fd, obj in map.items():
+            flags = 0
+            if obj.readable():
+                flags |= select.EPOLLIN | select.EPOLLPRI
+            # accepting sockets should not be writable
+            if obj.writable() and not obj.accepting:
+                flags |= select.EPOLLOUT
+
+            current = registered.get(fd)
+            if current is not None:
+                if current[0] is obj and current[1] == flags:
+                    in_map += 1
+                    continue
+                self._unregister(fd)
+            # Only check for exceptions if object is either readable or writable (just like poll2 does)
+            if flags:
+                self.epoll.register(fd, flags | select.EPOLLERR | select.EPOLLHUP)
+                registered[fd] = (obj, flags)
+                in_map += 1
+
+        # Forget about the dispatchers that are gone
+        if in_map < len(registered):
+            for fd in [fd for fd in registered if fd not in map]:
+                self._unregister(fd)
+
+    def _unregister(self, fd):
+        del self.registered[fd]
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, OSError, ValueError):
+            # The socket was already closed (which removes it from the epoll set)
+            pass
+
+
+def next_timer():
+    while _TIMER_HEAP:
+        when, timer_id = _TIMER_HEAP[0]
+        timer = TIMERS.get(timer_id)
+        if timer is not None and timer[2] == when:
+            return when
+        # Cancelled or rescheduled, drop it
+        heapq.heappop(_TIMER_HEAP)
+    return None
+
+
 def _check_timers():
     now = time.time()
-    calls = {}
-    for timer_id, timer in TIMERS.items():
-        if now >= timer.get('when'):
-            calls[timer_id] = timer.get('what')
-            if timer.get('interval') is not None:
-                timer['when'] = time.time() + timer.get('interval')
-
-    for timer_id, call in calls.items():
+    calls = []
+    while _TIMER_HEAP and _TIMER_HEAP[0][0] <= now:
+        when, timer_id = heapq.heappop(_TIMER_HEAP)
+        timer = TIMERS.get(timer_id)
+        if timer is None or timer[2] != when:
+            continue
+        callback, interval, _ = timer
+        if interval is None:
+            del TIMERS[timer_id]
+        else:
+            _schedule(timer_id, callback, interval, time.time() + interval)
+        calls.append((timer_id, callback, when))
+
+    threshold = MONITOR.slow_callback_threshold
+    for timer_id, call, when in calls:
+        started = time.time()
+        MONITOR.record_lateness(started - when)
         try:
             call()
         except Exception as e:
             debug("ERRO", "Exception running interval callback for timer {}: ".format(timer_id), e)
             import traceback
             traceback.print_exc()
+        if threshold is not None:
+            elapsed = time.time() - started
+            if elapsed > threshold:
+                MONITOR.slow_timer(call, elapsed)
 
 
-def set_timeout(callback, timeout):
-    def call_and_expire():
-        del TIMERS[timer_id]
-        return callback()
-
-    timer_id = uuid.uuid4()
-    TIMERS[timer_id] = {
-        'when': time.time() + timeout,
-        'what': call_and_expire,
-        'interval': None,
-    }
+def _schedule(timer_id, callback, interval, when):
+    TIMERS[timer_id] = (callback, interval, when)
+    heapq.heappush(_TIMER_HEAP, [when, timer_id])
     return timer_id
 
 
+def set_timeout(callback, timeout):
+    return _schedule(next(_TIMER_IDS), callback, None, time.time() + timeout)
+
+
 def set_interval(callback, timeout):
-    timer_id = uuid.uuid4()
-    TIMERS[timer_id] = {
-        'when': time.time() + timeout,
-        'what': callback,
-        'interval': timeout,
-    }
-    return timer_id
+    return _schedule(next(_TIMER_IDS), callback, timeout, time.time() + timeout)
 
 
 def cancel_timeout(timer_id):
     if timer_id not in TIMERS:
         debug("WARN", "Trying to cancel timeout timer {} which doesn't exist. This should be fixed".format(timer_id))
         return
-    del TIMERS[timer_id]
+    _cancel(timer_id)
 
 
 def cancel_interval(timer_id):
     if timer_id not in TIMERS:
         debug("WARN", "Trying to cancel interval timer {} which doesn't exist. This should be fixed".format(timer_id))
         return
+    _cancel(timer_id)
+
+
+def _cancel(timer_id):
     del TIMERS[timer_id]
+    # If the heap is mostly made of cancelled entries, rebuild it so it doesn't grow unbounded
+    if len(_TIMER_HEAP) > 64 and len(_TIMER_HEAP) > 2 * len(TIMERS):
+        _TIMER_HEAP[:] = [[timer[2], live_id] for live_id, timer in TIMERS.items()]
+        heapq.heapify(_TIMER_HEAP)
@@ -4,10 +4,16 @@ from errno import EALREADY, EINPROGRESS, EWOULDBLOCK, ECONNRESET, EINVAL, \
 from pymitter import EventEmitter
 import socket
 import sys
+import time
 import traceback
 
 from ..asyncorepp import set_timeout, cancel_timeout
-from ..util import debug, DO_NOTHING
+from .. import metrics
+from ..util import debug, debugf, DO_NOTHING
+
+
+CONNECT_TIME = metrics.histogram('homeswitch_socket_connect_seconds', 'Time taken to connect to devices', ('peer',))
+CONNECT_FAILURES = metrics.counter('homeswitch_socket_connect_failures_total', 'Failed connection attempts', ('peer', 'reason'))
 
 
 # Events
@@ -30,6 +36,7 @@ class AsyncSocketClient(EventEmitter):
         self.buffer = bytearray()
         self.ttl = ttl
         self.ttl_timeout = None
+        self.connect_started = None
 
     # Connects
     def connect(self, ip, port, timeout=None):
@@ -37,6 +44,7 @@ class AsyncSocketClient(EventEmitter):
         self.port = port
         self.connected = False
         self.connecting = True
+        self.connect_started = time.time()
         self.socket = AsyncSocketClientNative(ip, port)
         self.fd = self.socket.socket.fileno()
         self.socket.on('connect', self._on_connect)
@@ -55,7 +63,7 @@ class AsyncSocketClient(EventEmitter):
         # Set a timeout
         self.timeout = None
         if timeout is not None:
-            debug("DBUG", "Setting socket timeout to {}".format(timeout))
+            debugf("DBUG", "Setting socket timeout to {}", timeout)
             self.timeout = set_timeout(lambda: self._on_failure({'error': 'timeout'}), timeout)
 
     def disconnect(self):
@@ -65,32 +73,36 @@ class AsyncSocketClient(EventEmitter):
 
         if self.connected:
             self.connected = False
-            debug("DBUG", "Closing connecting socket to {}:{} (fd: {})".format(self.ip, self.port, self.fd))
+            debugf("DBUG", "Closing connecting socket to {}:{} (fd: {})", self.ip, self.port, self.fd)
             if self.socket and self.socket.socket:
                 self.socket.close()
             else:
-                debug("DBUG", "Connection to {}:{} NOT closed as is has no socket (fd: {})".format(self.ip, self.port, self.fd))
+                debugf("DBUG", "Connection to {}:{} NOT closed as is has no socket (fd: {})", self.ip, self.port, self.fd)
             return True
 
     def send(self, data):
-        debug("DBUG", "Sending {} bytes to {}:{} (fd: {})".format(len(data), self.ip, self.port, self.fd))
+        debugf("DBUG", "Sending {} bytes to {}:{} (fd: {})", len(data), self.ip, self.port, self.fd)
         self.socket.send(data)
 
     def receive(self, num_bytes):
         return self.socket.recv(num_bytes)
 
     def _on_connect(self):
-        debug("INFO", "Connected to {}:{} !".format(self.ip, self.port))
+        debugf("INFO", "Connected to {}:{} !", self.ip, self.port)
         if self.timeout is not None:
             cancel_timeout(self.timeout)
         self.connecting = False
         self.connected = True
+        CONNECT_TIME.labels(self._peer()).observe(time.time() - self.connect_started)
         if self.ttl is not None:
             self.ttl_timeout = set_timeout(self._on_ttl_expire, self.ttl)
         self.emit('connect')
 
+    def _peer(self):
+        return '{}:{}'.format(self.ip, self.port)
+
     def _on_ttl_expire(self):
-        debug("INFO", "Connection to {}:{} TTL {} expired".format(self.ip, self.port, self.ttl))
+        debugf("INFO", "Connection to {}:{} TTL {} expired", self.ip, self.port, self.ttl)
         self.disconnect()
 
     def _on_failure(self, ex):
@@ -98,14 +110,15 @@ class AsyncSocketClient(EventEmitter):
         cancel_timeout(self.timeout)
         self.connecting = False
         self.connected = False
+        CONNECT_FAILURES.labels(self._peer(), 'timeout' if type(ex) is dict and ex.get('error') == 'timeout' else 'error').inc()
         if self.socket and self.socket.socket:
             self.socket.close()
         self.emit('failure', ex)
 
     def _on_close(self):
-        debug("INFO", "Connection to {}:{} was closed.".format(self.ip, self.port))
+        debugf("INFO", "Connection to {}:{} was closed.", self.ip, self.port)
         if self.connected:
-            debug("INFO", "Connection to {}:{} was reset by peer.".format(self.ip, self.port))
+            debugf("INFO", "Connection to {}:{} was reset by peer.", self.ip, self.port)
             self.emit('break')
         else:
             self.emit('disconnect')
@@ -122,11 +135,11 @@ class AsyncSocketClient(EventEmitter):
         self.emit('error', t, v, tb)
 
     def _on_read(self):
-        debug("INFO", "Socket ({}:{}) read can happen".format(self.ip, self.port))
+        debugf("INFO", "Socket ({}:{}) read can happen", self.ip, self.port)
         self.emit('data')
 
     def _on_write(self):
-#        debug("INFO", "Socket ({}:{}) write can happen".format(self.ip, self.port))
+#        debugf("INFO", "Socket ({}:{}) write can happen", self.ip, self.port)
         self.emit('write')
 
     def __destroy__(self):
@@ -0,0 +1,172 @@
+from collections import OrderedDict
+import random
+import time
+
+from ..asyncorepp import set_timeout, cancel_timeout, set_interval
+from .. import metrics
+from ..util import debugf
+
+
+OPEN_CONNECTIONS = metrics.gauge('homeswitch_pool_open_connections', 'Device connections open (or opening) in the connection pool')
+POOL_CLOSES = metrics.counter('homeswitch_pool_closed_connections_total', 'Device connections closed by the connection pool', ('reason',))
+HEARTBEATS = metrics.counter('homeswitch_pool_heartbeats_total', 'Heartbeats sent to keep device connections alive', ('result',))
+RECONNECTS = metrics.counter('homeswitch_pool_reconnects_total', 'Background reconnects to recently used devices')
+
+# The pool used by the device modules (see configure())
+POOL = None
+
+
+class ConnectionPool(object):
+    """
+    Keeps the connections to recently used devices open, so commands don't have to wait for a connect.
+    At most `max_open` connections are kept (the least recently used idle ones are closed first) and connections that
+    weren't used for `idle_timeout` seconds are closed. Open connections without traffic for `heartbeat_interval`
+    seconds get a heartbeat (devices drop silent connections) and, if a connection to a recently used device breaks or
+    can't be established, it's reopened in the background with an exponential backoff (from `backoff_base` up to
+    `backoff_max` seconds). Connections of members that stay busy for `busy_timeout` seconds without any progress
+    (replies) are taken as broken and reopened too.
+
+    Members (the devices) have an `id`, `connected` and `connecting` attributes and the is_idle(), heartbeat(callback),
+    open() and close() methods, and tell the pool about their connection with touch(), opened(), progress(), idle()
+    and closed().
+    """
+    def __init__(self, max_open=64, idle_timeout=120, heartbeat_interval=10, backoff_base=0.5, backoff_max=60, busy_timeout=30):
+        self.max_open = max_open
+        self.idle_timeout = idle_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.busy_timeout = busy_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.entries = {}
+        # Open connections, from the least to the most recently used
+        self.open = OrderedDict()
+        self._interval = None
+        OPEN_CONNECTIONS.set_function(lambda: len(self.open))
+
+    def _entry(self, member):
+        entry = self.entries.get(member.id, None)
+        if entry is None:
+            entry = self.entries[member.id] = PoolEntry(member)
+        return entry
+
+    def touch(self, member):
+        # The member is being used (and so is its connection)
+        entry = self._entry(member)
+        entry.last_used = entry.last_traffic = time.time()
+        if member.id in self.open:
+            self.open[member.id] = self.open.pop(member.id)
+
+    def opened(self, member):
+        entry = self._entry(member)
+        entry.failures = 0
+        entry.last_traffic = time.time()
+        self._cancel_reconnect(entry)
+        self.open.pop(member.id, None)
+        self.open[member.id] = entry
+        if self._interval is None:
+            self._interval = set_interval(self._tick, max(0.5, min(self.heartbeat_interval, self.idle_timeout, self.busy_timeout) / 2.0))
+        if len(self.open) > self.max_open:
+            self._evict()
+
+    def progress(self, member):
+        # The member got a reply through its connection
+        entry = self._entry(member)
+        entry.last_progress = entry.last_traffic = time.time()
+
+    def idle(self, member):
+        # The member has nothing else to send, so if there are too many connections open, it can be closed now
+        if len(self.open) > self.max_open:
+            self._evict()
+
+    def closed(self, member, broken=False):
+        # The connection was closed (or failed). Broken connections to recently used devices are reopened.
+        entry = self._entry(member)
+        self.open.pop(member.id, None)
+        if broken and (not member.is_idle() or time.time() - entry.last_used < self.idle_timeout):
+            self._schedule_reconnect(entry)
+
+    def _evict(self):
+        for dev_id, entry in self.open.items():
+            if len(self.open) <= self.max_open:
+                return
+            if entry.member.is_idle():
+                self._close(entry, 'lru')
+
+    def _close(self, entry, reason):
+        debugf("INFO", "Closing pooled connection to device {} ({})", entry.member.id, reason)
+        POOL_CLOSES.labels(reason).inc()
+        self.open.pop(entry.member.id, None)
+        entry.member.close()
+
+    def _tick(self):
+        if len(self.open) > self.max_open:
+            self._evict()
+        now = time.time()
+        for dev_id, entry in self.open.items():
+            member = entry.member
+            if not member.connected:
+                continue
+            if not member.is_idle():
+                # Busy for too long without replies, the connection is probably stuck
+                if entry.busy_since is None:
+                    entry.busy_since = now
+                elif now - max(entry.busy_since, entry.last_progress) >= self.busy_timeout:
+                    debugf("WARN", "Device {} was busy for {}s without replies. Reconnecting...", dev_id, int(now - entry.busy_since))
+                    self._close(entry, 'stuck')
+                    self._schedule_reconnect(entry)
+                continue
+            entry.busy_since = None
+            if now - entry.last_used >= self.idle_timeout:
+                self._close(entry, 'idle')
+            elif now - entry.last_traffic >= self.heartbeat_interval:
+                self._heartbeat(entry)
+
+    def _heartbeat(self, entry):
+        entry.last_traffic = time.time()
+        def _on_heartbeat(err):
+            HEARTBEATS.labels('error' if err else 'ok').inc()
+            if err:
+                debugf("WARN", "Heartbeat to device {} failed. Reconnecting...", entry.member.id, err)
+                self._close(entry, 'heartbeat')
+                self._schedule_reconnect(entry)
+        entry.member.heartbeat(_on_heartbeat)
+
+    def _schedule_reconnect(self, entry):
+        self._cancel_reconnect(entry)
+        delay = min(self.backoff_base * 2 ** entry.failures, self.backoff_max) * random.uniform(0.5, 1)
+        entry.failures += 1
+        debugf("DBUG", "Reconnecting to device {} in {}s (attempt {})", entry.member.id, round(delay, 2), entry.failures)
+        entry.reconnect_timer = set_timeout(lambda: self._reconnect(entry), delay)
+
+    def _cancel_reconnect(self, entry):
+        if entry.reconnect_timer is not None:
+            cancel_timeout(entry.reconnect_timer)
+            entry.reconnect_timer = None
+
+    def _reconnect(self, entry):
+        entry.reconnect_timer = None
+        member = entry.member
+        if member.connected or member.connecting:
+            return
+        RECONNECTS.inc()
+        member.open()
+
+
+class PoolEntry(object):
+    __slots__ = ('member', 'last_used', 'last_traffic', 'last_progress', 'busy_since', 'failures', 'reconnect_timer')
+
+    def __init__(self, member):
+        self.member = member
+        self.last_used = 0
+        self.last_traffic = 0
+        self.last_progress = 0
+        self.busy_since = None
+        self.failures = 0
+        self.reconnect_timer = None
+
+
+def configure(**options):
+    # Creates the pool used by the device modules (with no options, the defaults of ConnectionPool)
+    global POOL
+    POOL = ConnectionPool(**options)
+    return POOL
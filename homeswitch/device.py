@@ -5,7 +5,7 @@ from pymitter import EventEmitter
 
 import asyncorepp
 from .hw import tuya
-from .util import debug, DO_NOTHING
+from .util import debug, debugf, DO_NOTHING
 
 DEVICE_CONTRUCTORS = {
     "tuya": tuya.TuyaDevice,
@@ -13,7 +13,7 @@ DEVICE_CONTRUCTORS = {
 
 
 class Device(EventEmitter):
-    def __init__(self, id=None, hw=None, config={}, discovery_status='offline', device_status="up", switch_status=None, hw_metadata={}, last_seen=None, **kwargs):
+    def __init__(self, id=None, hw=None, config={}, discovery_status='offline', device_status="up", switch_status=None, hw_metadata={}, last_seen=None, scheduler=None, **kwargs):
         EventEmitter.__init__(self)
         self.id = id
         self.discovery_status = discovery_status
@@ -25,6 +25,12 @@ class Device(EventEmitter):
         self.hooks = config.get('hooks', [])
         self.metadata = config.get('metadata', {})
         self.status_cache = config.get('status_cache', None)
+        # With `read_mode` 'snapshot', reads are answered from the last known status (refreshed in the background
+        # once it gets older than `snapshot_max_age` seconds)
+        self.read_mode = config.get('read_mode', 'device')
+        self.snapshot_max_age = config.get('snapshot_max_age', 60)
+        self.status_known_at = None
+        self.revalidating = False
         self.refresh_status = int(config.get('refresh_status', 0))
         self.hold_get_status = config.get('hold_get_status', False)
         self.activation_key = config.get('activation_key', None)
@@ -40,8 +46,11 @@ class Device(EventEmitter):
         if self.hw:
             self.hw.on('status_update', self._on_status_update)
 
-        # Periodically refresh the device status
-        if self.refresh_status:
+        # Periodically refresh the device status (through the scheduler, if there's one)
+        self.scheduler = scheduler if self.refresh_status else None
+        if self.scheduler:
+            self.scheduler.add(self)
+        elif self.refresh_status:
             asyncorepp.set_interval(self._refresh_status, self.refresh_status)
 
     def _import_device_module(self, id, hw, config={}, hw_metadata={}):
@@ -49,12 +58,15 @@ class Device(EventEmitter):
         return hw_module.Device(id=id, config=config, hw_metadata=hw_metadata)
 
     def _on_status_update(self, status, ctx={'origin': 'UNKWNOWN'}):
+        self.status_known_at = time.time()
         if self.switch_status != status:
-            debug("INFO", "Got a status update about device {}. Device status changed from {} to {}".format(self.id, self.switch_status, status))
+            debugf("INFO", "Got a status update about device {}. Device status changed from {} to {}", self.id, self.switch_status, status)
             self.switch_status = status
+            if self.scheduler:
+                self.scheduler.boost(self)
             self.emit('status_update', status, ctx)
         else:
-            debug("INFO", "Got a status update about device {}. Device status has NOT changed ({})".format(self.id, status))
+            debugf("INFO", "Got a status update about device {}. Device status has NOT changed ({})", self.id, status)
 
     def update(self, **kwargs):
         if 'discovery_status' in kwargs:
@@ -86,15 +98,15 @@ class Device(EventEmitter):
         }
 
     def get_status(self, callback=DO_NOTHING, ctx={'origin': 'UNKWNOWN'}, ignore_cache=False):
-        debug("INFO", "Getting device {} status".format(self.id))
+        debugf("INFO", "Getting device {} status", self.id)
         if not self.hw:
-            debug("DBUG", "Device {} has no assigned hardware. Cannot set its status".format(self.id))
+            debugf("DBUG", "Device {} has no assigned hardware. Cannot set its status", self.id)
             return callback({'error': 'Device {} has no assigned hardware. Cannott set its status'.format(self.id)}, ctx)
         if not self.discovery_status == 'online':
             debug("WARN", "Device {} is not online. Cannot get its status".format(self.id))
             return callback({'error': 'Device {} is not online. Cannot get its status'.format(self.id)}, None, ctx)
         if not ignore_cache and self.status_cache and self.last_status_update > time.time() - self.status_cache:
-            debug("INFO", "Serving device {} status from cache...".format(self.id))
+            debugf("INFO", "Serving device {} status from cache...", self.id)
             return callback(None, self.switch_status, ctx)
 
         with status_collector(self, callback) as collector_callback:
@@ -107,19 +119,19 @@ class Device(EventEmitter):
             self._check_error(err, ctx)
             return callback(err, None, ctx)
 
-        debug("INFO", "Device {} status is {}".format(self.id, status))
+        debugf("INFO", "Device {} status is {}", self.id, status)
         self._check_success()
         self.switch_status = status
-        self.last_status_update = time.time()
+        self.last_status_update = self.status_known_at = time.time()
         return callback(None, status, ctx)
 
     def set_status(self, value, ctx={'origin': 'set'}, callback=DO_NOTHING):
-        debug("INFO", "Setting device {} status to {}".format(self.id, value))
+        debugf("INFO", "Setting device {} status to {}", self.id, value)
         if not self.hw:
-            debug("DBUG", "Device {} has no assigned hardware. Cannot set its status".format(self.id))
+            debugf("DBUG", "Device {} has no assigned hardware. Cannot set its status", self.id)
             return callback({'error': 'Device {} has no assigned hardware. Cannot set its status'.format(self.id)}, None, value, ctx)
         if not self.discovery_status == 'online':
-            debug("DBUG", "Device {} is not online. Cannot set its status".format(self.id))
+            debugf("DBUG", "Device {} is not online. Cannot set its status", self.id)
             return callback({'error': 'Device {} is not online. Cannot set its status'.format(self.id)}, None, value, ctx)
 
         with status_collector(self, callback, get=False) as collector_callback:
@@ -132,16 +144,18 @@ class Device(EventEmitter):
             self._check_error(err, ctx)
             return callback(err, None, intent, ctx)
 
-        debug("INFO", "Device {} was set to {} and is now {}".format(self.id, intent, status))
+        debugf("INFO", "Device {} was set to {} and is now {}", self.id, intent, status)
         self._check_success()
         self.switch_status = status
-        self.last_status_update = time.time()
+        self.last_status_update = self.status_known_at = time.time()
+        if self.scheduler:
+            self.scheduler.boost(self)
         return callback(None, status, intent, ctx)
 
     def put_status(self, value, ctx={'origin': 'put'}, callback=DO_NOTHING):
-        debug("INFO", "Putting device {} status '{}'".format(self.id, value))
+        debugf("INFO", "Putting device {} status '{}'", self.id, value)
         if not self.hw:
-            debug("DBUG", "Device {} has no assigned hardware. Cannot put a status in it".format(self.id))
+            debugf("DBUG", "Device {} has no assigned hardware. Cannot put a status in it", self.id)
             return callback({'error': 'Device {} has no assigned hardware. Cannot put a status in it'.format(self.id)}, None, value, ctx)
 
         return self.hw.put_status(value, ctx=ctx, callback=lambda err, status: self._put_status_callback(err, status, value, ctx, callback))
@@ -151,15 +165,47 @@ class Device(EventEmitter):
             debug("ERRO", "Error putting device {} status '{}'".format(self.id, intent), err)
             return callback(err, None, intent, ctx)
 
-        debug("INFO", "Device {} status was defined to '{}' and is now '{}'".format(self.id, intent, status))
+        debugf("INFO", "Device {} status was defined to '{}' and is now '{}'", self.id, intent, status)
         self._check_success()
         self.last_status_update = time.time()
         self.discovery_status = "online"
         return callback(None, status, intent, ctx)
 
+    def snapshot(self, now=None):
+        # The last known status and its age in seconds (None if the status was never known)
+        if self.status_known_at is None:
+            return self.switch_status, None
+        return self.switch_status, max(0, (now or time.time()) - self.status_known_at)
+
+    def is_stale(self, age, max_age=None):
+        max_age = self.snapshot_max_age if max_age is None else max_age
+        return age is None or age > max_age
+
+    def revalidate(self, run=None):
+        # Refreshes the status in the background, unless a refresh is already on its way. The refresh is a task for
+        # `run(task)` (like a Limiter's), which calls task(done).
+        if self.revalidating or self.discovery_status != 'online':
+            return False
+        self.revalidating = True
+        def _task(done):
+            def _on_status(*args):
+                self.revalidating = False
+                done()
+            try:
+                self.get_status(_on_status, ctx={'origin': 'revalidate'}, ignore_cache=True)
+            except Exception:
+                # Otherwise the device would never be revalidated again
+                self.revalidating = False
+                raise
+        if run is None:
+            _task(DO_NOTHING)
+        else:
+            run(_task)
+        return True
+
     def _refresh_status(self):
         if self.discovery_status == 'online':
-            debug("INFO", "Updating device {} status...".format(self.id))
+            debugf("INFO", "Updating device {} status...", self.id)
             self.get_status(DO_NOTHING, ctx={'origin': 'refresh'}, ignore_cache=True)
 
     def _check_success(self):
@@ -194,7 +240,7 @@ def status_collector(scope, callback, get=True):
 
         # Call the other waiting callbacks
         other_callbacks = list(filter(lambda cb: cb is not None, scope.waiting_status))
-        debug("DBUG", "Serving device {} {} callbacks with the result of a {}".format(scope.id, len(other_callbacks), "get" if get else "set"))
+        debugf("DBUG", "Serving device {} {} callbacks with the result of a {}", scope.id, len(other_callbacks), "get" if get else "set")
         while len(other_callbacks) > 0:
             other_callback = other_callbacks.pop(0)
             if other_callback:
@@ -1,69 +1,156 @@
+from collections import deque
+import heapq
+import itertools
 from pymitter import EventEmitter
 from time import time
 
-from asyncorepp import set_timeout, cancel_timeout
+from .asyncorepp import set_timeout, cancel_timeout
+
+
+QUEUED = 'queued'
+SHIFTED = 'shifted'
+EXPIRED = 'expired'
+DONE = 'done'
 
 
 class ExpirableQueue(EventEmitter):
+	"""
+	A FIFO queue of items that can expire. Instead of a timer per item, the expiry times of all the items are kept in a
+	single deadline-ordered index (with one timer for the earliest one). Items stay in the index after being shifted
+	out of the queue, until they are marked as done(), so they can still expire while being processed.
+	Emits 'expire' (item, was_queued) when an item expires and 'drain' when that leaves the queue empty.
+	"""
 	def __init__(self, default_timeout=None):
 		EventEmitter.__init__(self)
-		self.queue = []
+		self.queue = deque()
 		self.default_timeout = default_timeout
+		self._length = 0
+		self._deadlines = []
+		self._counter = itertools.count()
+		self._timer = None
+		self._timer_when = None
 
 	def push(self, what, timeout=None):
-		item = ExpirableItem(what, timeout=timeout or self.default_timeout)
-		item.on('expire', lambda: self._item_expire(item))
-		item.on('cancel', lambda: self._item_cancel(item))
-		self.queue.push(item)
-
-	def _item_expire(self, item):
-		self.emit('item_expire', item)
-		self.remove(item)
-		if len(self.queue) == 0:
-			self.emit('drain')
+		return self.append(ExpirableItem(what, timeout=timeout or self.default_timeout))
 
-	def _item_cancel(self):
-		self.remove(item)
+	def append(self, item):
+		item.state = QUEUED
+		self.queue.append(item)
+		self._length += 1
+		self._index(item)
+		return item
 
-	def remove(self, item):
-		item.cancel()
-		try:
-			self.queue.remove(item)
-		except ValueError:
+	def unshift(self, item):
+		# Put a shifted item back in the front of the queue (unless it expired or is done meanwhile)
+		if item.state != SHIFTED:
 			return False
+		item.state = QUEUED
+		self.queue.appendleft(item)
+		self._length += 1
 		return True
 
-	def shift(self):
-		while len(self.queue) > 0:
-			item = self.queue.popleft()
-			if item.expires < time():
+	def peek(self):
+		now = None
+		while self.queue:
+			item = self.queue[0]
+			if item.state != QUEUED:
+				self.queue.popleft()
 				continue
+			if item.expires is not None:
+				now = now or time()
+				if item.expires <= now:
+					self.queue.popleft()
+					self._expire(item)
+					continue
 			return item
+		return None
 
+	def shift(self):
+		item = self.peek()
+		if item is None:
+			return None
+		self.queue.popleft()
+		self._length -= 1
+		item.state = SHIFTED
+		return item
 
-class ExpirableItem(EventEmitter):
-	def __init__(self, value, timeout=None):
-		self.expired = False
-		self.cancelled = False
-		self.timeout = None
-		self.expires = None
-		if timeout:
-			self.timeout = set_timeout(self._expire, timeout)
-			self.expires = time() + timeout
-
-	def _expire(self):
-		if self.expired or self.cancelled:
+	def remove(self, item):
+		# Items are removed lazily from the queue and the deadline index
+		if item.state == QUEUED:
+			self._length -= 1
+		elif item.state != SHIFTED:
 			return False
-		self.timeout = None
-		self.expired = True
-		self.emit('expire')
+		item.state = DONE
 		return True
 
-	def cancel(self):
-		if self.cancelled or self.expired:
-			return False
-		if self.timeout is not None:
-			cancel_timeout(self.timeout)
-		self.cancelled = True
-		self.emit('cancel')
-		return True
\ No newline at end of file
+	def done(self, item):
+		return self.remove(item)
+
+	def clear(self):
+		# Forget about every item (queued or shifted) and return the ones that were still queued
+		items = [item for item in self.queue if item.state == QUEUED]
+		for item in items:
+			item.state = DONE
+		for _, _, item in self._deadlines:
+			if item.state == SHIFTED:
+				item.state = DONE
+		self.queue.clear()
+		self._length = 0
+		del self._deadlines[:]
+		return items
+
+	def __len__(self):
+		return self._length
+
+	def __iter__(self):
+		return (item for item in self.queue if item.state == QUEUED)
+
+	def _index(self, item):
+		if item.expires is None:
+			return
+		heapq.heappush(self._deadlines, (item.expires, next(self._counter), item))
+		if self._timer_when is None or item.expires < self._timer_when:
+			self._schedule(item.expires)
+
+	def _schedule(self, when):
+		if self._timer is not None:
+			cancel_timeout(self._timer)
+		self._timer = set_timeout(self._check_expired, max(0, when - time()))
+		self._timer_when = when
+
+	def _check_expired(self):
+		self._timer = None
+		self._timer_when = None
+		now = time()
+		while self._deadlines and self._deadlines[0][0] <= now:
+			_, _, item = heapq.heappop(self._deadlines)
+			if item.state in (QUEUED, SHIFTED):
+				self._expire(item)
+
+		# Drop the entries of the items that are already gone and wait for the next one
+		while self._deadlines and self._deadlines[0][2].state not in (QUEUED, SHIFTED):
+			heapq.heappop(self._deadlines)
+		if self._deadlines:
+			self._schedule(self._deadlines[0][0])
+
+	def _expire(self, item):
+		was_queued = item.state == QUEUED
+		if was_queued:
+			self._length -= 1
+		item.state = EXPIRED
+		self.emit('expire', item, was_queued)
+		if was_queued and self._length == 0:
+			self.emit('drain')
+
+
+class ExpirableItem(object):
+	__slots__ = ('value', 'expires', 'state')
+
+	def __init__(self, value=None, timeout=None):
+		self.value = value
+		self.expires = time() + timeout if timeout else None
+		self.state = None
+
+	@property
+	def expired(self):
+		return self.state == EXPIRED
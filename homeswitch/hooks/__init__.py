@@ -1,4 +1,7 @@
+from collections import deque, OrderedDict
+import heapq
 from importlib import import_module
+import itertools
 import json
 #from multiprocessing.pool import ThreadPool
 import os.path
@@ -8,69 +11,250 @@ import uuid
 import threading
 import time
 
-from ..util import debug, dict_to_obj
+from ..asyncorepp import set_timeout, cancel_timeout
+from .. import metrics
+from ..util import debug, debugf, dict_to_obj
+from . import stream
+from .writer import GroupCommitWriter
+
+
+# HooksServer reads datagrams of up to this size
+MAX_DATAGRAM_SIZE = 8192
+SYNCHRONOUS_LEVELS = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+# Database schema migrations, run in order (PRAGMA user_version is the number of migrations applied)
+MIGRATIONS = (
+    '''
+        CREATE TABLE IF NOT EXISTS notifications (
+            id VARCHAR(64) NOT NULL PRIMARY KEY,
+            arrived DATETIME NOT NULL,
+            process_at DATETIME NOT NULL,
+            attempts INT NOT NULL,
+            data TEXT
+        );
+    ''',
+    # Epoch times (no conversions in queries) and an index to find the messages that are due
+    '''
+        ALTER TABLE notifications ADD COLUMN arrived_ts INTEGER NOT NULL DEFAULT 0;
+        ALTER TABLE notifications ADD COLUMN process_at_ts INTEGER NOT NULL DEFAULT 0;
+        UPDATE notifications SET
+            arrived_ts = CAST(strftime('%s', arrived) AS INTEGER),
+            process_at_ts = CAST(strftime('%s', process_at) AS INTEGER);
+        CREATE INDEX IF NOT EXISTS notifications_due ON notifications (process_at_ts, arrived_ts);
+    ''',
+    # Messages being delivered are leased until this time (if the server dies, they're delivered again after that)
+    '''
+        ALTER TABLE notifications ADD COLUMN lease_until INTEGER NOT NULL DEFAULT 0;
+    ''',
+)
+# The device fields sent in compact device references
+COMPACT_DEVICE_FIELDS = ('id', 'switch_status', 'device_status', 'discovery_status', 'last_seen')
+
+PENDING_NOTIFICATIONS = metrics.gauge('homeswitch_hooks_pending_notifications', 'Hook notifications waiting to be sent in a batch')
+HOOK_DATAGRAMS = metrics.counter('homeswitch_hooks_datagrams_total', 'Datagrams sent to the hooks server')
 
 
 class HooksClient(object):
+    """
+    Sends notifications to the hooks server. Notifications sent with notify_all() go together, in as few datagrams as
+    possible (of up to `max_batch_size` bytes). With a `batch_window` (in seconds), notifications are buffered for that
+    long and sent together too. Every notification is sent, except for the hooks in `coalesce_hooks` (the ones that only
+    care about the latest status, for which overwriting is safe): their buffered notifications of the same type about
+    the same device are replaced by the most recent one.
+    With `compact_devices` (the default when batching), only a reference to the device (its id, name and statuses) is
+    sent instead of all its metadata.
+    With a `stream` address (like 'unix:/run/hshookd.sock' or 'tcp:127.0.0.1:7778'), notifications are sent through a
+    stream connection instead of UDP and are acknowledged by the server (see stream.StreamTransport for its options).
+    """
     def __init__(self, config={}):
         self.host = config.get('host', '127.0.0.1')
         self.port = int(config.get('port', '7777'))
+        self.batch_window = config.get('batch_window', None)
+        self.max_batch_size = min(int(config.get('max_batch_size', MAX_DATAGRAM_SIZE - 192)), MAX_DATAGRAM_SIZE)
+        self.compact_devices = config.get('compact_devices', self.batch_window is not None)
+        self.coalesce_hooks = set(config.get('coalesce_hooks', ()))
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, 0)
+        self.transport = None
+        if config.get('stream', None):
+            self.transport = stream.StreamTransport(
+                config.get('stream'),
+                outbox_size=config.get('outbox_size', 10000),
+                max_unacked=config.get('max_unacked', 256),
+                spool_file=config.get('spool_file', None),
+            )
+        # Notification ids are unique to this client plus a counter (much cheaper than a uuid per notification)
+        self._id_prefix = uuid.uuid4().hex
+        self._ids = itertools.count(1)
+        self._pending = OrderedDict()
+        self._pending_size = 0
+        self._batch_timer = None
+        PENDING_NOTIFICATIONS.set_function(lambda: len(self._pending))
         debug("DBUG", "Hooks Client will send data to {}:{}".format(self.host, self.port))
 
     def notify(self, hook_name, notif_type, data):
-        debug("INFO", "Sending a {} / {} hook notification:".format(hook_name, notif_type), data)
-        buf = json.dumps({
-            'id': str(uuid.uuid4()),
+        return self.notify_all(hook_name, notif_type, [data])
+
+    def notify_all(self, hook_name, notif_type, data_list):
+        # Several notifications for the same hook, sent together (in as few datagrams as possible)
+        debug("INFO", "Sending {} {} / {} hook notifications:".format(len(data_list), hook_name, notif_type), data_list)
+        if self.compact_devices:
+            data_list = [dict(data, device=compact_device(data.get('device'))) if data.get('device') else data for data in data_list]
+        ids = ['{}-{}'.format(self._id_prefix, next(self._ids)) for _ in data_list]
+        bufs = [json.dumps({
+            'id': id,
             'hook': hook_name,
             'type': notif_type,
             'data': data
-        })
+        }) for id, data in zip(ids, data_list)]
+        if self.batch_window is None:
+            return self._send_batch(bufs)
+
+        coalesce = hook_name in self.coalesce_hooks
+        for id, buf, data in zip(ids, bufs, data_list):
+            # Replace a buffered notification about the same thing (if that's safe), or make room for this one
+            key = (hook_name, notif_type, (data.get('device') or {}).get('id')) if coalesce else id
+            replaced = self._pending.pop(key, None)
+            if replaced is not None:
+                self._pending_size -= len(replaced) + 1
+            elif self._pending and self._batch_size(len(buf)) > self.max_batch_size:
+                self.flush()
+            self._pending[key] = buf
+            self._pending_size += len(buf) + 1
+        if self._batch_timer is None:
+            self._batch_timer = set_timeout(self.flush, self.batch_window)
+
+    def _batch_size(self, extra=0):
+        # Size of the datagram with the pending notifications (plus one of `extra` bytes)
+        return len('{"batch":[]}') + self._pending_size + extra
+
+    def flush(self):
+        if self._batch_timer is not None:
+            cancel_timeout(self._batch_timer)
+            self._batch_timer = None
+        if not self._pending:
+            return
+        notifications = list(self._pending.values())
+        self._pending = OrderedDict()
+        self._pending_size = 0
+        debugf("DBUG", "Sending a batch of {} hook notifications", len(notifications))
+        self._send_batch(notifications)
+
+    def _send_batch(self, bufs):
+        # The notifications are already serialised, so batches are put together without serialising them again
+        batch, size = [], len('{"batch":[]}')
+        for buf in bufs:
+            if batch and size + len(buf) + 1 > self.max_batch_size:
+                self._send_batch_datagram(batch)
+                batch, size = [], len('{"batch":[]}')
+            batch.append(buf)
+            size += len(buf) + 1
+        if batch:
+            self._send_batch_datagram(batch)
+
+    def _send_batch_datagram(self, bufs):
+        if len(bufs) == 1:
+            return self._send(bufs[0])
+        return self._send('{"batch":[' + ','.join(bufs) + ']}')
+
+    def _send(self, buf):
+        if self.transport is not None:
+            return self.transport.send(buf)
+        if len(buf) > MAX_DATAGRAM_SIZE:
+            debug("WARN", "Hook notification has {} bytes, which is more than the hooks server reads".format(len(buf)))
+        HOOK_DATAGRAMS.inc()
         return self.socket.sendto(
             buf.encode('utf-8'),
             (self.host, self.port)
         )
 
 
+def compact_device(device):
+    ref = dict((field, device.get(field)) for field in COMPACT_DEVICE_FIELDS if field in device)
+    name = (device.get('metadata') or {}).get('name', None)
+    if name is not None:
+        ref['name'] = name
+    return ref
+
+
 class HooksServer(object):
-    def __init__(self, host="127.0.0.1", port=7777, database={}, retry_wait=30, max_attempts=5, devices={}, modules={}):
+    def __init__(self, host="127.0.0.1", port=7777, database={}, retry_wait=30, max_attempts=5, devices={}, modules={}, stream=None, claim_batch=100,
+                 workers=4, lease_time=300):
         self.host = host
         self.port = port
+        # Besides UDP, notifications can also come through stream connections on this address (see HooksClient)
+        self.stream_address = stream
+        self.stream_socket = None
         self.retry_wait = retry_wait
         self.max_attempts = max_attempts
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.database_conf = database
         self.receiver_db = None
         self.scheduler_db = None
+        # Writes are committed in groups, every `commit_interval` seconds or `commit_batch` writes
+        self.writer = GroupCommitWriter(
+            self._database_connect,
+            interval=database.get('commit_interval', 0.05),
+            max_batch=database.get('commit_batch', 500),
+        )
+        # Messages claimed (being delivered or with their update or removal not committed yet)
+        self.in_flight = set()
+        # The scheduler claims up to `claim_batch` due messages at once and sleeps until the next one is due: the times
+        # messages are due (when stored or retried) are kept in a heap and it's woken up when they're committed
+        self.claim_batch = claim_batch
+        self.due_times = []
+        self.queue_cond = threading.Condition()
+        # Claimed messages are leased for `lease_time` seconds and delivered by `workers` threads. Messages for the
+        # same device and hook (a lane) are delivered one at a time, in order, and each module can have a
+        # `concurrency` limit (lanes being delivered at once). When a message fails, its lane waits for it to be
+        # retried: the messages after it (and the ones claimed meanwhile) go back to the queue, due at the same time
+        # but behind it, so they don't overtake it nor take room from other lanes
+        self.workers = workers
+        self.lease_time = lease_time
+        self.lanes = OrderedDict()
+        self.busy_lanes = set()
+        self.lane_retries = {}
+        self.module_concurrency = {}
+        self.module_busy = {}
+        self.queued = 0
+        self.work_cond = threading.Condition()
+        self.worker_threads = []
+        self.background_run = None
+        self.scheduler_thread = None
         self.devices = devices
         self.modules = modules
         self.running = False
 
         # Load all modules
         for mod_name, mod_conf in modules.items():
+            self.module_concurrency[mod_name] = mod_conf.get('concurrency', None)
+            self.module_busy[mod_name] = 0
             modules[mod_name] = self._import_device_module(mod_name, mod_conf)
 
     def _database_connect(self, init=False):
         db_file = self.database_conf.get('file', None)
         if db_file is None:
             return
-        db_exists = os.path.isfile(db_file)
-        return sqlite3.connect(db_file)
-
-        # If the database table don't exist, initialise them
+        db = sqlite3.connect(db_file)
+
+        # With WAL, the scheduler can read while the writer commits and, with synchronous=NORMAL (the default), commits
+        # only sync to disk on checkpoints
+        synchronous = str(self.database_conf.get('synchronous', 'NORMAL')).upper()
+        if synchronous not in SYNCHRONOUS_LEVELS:
+            raise ValueError('Invalid database synchronous level {}'.format(synchronous))
+        if self.database_conf.get('wal', True):
+            db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous={}'.format(synchronous))
+
+        # Create the database tables or bring them up to date
         if init:
             self._database_init(db)
+        return db
 
     def _database_init(self, db):
-        return self._database_op(db, '''
-            CREATE TABLE IF NOT EXISTS notifications (
-                id VARCHAR(64) NOT NULL PRIMARY KEY,
-                arrived DATETIME NOT NULL,
-                process_at DATETIME NOT NULL,
-                attempts INT NOT NULL,
-                data TEXT
-            )
-        ''')
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+            debug("INFO", "Migrating the hooks database to version {}...".format(number))
+            # Each migration (and the version bump) is a single transaction
+            db.executescript('BEGIN; {} PRAGMA user_version = {}; COMMIT;'.format(migration, number))
 
     def _database_op(self, db, cmd, *values):
         cur = db.cursor()
@@ -84,60 +268,99 @@ class HooksServer(object):
         for row in cur.execute(cmd, *values):
             yield row
 
-    def _store_raw_message(self, db, msg):
-        msg_id = msg.get('id')
-        debug("INFO", "Storing message {}...".format(msg_id))
-        try:
-            return self._database_op(db, '''
-                INSERT INTO notifications (id, arrived, process_at, attempts, data)
-                VALUES (?, DATETIME("now"), DATETIME("now"), 0, ?)
-            ''', (
-                msg_id,
-                json.dumps(msg),
-            ))
-        except Exception as e:
-            debug("ERRO", "Error storing message {}: ".format(msg_id), e)
-            return
-
-    def _get_queue_message(self, db):
-#        debug("DBUG", "Getting a message from the queue...")
+    def _store_raw_messages(self, msgs, on_commit=None):
+        # Queued for the writer (which ignores messages that were already stored)
+        debug("INFO", "Storing {} messages...".format(len(msgs)))
+        now = int(time.time())
+        def _on_commit(err):
+            if err is None:
+                self._queued(now)
+            if on_commit is not None:
+                on_commit(err)
+        self.writer.execute('''
+            INSERT OR IGNORE INTO notifications (id, arrived, process_at, arrived_ts, process_at_ts, attempts, data)
+            VALUES (?, DATETIME(?, "unixepoch"), DATETIME(?, "unixepoch"), ?, ?, 0, ?)
+        ''', [(msg.get('id'), now, now, now, now, json.dumps(msg)) for msg in msgs], many=True, on_commit=_on_commit)
+
+    def _queued(self, due):
+        # A message will be due at `due` (wakes the scheduler up if that's earlier than what it's waiting for)
+        with self.queue_cond:
+            heapq.heappush(self.due_times, due)
+            if self.due_times[0] == due:
+                self.queue_cond.notify()
+
+    def _next_due_time(self, db):
+        return db.execute('SELECT MIN(MAX(process_at_ts, lease_until)) FROM notifications').fetchone()[0]
+
+    def _wait_for_due_messages(self):
+        # Sleeps until a message is due (or the server stops)
+        with self.queue_cond:
+            while self.running:
+                now = time.time()
+                if self.due_times and self.due_times[0] <= now:
+                    while self.due_times and self.due_times[0] <= now:
+                        heapq.heappop(self.due_times)
+                    return True
+                self.queue_cond.wait(self.due_times[0] - now if self.due_times else None)
+        return False
+
+    def _claim_queue_messages(self, db, now, limit):
+        # Due messages that aren't leased (or whose lease expired) are leased, in a single transaction. Messages in
+        # flight are skipped too (their lease might have expired while a slow hook delivers them)
+        in_flight = list(self.in_flight)
         try:
-            db_msg = next(self._database_q(db, '''
-                SELECT id, CAST(strftime('%s', arrived) AS INT), CAST(strftime('%s', process_at) AS INT), attempts, data
+            db.execute('BEGIN IMMEDIATE')
+            db_msgs = list(self._database_q(db, '''
+                SELECT id, arrived_ts, process_at_ts, attempts, data
                 FROM notifications
-                WHERE process_at <= DATETIME('now')
-                ORDER BY arrived ASC LIMIT 1
-            '''))
-        except StopIteration:
-            return None
+                WHERE process_at_ts <= ? AND lease_until <= ? AND id NOT IN ({})
+                ORDER BY process_at_ts, arrived_ts, rowid LIMIT ?
+            '''.format(','.join('?' * len(in_flight))), [now, now] + in_flight + [limit]))
+            db.executemany('UPDATE notifications SET lease_until = ? WHERE id = ?',
+                           [(int(now) + self.lease_time, db_msg[0]) for db_msg in db_msgs])
+            db.commit()
         except Exception as e:
-            debug("ERRO", "Error getting a message from the queue:", e)
+            debug("ERRO", "Error getting messages from the queue:", e)
+            db.rollback()
             raise
+        self.in_flight.update(db_msg[0] for db_msg in db_msgs)
+        debugf("DBUG", "Claimed {} messages from the queue", len(db_msgs))
 
-        (id, arrived, process_at, attempts, raw_msg) = db_msg
-        raw_msg = json.loads(raw_msg)
-        print("GOT MSG FROM Q:", raw_msg)
-
-        return (id, arrived, process_at, attempts, raw_msg)
+        return [(id, arrived, process_at, attempts, json.loads(raw_msg)) for (id, arrived, process_at, attempts, raw_msg) in db_msgs]
 
-    def _update_message(self, db, msg):
+    def _update_message(self, msg):
+        # Releases the lease too
         debug("INFO", "Updating message {}...".format(msg.id))
-        try:
-            return self._database_op(db, 'UPDATE notifications SET process_at=datetime(?, "unixepoch"), attempts=?, data=? WHERE id=?', (
-                msg.process_at,
-                msg.attempts,
-                json.dumps(msg.source_data),
-                msg.id,
-            ))
-        except Exception as e:
-            debug("ERRO", "Error storing message {}: ".format(msg_id), e)
-            return
-
-    def _unstore_message(self, db, msg):
-        debug("INFO", "Remove completed message {}...".format(msg.id))
-        return self._database_op(db, '''
+        def _on_commit(err):
+            self.in_flight.discard(msg.id)
+            self._queued(msg.process_at)
+        self.writer.execute('''
+            UPDATE notifications SET process_at=DATETIME(?, "unixepoch"), process_at_ts=?, attempts=?, data=?, lease_until=0
+            WHERE id=?
+        ''', (
+            msg.process_at,
+            msg.process_at,
+            msg.attempts,
+            json.dumps(msg.source_data),
+            msg.id,
+        ), on_commit=_on_commit)
+
+    def _defer_messages(self, msgs, process_at):
+        # Puts claimed messages back in the queue, to be processed at `process_at` (releases their leases too)
+        debug("INFO", "Deferring {} messages...".format(len(msgs)))
+        def _on_commit(err):
+            self.in_flight.difference_update(msg.id for msg in msgs)
+            self._queued(process_at)
+        self.writer.execute('''
+            UPDATE notifications SET process_at=DATETIME(?, "unixepoch"), process_at_ts=?, lease_until=0
+            WHERE id=?
+        ''', [(process_at, process_at, msg.id) for msg in msgs], many=True, on_commit=_on_commit)
+
+    def _unstore_message(self, msg_id):
+        debug("INFO", "Remove completed message {}...".format(msg_id))
+        self.writer.execute('''
             DELETE FROM notifications WHERE id = ?
-        ''', [msg.id])
+        ''', [msg_id], on_commit=lambda err: self.in_flight.discard(msg_id))
 
     def _import_device_module(self, mod_name, config={}):
         hook_module = import_module("homeswitch.hooks.{}".format(mod_name))
@@ -150,6 +373,9 @@ class HooksServer(object):
         # Start listening
         debug("INFO", "Hooks server listening on {}:{}".format(self.host, self.port))
         self.socket.bind((self.host, self.port))
+        if self.stream_address:
+            debug("INFO", "Hooks server listening for stream connections on {}".format(self.stream_address))
+            self.stream_socket = stream.listen(self.stream_address)
 
         # Run in a separate thread
         self.running = True
@@ -162,6 +388,10 @@ class HooksServer(object):
 
     def stop(self):
         self.running = False
+        with self.queue_cond:
+            self.queue_cond.notify_all()
+        with self.work_cond:
+            self.work_cond.notify_all()
 
         # If it's running in background, wait for it to stop
         if self.background_run:
@@ -169,83 +399,229 @@ class HooksServer(object):
         if self.scheduler_thread:
             self.scheduler_thread.join()
 
+        # Commit whatever is still queued
+        if self.writer.is_alive():
+            self.writer.stop()
+
     def run(self, *args):
+        # Create the database tables (or migrate them) before the other threads use them
+        self._database_connect(init=True).close()
+        self.writer.start()
+
+        # Start the workers that deliver the notifications
+        for number in range(self.workers):
+            worker = threading.Thread(target=self._run_worker, name='hooks-worker-{}'.format(number))
+            worker.daemon = True
+            worker.start()
+            self.worker_threads.append(worker)
+
         # Create the scheduler thread and run it
         self.scheduler_thread = threading.Thread(target=self._run_scheduler, args=())
         self.scheduler_thread.daemon = True
         self.scheduler_thread.start()
 
+        # Accept stream connections (each one gets its own thread)
+        if self.stream_socket is not None:
+            self.stream_thread = threading.Thread(target=self._run_stream_listener, args=())
+            self.stream_thread.daemon = True
+            self.stream_thread.start()
+
         # Run receiver
         self._run_receiver()
 
     def _run_receiver(self):
-        # Connect to database
-        db = self._database_connect(init=True)
-
         # Start running
         while self.running:
-            (raw_msg, addr) = self._read_message()
-            debug("INFO", "Got message: ", raw_msg)
+            (raw_msgs, addr) = self._read_messages()
+            debug("INFO", "Got messages: ", raw_msgs)
 
-            # Store the message in the queue
-            self._store_raw_message(db, raw_msg)
+            # Store the messages in the queue (without waiting for them to be written)
+            self._store_raw_messages(raw_msgs)
 
-    def _run_scheduler(self):
-        # Wait a couple of seconds for the receiver to start (...)
-        # Not beautiful but just to avoid multiple threads connecting and initialising the DB at the same time
-        time.sleep(2)
+    def _run_stream_listener(self):
+        while self.running:
+            (conn, addr) = self.stream_socket.accept()
+            debug("INFO", "New hooks stream connection from {}".format(addr or 'local socket'))
+            conn_thread = threading.Thread(target=self._run_stream_receiver, args=(conn, ))
+            conn_thread.daemon = True
+            conn_thread.start()
+
+    def _run_stream_receiver(self, conn):
+        # Everything that arrives together is stored together and acknowledged with a single frame, once committed
+        frames = stream.FrameBuffer()
+        try:
+            while self.running:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                raw_msgs = []
+                last_seq = None
+                for frame in frames.feed(data):
+                    frame = json.loads(frame)
+                    last_seq = frame.get('seq')
+                    raw_msgs.extend(self._unpack_messages(frame.get('data') or {}))
+                if last_seq is None:
+                    continue
+                ack = lambda err, seq=last_seq: self._ack_stream(conn, seq, err)
+                if raw_msgs:
+                    self._store_raw_messages(raw_msgs, on_commit=ack)
+                else:
+                    self.writer.execute('SELECT 1', on_commit=ack)
+        except (socket.error, ValueError) as e:
+            debug("WARN", "Error on hooks stream connection:", e)
+        finally:
+            # Acknowledgements of what's still being written won't be sent, so the client sends it again
+            conn.close()
+
+    def _ack_stream(self, conn, seq, err):
+        # If the messages couldn't be stored, the connection is dropped and the client sends them again
+        try:
+            if err is not None:
+                return conn.shutdown(socket.SHUT_RDWR)
+            conn.sendall(stream.encode_frame(json.dumps({'ack': seq})))
+        except socket.error as e:
+            debug("WARN", "Error acknowledging hooks stream messages:", e)
 
+    def _run_scheduler(self):
         # Connect to the database
         db = self._database_connect(init=False)
 
-        # Start running (get messages from the DB, process and remove them; if they fail update them to run later or expire them)
-        while self.running:
-            # Retrieve a message from there (should be the same one) and parse it
-            db_msg = self._get_queue_message(db)
-            if db_msg is None:
-                time.sleep(1)
+        # Messages left in the queue (from a previous run)
+        next_due = self._next_due_time(db)
+        if next_due is not None:
+            self._queued(next_due)
+
+        # Start running (claim due messages from the DB and hand them to the workers, which process and remove them;
+        # if they fail, they're updated to run later or expired)
+        while self._wait_for_due_messages():
+            # At most `claim_batch` messages wait for the workers
+            with self.work_cond:
+                while self.running and self.queued >= self.claim_batch:
+                    self.work_cond.wait()
+                limit = self.claim_batch - self.queued
+            if not self.running:
+                break
+            now = time.time()
+            db_msgs = self._claim_queue_messages(db, now, limit)
+            # A full batch might have left other due messages behind
+            if len(db_msgs) == limit:
+                self._queued(now)
+
+            for (id, arrived, process_at, attempts, raw_msg) in db_msgs:
+                msg = self._parse_raw_message(raw_msg, id=id, arrived=arrived, process_at=process_at, attempts=attempts)
+                if msg is None:
+                    debug("WARN", "Error parsing raw message. Skipping it!", raw_msg)
+                    self._unstore_message(id)
+                    continue
+                self._dispatch(msg)
+
+    def _dispatch(self, msg):
+        # Messages go to their lane (device and hook), to be delivered after the ones before them
+        device = msg.data.device if msg.data is not None else None
+        lane = (device.id if device is not None else None, msg.hook)
+        with self.work_cond:
+            retry_at = self.lane_retries.get(lane, None)
+            if retry_at is not None and retry_at <= time.time():
+                del self.lane_retries[lane]
+                retry_at = None
+            if retry_at is None:
+                self.lanes.setdefault(lane, deque()).append(msg)
+                self.queued += 1
+                self.work_cond.notify()
+        # The lane is waiting for a message to be retried
+        if retry_at is not None:
+            self._defer_messages([msg], retry_at)
+
+    def _next_lane(self):
+        # The oldest lane that isn't being delivered and whose module has room for it
+        for lane in self.lanes:
+            if lane in self.busy_lanes:
                 continue
+            limit = self.module_concurrency.get(lane[1], None)
+            if limit is None or self.module_busy.get(lane[1], 0) < limit:
+                return lane
+        return None
 
-            (id, arrived, process_at, attempts, raw_msg) = db_msg
-            msg = self._parse_raw_message(raw_msg, id=id, arrived=arrived, process_at=process_at, attempts=attempts)
-            if msg is None:
-                debug("WARN", "Error parsing raw message. Skipping it!", raw_msg)
-                return None
-            msg_dict = msg.__dict__
-
-            # Process it
+    def _run_worker(self):
+        while True:
+            with self.work_cond:
+                lane = self._next_lane()
+                while self.running and lane is None:
+                    self.work_cond.wait()
+                    lane = self._next_lane()
+                if not self.running:
+                    return
+                msg = self.lanes[lane].popleft()
+                self.busy_lanes.add(lane)
+                self.module_busy[lane[1]] = self.module_busy.get(lane[1], 0) + 1
+
+            retry = False
             try:
-                self._process_message(msg)
+                retry = self._run_message(msg)
             except Exception as e:
-                debug("ERRO", "Error '{}' processing notification for message:".format(e), msg_dict)
-                msg.attempts += 1
-                if msg.attempts >= self.max_attempts:
-                    debug("ERRO", "Message {} exceeded maximum number of attempts {}:".format(msg.id, self.max_attempts), msg_dict)
-                else:
-                    msg.process_at += self.retry_wait
-                    self._update_message(db, msg)
-                    continue
-
-            # Delete it from storage
-            self._unstore_message(db, msg)
-
+                debug("ERRO", "Error running message {}:".format(msg.id), e)
+
+            with self.work_cond:
+                self.busy_lanes.discard(lane)
+                self.module_busy[lane[1]] -= 1
+                # Lanes go to the back when they're done, so busy destinations don't starve the others
+                pending = self.lanes.pop(lane)
+                self.queued -= 1
+                if retry:
+                    self.lane_retries[lane] = msg.process_at
+                    self.queued -= len(pending)
+                elif pending:
+                    self.lanes[lane] = pending
+                self.work_cond.notify_all()
+            if retry and pending:
+                self._defer_messages(pending, msg.process_at)
+
+    def _run_message(self, msg):
+        # Returns True if the message has to be retried
+        msg_dict = msg.__dict__
 
-    def _read_message(self):
+        # Process it
+        try:
+            self._process_message(msg)
+        except Exception as e:
+            debug("ERRO", "Error '{}' processing notification for message:".format(e), msg_dict)
+            msg.attempts += 1
+            if msg.attempts >= self.max_attempts:
+                debug("ERRO", "Message {} exceeded maximum number of attempts {}:".format(msg.id, self.max_attempts), msg_dict)
+            else:
+                msg.process_at += self.retry_wait
+                self._update_message(msg)
+                return True
+
+        # Delete it from storage
+        self._unstore_message(msg.id)
+        return False
+
+
+    def _read_messages(self):
+        # Reads a datagram with a message or a batch of them
         while True:
-            (msg, addr) = self.socket.recvfrom(8192)
-            msg = json.loads(msg)
-            if 'id' not in msg:
-                debug("WARN", "Found a message without id, skipping...: ", msg)
+            (msg, addr) = self.socket.recvfrom(MAX_DATAGRAM_SIZE)
+            msgs = self._unpack_messages(json.loads(msg))
+            if len(msgs) == 0:
                 continue
-            return (msg, addr)
+            return (msgs, addr)
+
+    def _unpack_messages(self, msg):
+        # A message or a batch of them
+        msgs = msg.get('batch') if type(msg.get('batch', None)) is list else [msg]
+        valid = [m for m in msgs if 'id' in m]
+        if len(valid) < len(msgs):
+            debug("WARN", "Found messages without id, skipping...: ", [m for m in msgs if 'id' not in m])
+        return valid
 
     def _parse_raw_message(self, raw_msg, id='-', arrived=0, process_at=0, attempts=0):
         msg = HookMessage(raw_msg, id=id, arrived=arrived, process_at=process_at, attempts=attempts)
         if msg.hook is None:
-            debug("WARN", "Got a message without a hook name. Skipping:", message)
+            debug("WARN", "Got a message without a hook name. Skipping:", raw_msg)
             return None
         if msg.hook not in self.modules:
-            debug("WARN", "Hook '{}' is not supported. Skipping:".format(msg.hook), message)
+            debug("WARN", "Hook '{}' is not supported. Skipping:".format(msg.hook), raw_msg)
             return None
         return msg
 
@@ -304,7 +680,10 @@ class HookMessageDevice(object):
         self.discovery_status = device.get('discovery_status', None)
         self.device_status = device.get('device_status', None)
         self.metadata = device.get('metadata', {})
-        self.name = self.metadata.get('name', None)
+        # Compact device references (see HooksClient) have the name, but no metadata
+        self.name = device.get('name', self.metadata.get('name', None))
+        if not self.metadata and self.name is not None:
+            self.metadata = {'name': self.name}
 
 
 class HookMessageContext(object):
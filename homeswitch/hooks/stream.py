@@ -0,0 +1,248 @@
+import asyncore
+from collections import deque, OrderedDict
+from errno import EAGAIN, EWOULDBLOCK
+import json
+import os
+import random
+import socket
+import struct
+
+from ..asyncorepp import set_timeout
+from .. import metrics
+from ..util import debug, debugf
+
+
+# Frames are a 4 byte (big endian) length followed by a JSON payload
+FRAME_LENGTH = struct.Struct('>I')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+OUTBOX_SIZE = metrics.gauge('homeswitch_hooks_outbox_size', 'Hook notifications waiting to be sent through the stream (in memory)')
+SPOOL_SIZE = metrics.gauge('homeswitch_hooks_spool_size', 'Hook notifications spooled to disk while the hooks server is unreachable')
+UNACKED = metrics.gauge('homeswitch_hooks_unacked', 'Hook notifications sent through the stream and waiting for an acknowledgement')
+
+
+def parse_address(address):
+    # 'unix:/path/to/socket', 'tcp:host:port' or 'host:port'
+    if address.startswith('unix:'):
+        return socket.AF_UNIX, address[len('unix:'):]
+    if address.startswith('tcp:'):
+        address = address[len('tcp:'):]
+    host, port = address.rsplit(':', 1)
+    return socket.AF_INET, (host, int(port))
+
+
+def encode_frame(payload):
+    return FRAME_LENGTH.pack(len(payload)) + payload
+
+
+class FrameBuffer(object):
+    """ Collects received bytes and splits them into frames """
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        self.buffer.extend(data)
+        frames = []
+        while len(self.buffer) >= FRAME_LENGTH.size:
+            size = FRAME_LENGTH.unpack_from(bytes(self.buffer[:FRAME_LENGTH.size]))[0]
+            if size > MAX_FRAME_SIZE:
+                raise ValueError('Frame of {} bytes is too big'.format(size))
+            if len(self.buffer) < FRAME_LENGTH.size + size:
+                break
+            frames.append(bytes(self.buffer[FRAME_LENGTH.size:FRAME_LENGTH.size + size]))
+            del self.buffer[:FRAME_LENGTH.size + size]
+        return frames
+
+
+class Spool(object):
+    """
+    Notifications written to disk (one per line) while the outbox is full. They're read back in the same order and the
+    file is truncated once everything in it was read.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a+')
+        self.offset = 0
+        self.pending = 0
+        # Whatever is left from before (if hsapid stopped with notifications spooled) is sent too
+        self.file.seek(0)
+        while self.file.readline():
+            self.pending += 1
+
+    def __len__(self):
+        return self.pending
+
+    def append(self, buf):
+        self.file.seek(0, os.SEEK_END)
+        self.file.write(buf + '\n')
+        self.file.flush()
+        self.pending += 1
+
+    def read(self, count):
+        self.file.seek(self.offset)
+        lines = []
+        while len(lines) < count:
+            line = self.file.readline()
+            if not line:
+                break
+            lines.append(line.rstrip('\n'))
+        self.offset = self.file.tell()
+        self.pending -= len(lines)
+        if self.pending <= 0:
+            self.file.truncate(0)
+            self.offset = self.pending = 0
+        return lines
+
+
+class StreamTransport(object):
+    """
+    Sends notifications to the hooks server through a stream socket (Unix or TCP), from the event loop.
+    Every notification goes in a frame with a sequence number and stays in memory until the server acknowledges it
+    (acknowledgements are cumulative), so whatever wasn't acknowledged when the connection breaks is sent again after
+    reconnecting (the server ignores notifications it already has). At most `max_unacked` notifications are sent
+    without being acknowledged and at most `outbox_size` wait in memory; after that they're written to `spool_file`
+    (if there's one, otherwise the oldest ones are dropped) until the outbox has room again.
+    """
+    def __init__(self, address, outbox_size=10000, max_unacked=256, spool_file=None, reconnect_min=0.5, reconnect_max=30):
+        self.address = address
+        self.family, self.sockaddr = parse_address(address)
+        self.outbox_size = outbox_size
+        self.max_unacked = max_unacked
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
+        self.outbox = deque()
+        self.unacked = OrderedDict()
+        self.spool = Spool(spool_file) if spool_file else None
+        self.sequence = 0
+        self.connection = None
+        self.connected = False
+        self.failures = 0
+        self._reconnect_timer = None
+        OUTBOX_SIZE.set_function(lambda: len(self.outbox))
+        SPOOL_SIZE.set_function(lambda: len(self.spool) if self.spool else 0)
+        UNACKED.set_function(lambda: len(self.unacked))
+        self._connect()
+
+    def send(self, buf):
+        # Once something is spooled, everything after it is spooled too (so the order is kept)
+        if len(self.outbox) >= self.outbox_size or (self.spool and len(self.spool) > 0):
+            if self.spool is not None:
+                self.spool.append(buf)
+            else:
+                debug("WARN", "Hooks outbox is full. Dropping the oldest notification")
+                self.outbox.popleft()
+                self.outbox.append(buf)
+        else:
+            self.outbox.append(buf)
+        self._pump()
+
+    def _pump(self):
+        if not self.connected:
+            return
+        while len(self.unacked) < self.max_unacked:
+            if len(self.outbox) == 0 and self.spool and len(self.spool) > 0:
+                self.outbox.extend(self.spool.read(self.outbox_size))
+            if len(self.outbox) == 0:
+                return
+            buf = self.outbox.popleft()
+            self.sequence += 1
+            self.unacked[self.sequence] = buf
+            self.connection.write('{{"seq":{},"data":{}}}'.format(self.sequence, buf))
+
+    def _on_connect(self):
+        debugf("INFO", "Connected to the hooks server at {}", self.address)
+        self.connected = True
+        self.failures = 0
+        self._pump()
+
+    def _on_frame(self, frame):
+        ack = json.loads(frame).get('ack', None)
+        if ack is None:
+            return
+        while self.unacked and next(iter(self.unacked)) <= ack:
+            self.unacked.popitem(last=False)
+        self._pump()
+
+    def _on_close(self):
+        if self.connected:
+            debugf("WARN", "Lost the connection to the hooks server at {}", self.address)
+        self.connected = False
+        self.connection = None
+        # Whatever wasn't acknowledged goes back to the front of the outbox, to be sent again
+        self.outbox.extendleft(reversed(list(self.unacked.values())))
+        self.unacked.clear()
+        delay = min(self.reconnect_min * 2 ** self.failures, self.reconnect_max) * random.uniform(0.5, 1)
+        self.failures += 1
+        if self._reconnect_timer is None:
+            self._reconnect_timer = set_timeout(self._connect, delay)
+
+    def _connect(self):
+        self._reconnect_timer = None
+        self.connection = StreamConnection(self)
+        try:
+            self.connection.connect(self.sockaddr)
+        except socket.error as e:
+            debugf("WARN", "Error connecting to the hooks server at {}:", self.address, e)
+            self.connection.close()
+
+
+class StreamConnection(asyncore.dispatcher):
+    def __init__(self, transport):
+        asyncore.dispatcher.__init__(self)
+        self.transport = transport
+        self.frames = FrameBuffer()
+        self.out_buffer = bytearray()
+        self.closed = False
+        self.create_socket(transport.family, socket.SOCK_STREAM)
+
+    def write(self, payload):
+        self.out_buffer.extend(encode_frame(payload))
+
+    def handle_connect(self):
+        self.transport._on_connect()
+
+    def handle_read(self):
+        try:
+            data = self.recv(65536)
+        except socket.error as e:
+            if e.errno in (EAGAIN, EWOULDBLOCK):
+                return
+            raise
+        if not data:
+            return
+        for frame in self.frames.feed(data):
+            self.transport._on_frame(frame)
+
+    def writable(self):
+        return not self.connected or len(self.out_buffer) > 0
+
+    def handle_write(self):
+        sent = self.send(bytes(self.out_buffer))
+        del self.out_buffer[:sent]
+
+    def handle_close(self):
+        self.close()
+
+    def handle_error(self):
+        debug("WARN", "Error on the connection to the hooks server:", asyncore.compact_traceback()[2])
+        self.close()
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        if not self.closed:
+            self.closed = True
+            self.transport._on_close()
+
+
+def listen(address):
+    # A listening socket for the hooks server
+    family, sockaddr = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_UNIX:
+        if os.path.exists(sockaddr):
+            os.unlink(sockaddr)
+    else:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(sockaddr)
+    sock.listen(16)
+    return sock
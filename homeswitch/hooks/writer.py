@@ -0,0 +1,109 @@
+from collections import deque
+import threading
+import time
+
+from ..util import debug, debugf
+
+
+class GroupCommitWriter(threading.Thread):
+    """
+    Runs database writes from a single thread and commits them in groups: the first write waits up to `interval`
+    seconds for others (or until there are `max_batch` of them) and they're all committed in one transaction, so
+    storing a burst of messages costs one sync to disk instead of one per message.
+    Writes are queued with execute() (which doesn't wait for them) and on_commit(err) is called, from the writer
+    thread, once they're committed (or failed).
+    """
+    def __init__(self, connect, interval=0.05, max_batch=500):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.connect = connect
+        self.interval = interval
+        self.max_batch = max_batch
+        self.running = True
+        self.committed = 0
+        self._ops = deque()
+        self._submitted = 0
+        self._cond = threading.Condition()
+
+    def execute(self, sql, params=(), many=False, on_commit=None):
+        with self._cond:
+            self._ops.append((sql, params, many, on_commit))
+            self._submitted += 1
+            self._cond.notify_all()
+
+    def __len__(self):
+        return len(self._ops)
+
+    def flush(self, timeout=None):
+        # Waits for everything queued so far to be committed
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._cond:
+            target = self._submitted
+            while self.committed < target:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self):
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
+        self.join()
+
+    def run(self):
+        db = self.connect()
+        while True:
+            ops = self._next_group()
+            if not ops:
+                return
+            self._commit(db, ops)
+
+    def _next_group(self):
+        with self._cond:
+            while not self._ops and self.running:
+                self._cond.wait()
+            if not self._ops:
+                return None
+            # Give other writes some time to join this group
+            deadline = time.time() + self.interval
+            while self.running and len(self._ops) < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            count = min(len(self._ops), self.max_batch)
+            return [self._ops.popleft() for _ in range(count)]
+
+    def _commit(self, db, ops):
+        errors = []
+        cur = db.cursor()
+        for sql, params, many, _ in ops:
+            # A failing statement is undone on its own, the rest of the transaction goes on
+            try:
+                if many:
+                    cur.executemany(sql, params)
+                else:
+                    cur.execute(sql, params)
+                errors.append(None)
+            except Exception as e:
+                debug("ERRO", "Error running `{}`:".format(sql.strip()), e)
+                errors.append(e)
+        try:
+            db.commit()
+        except Exception as e:
+            debug("ERRO", "Error committing {} writes:".format(len(ops)), e)
+            db.rollback()
+            errors = [e] * len(ops)
+        debugf("DBUG", "Committed {} writes", len(ops))
+
+        for (_, _, _, on_commit), err in zip(ops, errors):
+            if on_commit is not None:
+                try:
+                    on_commit(err)
+                except Exception as e:
+                    debug("ERRO", "Error in a commit callback:", e)
+        with self._cond:
+            self.committed += len(ops)
+            self._cond.notify_all()
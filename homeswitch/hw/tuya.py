@@ -4,6 +4,7 @@ import json
 import os
 from pymitter import EventEmitter
 import socket
+import struct
 import sys
 import time
 import traceback
@@ -12,17 +13,28 @@ import uuid
 from ..aes import AESCipher
 from ..asyncorepp import set_timeout
 from ..asyncsocket.client import AsyncSocketClient
-from ..util import hex2bin, bin2hex, int2hex, readUInt32BE, UInt32BE, debug, dict_diff, DO_NOTHING, bin2hex_sep
+from ..asyncsocket import pool as connection_pool
+from ..util import hex2bin, bin2hex, int2hex, readUInt32BE, debug, debugf, dict_diff, DO_NOTHING, bin2hex_sep
 from ..syncproto import SyncProto
 
 
 Crypto = None
 CMD_CONTROL = 7
+CMD_STATUS = 8
+CMD_HEART_BEAT = 9
+CMD_DP_QUERY = 10
+# 3.3 devices don't take the version header on these
+NO_VERSION_HEADER_COMMANDS = (CMD_HEART_BEAT, CMD_DP_QUERY)
 PROTOCOL_VERSION_BYTES_31 = b'3.1'
 PROTOCOL_VERSION_BYTES_33 = b'3.3'
 HEADER_SIZE = 16
 PREFIX = "000055aa00000000"
 SUFFIX = "000000000000aa55"
+PREFIX_VALUE = 0x000055aa
+SUFFIX_VALUE = 0x0000aa55
+SUFFIX_BYTES = struct.pack('>I', SUFFIX_VALUE)
+FRAME_HEADER = struct.Struct('>IIII')
+FRAME_TRAILER = struct.Struct('>II')
 
 
 class TuyaDevice(EventEmitter):
@@ -44,9 +56,20 @@ class TuyaDevice(EventEmitter):
         self.dps = str(config.get('dps', 1))
         self.persistent_connections = config.get('persistent_connections', False)
         self.get_status_on_start = config.get('get_status_on_start', True)
+        self.pipeline_window = int(config.get('pipeline_window', 1))
+        self.coalesce_commands = config.get('coalesce_commands', True)
+        # The status a set was acknowledged with (and until when), as devices push it right after the acknowledgement
+        self._set_echo = None
+        # The value of each set command waiting for its reply (coalesced sets replace it) and the last set result, which
+        # is the result of every caller of that command
+        self._set_values = {}
+        self._set_result = None
+        self.codec = TuyaCodec(self.key, self.version, aes_backend=config.get('aes_backend', None))
+        # Unless persistent_connections is on, connections are managed by the connection pool (if there's one)
+        self.pool = connection_pool.POOL if config.get('connection_pool', True) and not self.persistent_connections else None
 
         # Creates the connection object and sets event handlers
-        self.connection = AsyncSocketClient(ttl=config.get('socket_ttl', 300))
+        self.connection = AsyncSocketClient(ttl=None if self.pool else config.get('socket_ttl', 300))
         self.connection.on('connect', self._on_dev_connect)
         self.connection.on('failure', self._on_dev_connection_failure)
         self.connection.on('timeout', self._on_dev_connection_failure)
@@ -61,10 +84,16 @@ class TuyaDevice(EventEmitter):
             self.connection,
             self._encode_and_send_message,
             self._read_and_parse_message,
+            window=self.pipeline_window,
+            name=self.id,
+            push_commands=(CMD_STATUS,),
         )
+        self.sync_proto.on('push', self._on_dev_push)
         self.sync_proto.on('drain', self._on_dev_send_drain)
         self.sync_proto.on('send_error', self._on_dev_send_error)
         self.sync_proto.on('receive_error', self._on_dev_recv_error)
+        if self.pool:
+            self.sync_proto.on('reply', lambda: self.pool.progress(self))
 
         # When IP address changes
         self.on('_ip', self._on_ip_change)
@@ -100,11 +129,14 @@ class TuyaDevice(EventEmitter):
     def update(self, hw_metadata={}):
         ip = hw_metadata.get('ip', None)
         ip_before = self.ip
+        gw_id_before = self.gw_id
 
         if 'ip' in hw_metadata:
             self.ip = hw_metadata.get('ip', self.config.get('ip', None))
         if 'version' in hw_metadata:
             self.version = float(hw_metadata.get('version', '3.3'))
+            if self.version != self.codec.version:
+                self.codec = TuyaCodec(self.key, self.version, aes_backend=self.config.get('aes_backend', None))
         if 'active' in hw_metadata:
             self.active = hw_metadata.get('active', None)
         if 'ablilty' in hw_metadata:
@@ -119,55 +151,67 @@ class TuyaDevice(EventEmitter):
         # Did the IP change? Disconnect and connect to the new one!
         if ip_before != self.ip:
             if ip_before:
-                debug("DBUG", "Tuya device {} IP address has changed from {} to {}".format(self.id, ip_before, self.ip))
+                debugf("DBUG", "Tuya device {} IP address has changed from {} to {}", self.id, ip_before, self.ip)
             else:
-                debug("DBUG", "Tuya device {} IP was set to {}".format(self.id, self.ip))
+                debugf("DBUG", "Tuya device {} IP was set to {}", self.id, self.ip)
 
             if self.gw_id and self.ip:
                 self.emit('_ip')
+        # Devices with a configured IP address only become reachable once we know their ID
+        elif not gw_id_before and self.gw_id and self.ip:
+            self.emit('_ip')
 
-    def send_command(self, command, payload, callback):
-        was_dry = self.sync_proto.is_dry()
-        self.sync_proto.append(
-            message={'command': command, 'payload': payload},
+    def send_command(self, command, payload, callback, key=None, replace=False, empty_reply=False, touch=True):
+        # Returns the id of the command it goes in (which might be a queued one it was coalesced with)
+        cmd_id = self.sync_proto.append(
+            message={'command': command, 'payload': payload, 'empty_reply': empty_reply},
             callback=callback,
-            timeout=self.command_timeout
+            timeout=self.command_timeout,
+            key=key if self.coalesce_commands else None,
+            replace=replace,
         )
+        if self.pool and touch:
+            self.pool.touch(self)
 
         # If not connected and not connecting, connect! Connect will take care of processing the queue
-        debug("DBUG", "Device {} Connecting={}, Connected={}".format(self.id, self.connecting, self.connected))
+        debugf("DBUG", "Device {} Connecting={}, Connected={}", self.id, self.connecting, self.connected)
         if not self.connected and not self.connecting:
-            return self._connect()
+            self._connect()
 
-        # If connected but the queue was empty, start processing it
-        if self.connected and was_dry:
-            return self.sync_proto.go()
+        # If connected, send it right away if there's room in the pipeline (otherwise it will be sent after a reply)
+        elif self.connected:
+            self.sync_proto.go()
+        return cmd_id
 
     def _connect(self):
-        debug("DBUG", "IP: {}, PORT: {}, GW_ID: {}".format(self.ip, self.port, self.gw_id))
+        debugf("DBUG", "IP: {}, PORT: {}, GW_ID: {}", self.ip, self.port, self.gw_id)
         if self.ip and self.port and self.gw_id and self.key:
-            debug("INFO", "Connecting to Tuya device {} at {}:{}...".format(self.id, self.ip, self.port))
+            debugf("INFO", "Connecting to Tuya device {} at {}:{}...", self.id, self.ip, self.port)
             self.connecting = True
             self.connection.connect(self.ip, self.port, timeout=self.socket_timeout)
-            debug("DBUG", "Connection to Tuya device {} at {}:{} for file descriptor {}".format(self.id, self.ip, self.port, self.connection.fd))
+            debugf("DBUG", "Connection to Tuya device {} at {}:{} for file descriptor {}", self.id, self.ip, self.port, self.connection.fd)
         else:
             debug("WARN", "Cannot connect because of not having an ip, port, device id or key")
 
     def _disconnect(self):
         if self.connected or self.connecting:
-            debug("INFO", "Disconnecting from Tuya device {}...".format(self.id))
+            debugf("INFO", "Disconnecting from Tuya device {}...", self.id)
             self.connected = False
             self.connection.disconnect()
+            if self.pool:
+                self.pool.closed(self)
 
     def _reconnect(self):
-        debug("INFO", "Reconnecting to {}...".format(self.id))
+        debugf("INFO", "Reconnecting to {}...", self.id)
         self._disconnect()
         self._connect()
 
     def _on_dev_connect(self):
-        debug("INFO", "Connected to Tuya device {} !".format(self.id))
+        debugf("INFO", "Connected to Tuya device {} !", self.id)
         self.connected = True
         self.connecting = False
+        if self.pool:
+            self.pool.opened(self)
         self.emit('_next')
 
     def _on_dev_connection_failure(self, ex):
@@ -185,14 +229,20 @@ class TuyaDevice(EventEmitter):
             {'error': error_code, 'description': 'Failure connecting to device {}'.format(self.id)},
             None
         )
+        if self.pool:
+            self.pool.closed(self, broken=True)
 
     def _on_dev_connection_break(self):
-        debug("INFO", "Device {} has disconnected.".format(self.id))
+        debugf("INFO", "Device {} has disconnected.", self.id)
+        if self.pool:
+            # The pool reconnects (with a backoff) if the device is still in use
+            self.connected = False
+            return self.pool.closed(self, broken=True)
         if self.connected:
             set_timeout(self._reconnect, 1)
 
     def _on_dev_disconnect(self):
-        debug("INFO", "Successfully disconnected from device {}".format(self.id))
+        debugf("INFO", "Successfully disconnected from device {}", self.id)
 
     def _on_dev_exception(self, ex):
         debug("ERRO", "Socket exception on device's {} connection: {}".format(self.id, ex))
@@ -202,60 +252,111 @@ class TuyaDevice(EventEmitter):
         self._disconnect()
 
     def _on_dev_send_drain(self):
-        debug("INFO", "Tuya device {} send queue has drained".format(self.id))
+        debugf("INFO", "Tuya device {} send queue has drained", self.id)
+        if self.pool:
+            return self.pool.idle(self)
         if not self.persistent_connections:
             debug("INFO", "Disconnecting as command queue is empty")
             self._disconnect()
 
     def _on_dev_send_error(self, err):
-        debug("DBUG", "Tuya device {} send error".format(self.id), err)
-        if err.errno in (41): # might mean the device went away, we need to reconnect and retry
+        debugf("DBUG", "Tuya device {} send error", self.id, err)
+        if err.errno in (41, ): # might mean the device went away, we need to reconnect and retry
             return self._reconnect()
 
     def _on_dev_recv_error(self, err):
-        debug("INFO", "Tuya device {} receive error".format(self.id), err)
+        debugf("INFO", "Tuya device {} receive error", self.id, err)
         debug("WARN", "Marking connection as unhealthy. Reconnecting and resending message!")
         self._reconnect()
 
+    def _on_dev_push(self, message):
+        # Status messages sent by the device on its own (like when someone presses its button)
+        dps = message.get('dps') if isinstance(message, dict) else None
+        if not dps or self.dps not in dps:
+            debugf("DBUG", "Ignoring message pushed by Tuya device {}:", self.id, message)
+            return
+        status = dps.get(self.dps)
+        echo, self._set_echo = self._set_echo, None
+        if echo is not None and echo[0] == status and time.time() < echo[1]:
+            debugf("DBUG", "Tuya device {} pushed the status it was just set to:", self.id, dps)
+            return
+        debugf("INFO", "Tuya device {} pushed its status:", self.id, dps)
+        self.emit('status_update', status, ctx={'origin': 'device'})
+
+    # Connection pool member interface
+    def is_idle(self):
+        return self.sync_proto.is_dry()
+
+    def open(self):
+        if not self.connected and not self.connecting:
+            self._connect()
+
+    def close(self):
+        self._disconnect()
+
+    def heartbeat(self, callback=DO_NOTHING):
+        # Devices reply to heartbeats with an empty message
+        return self.send_command(CMD_HEART_BEAT, {
+            'gwId':  self.gw_id,
+            'devId': self.gw_id,
+        }, lambda err, reply: callback(err), key=('heartbeat',), empty_reply=True, touch=False)
+
     def set_status(self, value, ctx={'origin': 'set'}, callback=DO_NOTHING):
         if not self.ip:
             raise Exception("Device {} has NO IP address yet. Can't get its status")
-        debug("DBUG", "Setting Tuya device status to {} (IP: {}, PORT: {}, GW_ID: {})".format(value, self.ip, self.port, self.gw_id))
-        return self.send_command(7, {
+        debugf("DBUG", "Setting Tuya device status to {} (IP: {}, PORT: {}, GW_ID: {})", value, self.ip, self.port, self.gw_id)
+        # Some devices reply to sets with an empty acknowledgement (and push their status after it)
+        sent = []
+        cmd_id = self.send_command(7, {
             'gwId':  self.gw_id,
             'devId': self.gw_id,
             'dps':   {str(self.dps): value},
             'uid':   self.gw_id,
-        }, lambda err, reply: self._set_status_callback(err, reply, ctx, callback))
+        }, lambda err, reply: self._set_status_callback(err, reply, ctx, callback, sent[0]), key=('set', self.dps), replace=True, empty_reply=True)
+        sent.append(cmd_id)
+        self._set_values[cmd_id] = value
+        return cmd_id
 
-    def _set_status_callback(self, err, reply, ctx, callback):
+    def _set_status_callback(self, err, reply, ctx, callback, cmd_id):
+        ctx['origin'] = 'set'
+        if self._set_result is None or self._set_result[0] != cmd_id:
+            # The first caller of the command handles its reply, the ones coalesced with it get the same result
+            value = self._set_values.pop(cmd_id, None)
+            status = None
+            if err:
+                debugf("DBUG", "Error setting device {} status:", self.gw_id, err)
+            else:
+                debugf("DBUG", "Got device {} status after SET:", self.gw_id, reply)
+                if isinstance(reply, dict) and reply.get('dps'):
+                    status = reply.get('dps').get(self.dps)
+                else:
+                    status = value
+                    self._set_echo = (status, time.time() + self.command_timeout)
+                self.emit('status_update', status, ctx=ctx)
+            self._set_result = (cmd_id, err, status)
+        _, err, status = self._set_result
         if err:
-            debug("DBUG", "Error setting device {} status:".format(self.gw_id), err)
             return callback(err, None)
-        debug("DBUG", "Got device {} status after SET:".format(self.gw_id), reply)
-        status = reply.get('dps').get(self.dps)
-        ctx['origin'] = 'set'
-        self.emit('status_update', status, ctx=ctx)
         return callback(None, status)
 
     def get_status(self, callback=DO_NOTHING, ctx={'origin':'UNKWNOWN'}):
         if not self.ip:
             raise Exception("Device {} has NO IP address yet. Can't get its status")
-        debug("DBUG", "Getting Tuya device status (IP: {}, PORT: {}, GW_ID: {})".format(self.ip, self.port, self.gw_id))
+        debugf("DBUG", "Getting Tuya device status (IP: {}, PORT: {}, GW_ID: {})", self.ip, self.port, self.gw_id)
 
         return self.send_command(7, {
             'gwId':  self.gw_id,
             'devId': self.gw_id,
             'dps':   {str(self.dps): None},
             'uid':   self.gw_id,
-        }, lambda err, reply: self._get_status_callback(err, reply, callback, ctx))
+        }, lambda err, reply: self._get_status_callback(err, reply, callback, ctx), key=('get', self.dps))
 
     def _get_status_callback(self, err, reply, callback, ctx):
         if err:
             debug("ERRO", "Error getting Tuya device {} status:".format(self.gw_id), err)
             return callback(err, None)
 
-        debug("DBUG", "Got device {} status:".format(self.gw_id), reply)
+        debugf("DBUG", "Got device {} status:", self.gw_id, reply)
         status = reply.get('dps').get(self.dps)
         self.emit('status_update', status, ctx=ctx)
         return callback(None, status)
@@ -264,46 +365,7 @@ class TuyaDevice(EventEmitter):
         return self.connection.send(self._serialise_message(message))
 
     def _serialise_message(self, message):
-        command = message.get('command')
-        payload = message.get('payload')
-        sequence_num = message.get('sequenceN', 0)
-
-        command_hb = hex(command)[2:]
-        if command < 16:
-            command_hb = '0{}'.format(command_hb)
-        if 't' not in payload:
-            payload['t'] = str(int(time.time()))
-
-        # Serialise the payload and clean it up
-        json_payload = json.dumps(payload)
-        json_payload = json_payload.replace(' ', '')
-        json_payload = json_payload.encode('utf-8')
-
-        if self.version == 3.3:
-            cipher = AESCipher(self.key)  # expect to connect and then disconnect to set new
-            json_payload = cipher.encrypt(json_payload, False)
-            cipher = None
-            if command_hb != '0a':
-                json_payload = PROTOCOL_VERSION_BYTES_33 + b"\0\0\0\0\0\0\0\0\0\0\0\0" + json_payload
-        elif command == CMD_CONTROL:  
-            cipher = AESCipher(self.key)
-            json_payload = cipher.encrypt(json_payload)
-            preMd5String = b'data=' + json_payload + b'||lpv=' + PROTOCOL_VERSION_BYTES_31 + b'||' + self.key
-            hexdigest = md5(preMd5String).hexdigest()
-            json_payload = PROTOCOL_VERSION_BYTES_31 + hexdigest[8:][:16].encode('latin1') + json_payload
-
-        postfix_payload = hex2bin(bin2hex(json_payload) + SUFFIX)
-        assert len(postfix_payload) <= 0xff
-        postfix_payload_hex_len = '%x' % len(postfix_payload)  # single byte 0-255 (0x00-0xff)
-
-        buffer = bytearray()
-        buffer.extend(hex2bin(PREFIX[0:8]))            # prefix
-        buffer.extend(UInt32BE(sequence_num))          # seq_number
-        buffer.extend(UInt32BE(command))               # command
-        buffer.extend(UInt32BE(len(postfix_payload)))  # payload length
-        buffer.extend(postfix_payload)
-        hex_crc = format(binascii.crc32(buffer[:-8]) & 0xffffffff, '08X')
-        return buffer[:-8] + hex2bin(hex_crc) + buffer[-4:]
+        return self.codec.encode(message.get('command'), message.get('payload'), message.get('sequenceN', 0))
 
     def _read_and_parse_message(self, proto):
         # Read the header and parse it
@@ -315,10 +377,12 @@ class TuyaDevice(EventEmitter):
         sequenceN = readUInt32BE(header, 4)
         commandByte = readUInt32BE(header, 8)
         payloadSize = readUInt32BE(header, 12)
-        debug("DBUG", "Got header (prefix: {}, seq: {}, cmd: {}, size: {})".format(prefix, sequenceN, commandByte, payloadSize))
+        debugf("DBUG", "Got header (prefix: {}, seq: {}, cmd: {}, size: {})", prefix, sequenceN, commandByte, payloadSize)
+        proto.reply_sequence = sequenceN
+        proto.reply_command = commandByte
 
         # Check prefix
-        if prefix != readUInt32BE(hex2bin(PREFIX), 0):
+        if prefix != PREFIX_VALUE:
             raise ValueError('Unknown prefix {}'.format(prefix))
 
         # Read payload
@@ -334,8 +398,8 @@ class TuyaDevice(EventEmitter):
             proto.put_back(header)
             return None
 
-        if suffix[-4:] != hex2bin(SUFFIX[-8:]):
-            raise ValueError('Unknown suffix {} vs {}'.format(suffix[-4:], hex2bin(SUFFIX[-8:])))
+        if suffix[-4:] != SUFFIX_BYTES:
+            raise ValueError('Unknown suffix {} vs {}'.format(suffix[-4:], SUFFIX_BYTES))
 
         returnCode = readUInt32BE(payload, 0)
         if returnCode == 1:
@@ -375,8 +439,51 @@ class TuyaDevice(EventEmitter):
         return payload
 
     def _decrypt_json(self, data, base64):
-        cipher = AESCipher(self.key)
-        payload = cipher.decrypt(str(data), base64)
+        return self.codec.decrypt_json(data, base64)
+
+    def __del__(self):
+        self._disconnect()
+
+
+Device = TuyaDevice
+
+
+class TuyaCodec(object):
+    """
+    Builds the frames sent to a device. The AES cipher (with its expanded key) and the constant parts of the frames
+    are created once per device instead of once per message.
+    """
+    def __init__(self, key, version, aes_backend=None):
+        self.key = key
+        self.version = version
+        self.cipher = AESCipher(key, backend=aes_backend) if key else None
+        self.version_header_33 = PROTOCOL_VERSION_BYTES_33 + b"\0\0\0\0\0\0\0\0\0\0\0\0"
+        self.md5_suffix_31 = b'||lpv=' + PROTOCOL_VERSION_BYTES_31 + b'||' + (key or b'')
+
+    def encode(self, command, payload, sequence_num=0):
+        if 't' not in payload:
+            payload['t'] = str(int(time.time()))
+
+        # Serialise the payload and clean it up
+        json_payload = json.dumps(payload).replace(' ', '')
+        json_payload = json_payload.encode('utf-8')
+
+        if self.version == 3.3:
+            json_payload = self.cipher.encrypt(json_payload, False)
+            if command not in NO_VERSION_HEADER_COMMANDS:
+                json_payload = self.version_header_33 + json_payload
+        elif command == CMD_CONTROL:
+            json_payload = self.cipher.encrypt(json_payload)
+            hexdigest = md5(b'data=' + json_payload + self.md5_suffix_31).hexdigest()
+            json_payload = PROTOCOL_VERSION_BYTES_31 + hexdigest[8:][:16].encode('latin1') + json_payload
+
+        # The length includes the CRC and the suffix, which are also 8 bytes
+        header = FRAME_HEADER.pack(PREFIX_VALUE, sequence_num, command, len(json_payload) + 8)
+        crc = binascii.crc32(header + json_payload) & 0xffffffff
+        return header + json_payload + FRAME_TRAILER.pack(crc, SUFFIX_VALUE)
+
+    def decrypt_json(self, data, base64):
+        payload = self.cipher.decrypt(str(data), base64)
         if not isinstance(payload, bytes):
             payload = payload.decode()
         try:
@@ -385,12 +492,6 @@ class TuyaDevice(EventEmitter):
             raise Exception('Error parsing decrypted message JSON body. Perhaps the configured key is wrong')
         return payload
 
-    def __del__(self):
-        self._disconnect()
-
-
-Device = TuyaDevice
-
 
 class TuyaUDPMessage(object):
     def __init__(self, payload=None, leftover=None, commandByte=None, sequenceN=None):
@@ -411,7 +512,7 @@ class TuyaDeviceListener(EventEmitter):
         self.unseen_timeout = unseen_timeout
         self.socket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
         self.socket.setblocking(0)
-        self.cipher = AESCipher(self.key)
+        self.cipher = AESCipher(self.key) if self.key else None
         self.devices = {}
         self.device_last_seen = {}
 
@@ -420,7 +521,7 @@ class TuyaDeviceListener(EventEmitter):
 
     def start(self):
         debug("INFO", "TuyaDeviceListener: Starting...")
-        debug("INFO", "TuyaDeviceListener: Binding on {}:{}".format(self.host, self.port))
+        debugf("INFO", "TuyaDeviceListener: Binding on {}:{}", self.host, self.port)
         self.socket.bind((self.host, self.port))
 
     def loop(self):
@@ -1,5 +1,6 @@
 import asyncore
 import base64
+from collections import deque
 from errno import EALREADY, EINPROGRESS, EWOULDBLOCK, ECONNRESET, EINVAL, \
      ENOTCONN, ESHUTDOWN, EINTR, EISCONN, EBADF, ECONNABORTED, EPIPE, EAGAIN
 import json
@@ -9,7 +10,8 @@ import socket
 import time
 
 import proto
-from .util import debug, readUInt32BE, writeUInt32BE
+from . import metrics
+from .util import debug, debugf, readUInt32BE, writeUInt32BE
 
 
 HTTP_STATUS_BY_ERROR = {
@@ -19,6 +21,15 @@ HTTP_STATUS_BY_ERROR = {
     'internal': 500,
 }
 
+HTTP_REQUEST_LINE = re.compile(r'^(GET|POST|HEAD|PUT|PATCH|DELETE) (\/[^ ]*) (HTTP\/[0-9](?:\.[0-9]+)?)$')
+HTTP_HEADER_LINE = re.compile(r'^([\w-]+)\s*:\s*(.*?)\s*$')
+HTTP_BASIC_AUTH_PREFIX = re.compile(r'^basic +', re.I)
+MAX_HTTP_LINE_SIZE = 8192
+MAX_HTTP_BODY_SIZE = 1048576
+
+BROADCAST_FANOUT = metrics.histogram('homeswitch_broadcast_recipients', 'Number of clients each broadcast was sent to', buckets=metrics.COUNT_BUCKETS)
+BROADCAST_FRAMES = metrics.counter('homeswitch_broadcast_frames_total', 'Distinct frames serialised for broadcasts')
+
 HTTP_STATUS_DESCRIPTION = {
     '200': 'OK',
     '400': 'Invalid request',
@@ -28,45 +39,74 @@ HTTP_STATUS_DESCRIPTION = {
 }
 
 class HybridServer(asyncore.dispatcher, EventEmitter):
-    def __init__(self, host='0.0.0.0', port=1234, tcp_backlog=20):
+    def __init__(self, host='0.0.0.0', port=1234, tcp_backlog=20, read_buffer_size=65536):
         asyncore.dispatcher.__init__(self)
         EventEmitter.__init__(self)
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.set_reuse_addr()
         self.bind((host, port))
         self.listen(tcp_backlog)
+        self.read_buffer_size = read_buffer_size
         self.clients = {}
 
     def handle_accept(self):
         pair = self.accept()
         if pair is not None:
             sock, addr = pair
-            debug("INFO", "New Incoming connection from {} (fd: {})".format(addr, sock.fileno()))
+            debugf("INFO", "New Incoming connection from {} (fd: {})", addr, sock.fileno())
             client_id = sock.fileno()
-            client = HybridServerClient(sock, self)
+            client = HybridServerClient(sock, self, read_buffer_size=self.read_buffer_size)
             self.clients[client_id] = client
 
     def broadcast(self, message, ignore=[]):
+        # Every distinct message is serialised only once and the same frame is queued on all the recipients. Clients
+        # subscribed to only some devices get a frame with just those (shared with the clients with the same view).
+        message = dict(message, when=time.time() * 1000)
+        devices = message.get('devices', None)
+        frames = {}
+        recipients = 0
         for id, client in self.clients.items():
-            if client.proto == 3 and not id in ignore:
-                debug("DBUG", "Broadcasting message to", id)
-                client.message(message)
+            if client.proto != 3 or id in ignore:
+                continue
+            view = client.subscribed_view(devices)
+            if view is not None and len(view) == 0:
+                continue
+            frame = frames.get(view, None)
+            if frame is None:
+                body = message if view is None else dict(message, devices=dict((dev_id, devices[dev_id]) for dev_id in view))
+                frame = frames[view] = proto.serialise(body)
+            client.fault_tolerant_send(frame)
+            recipients += 1
+        BROADCAST_FANOUT.observe(recipients)
+        BROADCAST_FRAMES.inc(len(frames))
+        debugf("DBUG", "Broadcasted message to {} clients ({} distinct frames)", recipients, len(frames))
 
     def remove_user(self, client):
         del self.clients[client.id]
 
 
 class HybridServerClient(asyncore.dispatcher_with_send, EventEmitter):
-    def __init__(self, sock, server):
+    def __init__(self, sock, server, read_buffer_size=65536):
         self.id = sock.fileno()
         debug("INFO", "NEW CLIENT: ", self.id)
         self.server = server
         self.request = None
         self.proto = None
         self.status = "alive"
-        self.processing = False
         self.client_id = None
         self.session_id = None
+        self.subscriptions = None
+        # Outgoing data is queued as a list of (possibly shared) frames instead of being concatenated
+        self._out_queue = deque()
+        self._out_offset = 0
+        self._out_len = 0
+        # Incoming data is read straight into this buffer and messages are parsed from it in place
+        self.read_buffer_size = read_buffer_size
+        self._read_buffer = bytearray(read_buffer_size)
+        self._read_buffer_len = 0
+        self._read_buffer_need = 0
+        self._consuming = False
+        self._close_when_sent = False
         asyncore.dispatcher_with_send.__init__(self, sock)
         EventEmitter.__init__(self)
         # Proxy 'request' event to 
@@ -80,36 +120,95 @@ class HybridServerClient(asyncore.dispatcher_with_send, EventEmitter):
         if self.client_id is None:
             self.client_id = request.get_client()
         self.server.emit('request', self, request, error)
-        self.processing = True
+
+    def readable(self):
+        # Stop reading if the buffer is full of pipelined HTTP requests that have to wait for the current one
+        return self._read_buffer_len < self.read_buffer_size or not self._waiting_http_response()
+
+    def _waiting_http_response(self):
+        return self.request is not None and self.request.proto == "http" and self.request.is_ready and not self.request.responded
 
     def handle_read(self):
-        if self.processing:
-            self.request = None
-            self.processing = False
-        data = None
-
-        # If we don't have a request object yet, create it... then just push data into it (it works like a stream)
-        data = self.recv(1024)
-        if len(data) < 1:
+        # Make sure there's room for what we're about to read (a whole message must fit in the buffer)
+        needed = max(self._read_buffer_len + 1, self._read_buffer_need)
+        if needed > len(self._read_buffer):
+            self._read_buffer.extend(bytearray(max(needed - len(self._read_buffer), self.read_buffer_size)))
+
+        read = self.recv_into(memoryview(self._read_buffer)[self._read_buffer_len:])
+        if read < 1:
+            return
+        self._read_buffer_len += read
+        self._consume_read_buffer()
+
+    def recv_into(self, buffer):
+        # Same as asyncore.dispatcher.recv() but reads into an existing buffer
+        try:
+            read = self.socket.recv_into(buffer)
+            if read == 0:
+                self.handle_close()
+            return read
+        except socket.error as why:
+            if why.args[0] in asyncore._DISCONNECTED:
+                self.handle_close()
+                return 0
+            raise
+
+    def _consume_read_buffer(self):
+        # Replying to a request from within the 'request' event brings us back here. The outer call will carry on.
+        if self._consuming:
             return
-        used_data = 0
+        self._consuming = True
+        try:
+            self._consume_read_buffer_messages()
+        finally:
+            self._consuming = False
+
+    def _consume_read_buffer_messages(self):
+        buf = self._read_buffer
+        view = memoryview(buf)
+        end = self._read_buffer_len
+        offset = 0
+        self._read_buffer_need = 0
 
         its = 0
-        while len(data) > 0:
+        while offset < end:
             its += 1
-            if its > 100:
+            if its > 10000:
                 debug("CRIT", "Something's wrong on parsing a message. Seems to be in an infinite loop")
                 break
+            if self._close_when_sent or self.status != "alive":
+                offset = end
+                break
+            # HTTP requests are answered in order, so pipelined ones wait until the previous one gets its response
+            if self._waiting_http_response():
+                break
             if not self.request or self.request.is_ready:
                 # Create a request object
-                self.request = HomeSwitchRequest(parent=self) if ord(data[0]) == 3 else HTTPRequest(parent=self)
+                self.request = HomeSwitchRequest(parent=self) if buf[offset] == 3 else HTTPRequest(parent=self)
                 self.request.on('ready', lambda: self.emit('request', self.request, None))
                 self.request.on('error', lambda description: self.emit('request', self.request, description))
-            used_data = self.request.push_data(data)
-            data = data[used_data:]
+
+            if self.request.proto == 3:
+                # Native messages are only handed to the request once they are complete
+                size = proto.frame_size(buf, offset, end)
+                if size is None or end - offset < size:
+                    self._read_buffer_need = size or 0
+                    break
+                start = offset
+                offset += size
+                self.request.load(buf[start + 1], view[start + proto.HEADER_SIZE:offset])
+            else:
+                offset += self.request.push_data(view[offset:end].tobytes())
+
+        # Keep whatever wasn't consumed at the beginning of the buffer
+        del view
+        leftover = end - offset
+        if offset > 0 and leftover > 0:
+            buf[0:leftover] = buf[offset:end]
+        self._read_buffer_len = leftover
 
     def handle_error(self):
-        debug("INFO", "Client {} crashed".format(self.id))
+        debugf("INFO", "Client {} crashed", self.id)
         debug("DEBUG", "Exception")
         import traceback
         traceback.print_exc()
@@ -119,25 +218,29 @@ class HybridServerClient(asyncore.dispatcher_with_send, EventEmitter):
 
     def handle_close(self):
         if self.status == "alive":
-            debug("INFO", "Client {} has disconnected".format(self.id))
+            debugf("INFO", "Client {} has disconnected", self.id)
             self.status = "gone"
             self.server.remove_user(self)
             self.close()
 
-    def reply(self, body):
+    def reply(self, body, request=None):
+        # Native clients can have more than one request going on, so the request being replied can be passed in
+        # (otherwise it's the last one received)
+        request = request or self.request
         _body = body.copy()
-        if self.request:
-            if self.request.id:
-                _body['id'] = self.request.id
+        if request:
+            if request.id:
+                _body['id'] = request.id
 
-        return self.message(_body if _body else body)
+        return self.message(_body if _body else body, request)
 
-    def message(self, body):
+    def message(self, body, request=None):
+        request = request or self.request
         proto = "HTTP" if self.proto == "http" else "HS"
         status = "error/"+body.get('error') if body.get('error', None) else 'ok'
-        user = self.request.get_user() if self.request.get_user() else 'unidentified'
-        client_id = self.request.get_client() if self.request.get_client() else 'unknown-client'
-        debug("INFO", "[Client {}] {}/{} => {}; by {} via {}".format(self.id, proto, self.request, status, user, client_id))
+        user = request.get_user() if request.get_user() else 'unidentified'
+        client_id = request.get_client() if request.get_client() else 'unknown-client'
+        debugf("INFO", "[Client {}] {}/{} => {}; by {} via {}", self.id, proto, request, status, user, client_id)
         body['when'] = time.time() * 1000
         if self.proto == 3:
             self.send_hs(body)
@@ -146,6 +249,14 @@ class HybridServerClient(asyncore.dispatcher_with_send, EventEmitter):
                 self.send_http(HTTP_STATUS_BY_ERROR.get(body.get('error'), 500), body)
             else:
                 self.send_http(200, body)
+        self.server.emit('reply', self, request, body)
+
+    def reply_http(self, status, body, content_type='application/json', request=None):
+        # Replies an HTTP request with a body of any content type (not only JSON messages), like reply() does
+        request = request or self.request
+        debugf("INFO", "[Client {}] HTTP/{} => {} ({})", self.id, request, status, content_type)
+        self.send_http(status, body, content_type=content_type)
+        self.server.emit('reply', self, request, {} if status < 400 else {'error': str(status)})
 
     def send_error(self, error):
         if self.proto == 3:
@@ -156,17 +267,58 @@ class HybridServerClient(asyncore.dispatcher_with_send, EventEmitter):
     def send_hs(self, body):
         self.fault_tolerant_send(proto.serialise(body))
 
-    def send_http(self, status, body):
-        debug("INFO", "Responding to HTTP {} {} with {} ({} bytes)".format(
-            self.request.method, self.request.url, status, len(body)
-        ))
-        raw_body = json.dumps(body)
-        response  = "HTTP/1.0 {} {}\r\n".format(status, HTTP_STATUS_DESCRIPTION[str(status)])
-        response += "Content-type: application/json\r\n"
+    def send_http(self, status, body, content_type='application/json'):
+        request = self.request
+        raw_body = body if isinstance(body, basestring) else json.dumps(body)
+        debugf("INFO", "Responding to HTTP {} {} with {} ({} bytes)", request.method, request.url, status, len(raw_body))
+        keep_alive = request.keep_alive
+        response  = "{} {} {}\r\n".format("HTTP/1.1" if request.http_version == "HTTP/1.1" else "HTTP/1.0", status, HTTP_STATUS_DESCRIPTION[str(status)])
+        response += "Content-type: {}\r\n".format(content_type)
         response += "Content-length: {}\r\n".format(len(raw_body))
+        response += "Connection: {}\r\n".format("keep-alive" if keep_alive else "close")
         response += "\r\n"
-        self.fault_tolerant_send(response)
-        self.fault_tolerant_send(raw_body)
+        request.responded = True
+        if not keep_alive:
+            self._close_when_sent = True
+        self.fault_tolerant_send(response + raw_body)
+
+        # Carry on with any pipelined request
+        if keep_alive and self._read_buffer_len > 0:
+            self._consume_read_buffer()
+
+    def subscribe(self, devices=None):
+        self.subscriptions = frozenset(devices) if devices else None
+
+    def subscribed_view(self, devices):
+        # Returns None if the client is interested in all the devices or a (sorted) tuple with the ones it cares about
+        if self.subscriptions is None or devices is None:
+            return None
+        view = tuple(sorted(dev_id for dev_id in devices if dev_id in self.subscriptions))
+        return None if len(view) == len(devices) else view
+
+    def send(self, data):
+        self._out_queue.append(data)
+        self._out_len += len(data)
+        self.initiate_send()
+
+    def writable(self):
+        return (not self.connected) or self._out_len > 0
+
+    def initiate_send(self):
+        while self._out_queue:
+            data = self._out_queue[0]
+            sent = asyncore.dispatcher.send(self, memoryview(data)[self._out_offset:] if self._out_offset else data)
+            if not sent:
+                break
+            self._out_len -= sent
+            self._out_offset += sent
+            if self._out_offset < len(data):
+                break
+            self._out_queue.popleft()
+            self._out_offset = 0
+
+        if self._close_when_sent and self._out_len == 0:
+            self.handle_close()
 
     def fault_tolerant_send(self, data):
         try:
@@ -183,7 +335,7 @@ class HybridServerClient(asyncore.dispatcher_with_send, EventEmitter):
 class HomeSwitchRequest(EventEmitter):
     def __init__(self, raw_request=None, parent=None):
         super(HomeSwitchRequest, self).__init__()
-        self.raw_request = ""
+        self.raw_request = bytearray()
         self.headers = None
         self.proto = 3
         self.encryption = None
@@ -193,53 +345,64 @@ class HomeSwitchRequest(EventEmitter):
         self.client_id = parent.client_id if parent else None
         self.session_id = parent.session_id if parent else None
         self.method = None
-        self._raw_body = ""
+        self.id = None
+        self._raw_body = bytearray()
         self._eating_stage = "need_header"
         self._ctx = None
 
     def push_data(self, data):
         # We need to understand how much data we actually need because perhaps it belongs to another request
         total_data_used = 0
-        initial_rr_size = len(self.raw_request)
-        self.raw_request += data
-        while self._eating_stage != "done" and len(self.raw_request) > 0:
+        data = memoryview(data)
+        while self._eating_stage != "done" and total_data_used < len(data):
             if self._eating_stage == "need_header":
-                if len(self.raw_request) >= 4:
+                missing = proto.HEADER_SIZE - len(self.raw_request)
+                self.raw_request.extend(data[total_data_used:total_data_used + missing])
+                total_data_used += min(missing, len(data) - total_data_used)
+                if len(self.raw_request) == proto.HEADER_SIZE:
                     self._eat_header(self.raw_request)
                     self._eating_stage = "need_body"
-                    self.raw_request = self.raw_request[4:]
-                    total_data_used += 4
-                else:
-                    return 4
             elif self._eating_stage == "need_body":
                 # Eat everything that belongs to us
-                total_data_used += self._eat_body(self.raw_request)
-                self.raw_request = ""
+                total_data_used += self._eat_body(data[total_data_used:])
         return total_data_used
 
+    def load(self, encryption, raw_body):
+        # Load a complete message body at once (the header was already parsed by whoever framed it)
+        self.encryption = encryption
+        self.size = len(raw_body)
+        self._eating_stage = "done"
+        self._parse_body(raw_body.tobytes())
+
     def _eat_header(self, data):
-        header = readUInt32BE(data, 0)
+        header = proto.HEADER.unpack_from(data, 0)[0]
         self.encryption = header >> 16 & 0xff
         self.size = header & 0xffff
 
     def _eat_body(self, data):
         missing = self.size - len(self._raw_body)
         eating = missing if missing <= len(data) else len(data)
-        self._raw_body += data[0:eating]
+        self._raw_body.extend(data[0:eating])
         if len(self._raw_body) >= self.size:
             self._eating_stage = "done"
-            self.is_ready = True
-            self.body = json.loads(self._raw_body)
-            self.method = self.body.get('method', None)
-            self.id = self.body.get('id', None)
-            if not self.method or not self.id:
-                self.emit('error', 'Mandatory request fields were not present')
-            else:
-                self.emit('ready')
+            self._parse_body(bytes(self._raw_body))
         return eating
 
-        if missing > len(self.raw_request):
-                        missing = len(self.raw_request)
+    def _parse_body(self, raw_body):
+        self.is_ready = True
+        try:
+            self.body = json.loads(raw_body)
+        except ValueError:
+            self.body = None
+        if type(self.body) is not dict:
+            self.body = {}
+            return self.emit('error', 'Invalid JSON body')
+        self.method = self.body.get('method', None)
+        self.id = self.body.get('id', None)
+        if not self.method or not self.id:
+            self.emit('error', 'Mandatory request fields were not present')
+        else:
+            self.emit('ready')
 
     def __repr__(self):
         return "{}".format(self.method)
@@ -265,11 +428,19 @@ class HomeSwitchRequest(EventEmitter):
 
 
 class HTTPRequest(EventEmitter):
+    """
+    Incremental HTTP/1.x request parser. Data can be pushed in arbitrarily sized chunks and every byte is only looked
+    at once. push_data() only consumes the bytes that belong to this request, so pipelined requests are left for the
+    next one.
+    """
     def __init__(self, method=None, url=None, http_version=None, headers=None, raw_request=None, parent=None):
         super(HTTPRequest, self).__init__()
         self.id = None
         self.proto = "http"
         self.is_ready = False
+        self.error = None
+        self.responded = False
+        self.keep_alive = False
         self.raw_request = ''
         self.method = None
         self.url = None
@@ -279,70 +450,131 @@ class HTTPRequest(EventEmitter):
         self.body = None
         self._ctx = None
         self._eating_stage = "need_request_line"
-#        if raw_request:
-#            self._eat_raw_request()
+        self._line = bytearray()
+        self._raw_body = bytearray()
+        self._body_missing = 0
+        self._chunked = False
 
     def push_data(self, data):
-        self.raw_request += data
-        # FIXME: this is a massive temporary hack. It should support stream parsing
-        if len(self.raw_request) > 10:
-            self._eat_raw_request()
-        return len(data)
-
-    def _eat_raw_request(self):
-        debug("DBUG", "HTTP Request:", self.raw_request)
-        debug("DBUG", "Starting headers: ", self.headers)
-        line_num = 0
-        last_crlf = 0
-        if self._eating_stage in ("need_request_line", "need_headers"):
-            while len(self.raw_request) > 0:
-                try:
-                    eol = self.raw_request.index("\r\n", last_crlf)
-                except ValueError:
-                    return
-                line = self.raw_request[last_crlf:eol]
-    #            debug("DBUG", "Line:", line)
-                last_crlf = eol + 2
-
-                # Request line
-                if line_num == 0:
-                    m = re.search('^(GET|POST|HEAD|PUT|PATCH|DELETE) (\/[^ ]*) (HTTP\/[0-9](?:\.[0-9]+)?)$', line)
-                    if not m:
-                        raise ValueError('Invalid HTTP request. Could not parse request line: {}'.format(line))
-                    self.method = m.group(1)
-                    self.url = m.group(2)
-                    self.http_version = m.group(3)
-                elif line == "":
-                    # End of request headers
-                    self._eating_stage = "need_body"
-                    self.raw_request = self.raw_request[last_crlf:]
-                    return self._eat_request_body()
-                else:
-                    m = re.search('^([\w-]+)\s*:\s*(.*?)\s*$', line)
-                    if m:
-                        self.headers[m.group(1).lower()] = m.group(2)
-                line_num += 1
-        elif self._eating_stage == "need_body":
-            self._eat_request_body()
+        used = 0
+        size = len(data)
+        while used < size and not self.is_ready:
+            if self._eating_stage == "need_body":
+                eating = min(self._body_missing, size - used)
+                self._raw_body.extend(data[used:used + eating])
+                self._body_missing -= eating
+                used += eating
+                if self._body_missing == 0:
+                    if self._chunked:
+                        self._eating_stage = "need_chunk_end"
+                    else:
+                        self._eat_request_body()
+                continue
+
+            # Every other stage is line based
+            eol = data.find(b'\n', used)
+            if eol == -1:
+                self._line.extend(data[used:])
+                if len(self._line) > MAX_HTTP_LINE_SIZE:
+                    self._fail('Request line or header is too long')
+                return size
+            if len(self._line) > 0:
+                self._line.extend(data[used:eol])
+                line = bytes(self._line)
+                self._line = bytearray()
+            else:
+                line = data[used:eol]
+            used = eol + 1
+            self._eat_line(line[:-1] if line.endswith(b'\r') else line)
+
+        # If something went wrong, we can't know where the next request starts. Discard everything.
+        return size if self.error else used
+
+    def _eat_line(self, line):
+        if self._eating_stage == "need_request_line":
+            # Ignore empty lines before the request line (RFC 7230 3.5)
+            if line == "":
+                return
+            m = HTTP_REQUEST_LINE.match(line)
+            if not m:
+                return self._fail('Invalid HTTP request. Could not parse request line: {}'.format(line))
+            self.method, self.url, self.http_version = m.groups()
+            self._eating_stage = "need_headers"
+        elif self._eating_stage == "need_headers":
+            if line == "":
+                return self._eat_headers_end()
+            m = HTTP_HEADER_LINE.match(line)
+            if m:
+                self.headers[m.group(1).lower()] = m.group(2)
+        elif self._eating_stage == "need_chunk_size":
+            try:
+                self._body_missing = int(line.split(';', 1)[0].strip(), 16)
+            except ValueError:
+                return self._fail('Invalid chunk size')
+            if self._body_missing == 0:
+                self._eating_stage = "need_trailers"
+            elif len(self._raw_body) + self._body_missing > MAX_HTTP_BODY_SIZE:
+                self._fail('Request body is too large')
+            else:
+                self._eating_stage = "need_body"
+        elif self._eating_stage == "need_chunk_end":
+            if line != "":
+                return self._fail('Invalid chunk termination')
+            self._eating_stage = "need_chunk_size"
+        elif self._eating_stage == "need_trailers":
+            if line == "":
+                self._eat_request_body()
+
+    def _eat_headers_end(self):
+        connection = [token.strip() for token in self.headers.get('connection', '').lower().split(',')]
+        if self.http_version == 'HTTP/1.1':
+            self.keep_alive = 'close' not in connection
+        else:
+            self.keep_alive = 'keep-alive' in connection
+
+        if 'chunked' in self.headers.get('transfer-encoding', '').lower():
+            self._chunked = True
+            self._eating_stage = "need_chunk_size"
+            return
 
-    def _eat_request_body(self):
         content_length = self.headers.get('content-length', None)
         if content_length is None:
-            self.is_ready = True
-            return self.emit('ready')
+            return self._eat_request_body()
+        try:
+            self._body_missing = int(content_length)
+        except ValueError:
+            return self._fail('Invalid content-length')
+        if self._body_missing > MAX_HTTP_BODY_SIZE:
+            return self._fail('Request body is too large')
+        if self._body_missing == 0:
+            return self._eat_request_body()
+        self._eating_stage = "need_body"
 
-        self.post_data += self.raw_request
-        if len(self.post_data) == int(content_length):
-            debug("DBUG", "POST: ", self.post_data)
-            if self.headers.get('content-type') != 'application/json':
-                return self.emit('error', "Unsupported content-type")
-            try:
-                self.body = self.post_data = json.loads(self.post_data)
-            except Exception as e:
-                return self.emit('error', 'Invalid request body')
+    def _eat_request_body(self):
+        self._eating_stage = "done"
+        if not self._chunked and self.headers.get('content-length', None) is None:
             self.is_ready = True
             return self.emit('ready')
 
+        self.post_data = bytes(self._raw_body)
+        self._raw_body = None
+        debug("DBUG", "POST: ", self.post_data)
+        if self.headers.get('content-type', '').split(';', 1)[0].strip() != 'application/json':
+            return self._fail("Unsupported content-type")
+        try:
+            self.body = self.post_data = json.loads(self.post_data)
+        except Exception as e:
+            return self._fail('Invalid request body')
+        self.is_ready = True
+        return self.emit('ready')
+
+    def _fail(self, description):
+        self._eating_stage = "done"
+        self.error = description
+        self.is_ready = True
+        self.keep_alive = False
+        return self.emit('error', description)
+
     def __repr__(self):
         return "{} {}".format(self.method, self.url)
 
@@ -352,8 +584,8 @@ class HTTPRequest(EventEmitter):
     def get_client(self):
         if self.headers.get('authorization', None):
             try:
-                auth = base64.b64decode(re.sub(r'^basic +', '', self.headers.get('authorization'), flags=re.I))
-                return re.sub(r':.*', '', auth)
+                auth = base64.b64decode(HTTP_BASIC_AUTH_PREFIX.sub('', self.headers.get('authorization')))
+                return auth.split(':', 1)[0]
             except Exception as e:
                 return None
 
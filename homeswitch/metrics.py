@@ -0,0 +1,263 @@
+from bisect import bisect_left
+from collections import OrderedDict
+import json
+
+
+# Latency buckets (in seconds)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Buckets for things that are counted (like the number of clients a broadcast was sent to)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class Registry(object):
+    """
+    Keeps every metric of the process. Metrics are created once (usually at import time) and recording a sample is
+    just a dictionary lookup for the labels plus an addition, so it can stay on under load.
+    """
+    def __init__(self):
+        self.metrics = OrderedDict()
+
+    def counter(self, name, help='', labels=()):
+        return self._register(Counter, name, help, labels)
+
+    def gauge(self, name, help='', labels=()):
+        return self._register(Gauge, name, help, labels)
+
+    def histogram(self, name, help='', labels=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, help, labels, buckets=buckets)
+
+    def _register(self, cls, name, help, labels, **kwargs):
+        metric = self.metrics.get(name, None)
+        if metric is not None:
+            if type(metric) is not cls or metric.labelnames != tuple(labels):
+                raise ValueError('Metric {} is already registered with a different type or labels'.format(name))
+            return metric
+        metric = cls(name, help, labels, **kwargs)
+        self.metrics[name] = metric
+        return metric
+
+    def clear(self):
+        for metric in self.metrics.values():
+            metric.clear()
+
+    def prometheus(self):
+        # Prometheus text exposition format (version 0.0.4)
+        lines = []
+        for metric in self.metrics.values():
+            lines.append('# HELP {} {}'.format(metric.name, metric.help.replace('\\', '\\\\').replace('\n', '\\n')))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            lines.extend(metric.prometheus())
+        lines.append('')
+        return '\n'.join(lines)
+
+    def json(self):
+        return dict((metric.name, {
+            'type': metric.type,
+            'help': metric.help,
+            'samples': metric.json(),
+        }) for metric in self.metrics.values())
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help='', labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.children = {}
+        self._default = None
+
+    def labels(self, *values):
+        # Returns the child holding the samples for these label values (keep it around on hot paths)
+        child = self.children.get(values, None)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('Metric {} takes the labels {}'.format(self.name, self.labelnames))
+            child = self._new_child()
+            self.children[values] = child
+        return child
+
+    def remove(self, *values):
+        self.children.pop(values, None)
+
+    def clear(self):
+        self.children = {}
+        self._default = None
+
+    def _child(self):
+        # The child of metrics without labels
+        if self._default is None:
+            self._default = self.labels()
+        return self._default
+
+    def _new_child(self):
+        # Abstract: every metric type creates its own kind of child
+        raise NotImplementedError()
+
+    def _label_string(self, values, extra=None):
+        pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(self.labelnames, values)]
+        if extra is not None:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def _sorted_children(self):
+        return sorted(self.children.items(), key=lambda item: tuple(str(value) for value in item[0]))
+
+    def prometheus(self):
+        return ['{}{} {}'.format(self.name, self._label_string(values), _number(child.get()))
+                for values, child in self._sorted_children()]
+
+    def json(self):
+        return [{'labels': dict(zip(self.labelnames, values)), 'value': child.get()}
+                for values, child in self._sorted_children()]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self._child().inc(amount)
+
+
+class CounterValue(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def get(self):
+        return self.value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _new_child(self):
+        return GaugeValue()
+
+    def set(self, value):
+        self._child().set(value)
+
+    def inc(self, amount=1):
+        self._child().inc(amount)
+
+    def dec(self, amount=1):
+        self._child().inc(-amount)
+
+    def set_function(self, function):
+        self._child().set_function(function)
+
+
+class GaugeValue(object):
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set_function(self, function):
+        # The value is only computed when the metrics are collected
+        self.function = function
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help='', labels=(), buckets=DEFAULT_BUCKETS):
+        Metric.__init__(self, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._child().observe(value)
+
+    def prometheus(self):
+        lines = []
+        for values, child in self._sorted_children():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(self.name, self._label_string(values, 'le="{}"'.format(_number(bound))), cumulative))
+            lines.append('{}_sum{} {}'.format(self.name, self._label_string(values), _number(child.sum)))
+            lines.append('{}_count{} {}'.format(self.name, self._label_string(values), child.count))
+        return lines
+
+    def json(self):
+        samples = []
+        for values, child in self._sorted_children():
+            cumulative = 0
+            buckets = OrderedDict()
+            for bound, count in zip(self.buckets + (float('inf'),), child.counts):
+                cumulative += count
+                buckets[_number(bound)] = cumulative
+            samples.append({
+                'labels': dict(zip(self.labelnames, values)),
+                'count': child.count,
+                'sum': child.sum,
+                'buckets': buckets,
+            })
+        return samples
+
+
+class HistogramValue(object):
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One counter per bucket (not cumulative) plus the +Inf one
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+REGISTRY = Registry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+def prometheus():
+    return REGISTRY.prometheus()
+
+
+def to_json():
+    return json.dumps(REGISTRY.json(), sort_keys=True)
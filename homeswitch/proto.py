@@ -1,16 +1,37 @@
 import json
+import struct
 from .util import readUInt32BE, writeUInt32BE
 
 
+HEADER_SIZE = 4
+HEADER = struct.Struct('>I')
+
 
 def parse_messages(buf, encryption_key=None):
-	msg = True
-	while msg:
-		msg, read_bytes = _parse(buf, encryption_key)
-		if msg is None:
-			return
-		del buf[0:read_bytes]
-		yield msg
+	# Parse every complete message in place and only drop the consumed bytes from the buffer once
+	offset = 0
+	try:
+		while True:
+			msg, read_bytes = _parse(buf, encryption_key, offset=offset)
+			if msg is None:
+				return
+			offset += read_bytes
+			yield msg
+	finally:
+		if offset > 0:
+			del buf[0:offset]
+
+
+def frame_size(buf, offset=0, end=None):
+	"""
+	Returns the total size (header included) of the message starting at `offset`
+	or None if we don't have enough bytes to read its header yet
+	"""
+	if end is None:
+		end = len(buf)
+	if end - offset < HEADER_SIZE:
+		return None
+	return HEADER_SIZE + (HEADER.unpack_from(buf, offset)[0] & 0x0000ffff)
 
 
 def serialise(body, encryption_key=None):
@@ -27,13 +48,8 @@ def parse(message, encryption_key=None):
 	msg, _ = _parse(message, encryption_key=encryption_key)
 	return msg
 
-def _parse(message, encryption_key=None):
-	if len(message) < 4:
-		return (None, 0)
-	value = readUInt32BE(message, 0)
-	proto = message[0]
-	encryption = message[1]
-	size = value & 0x0000ffff
-	if len(message) - 4 < size:
+def _parse(message, encryption_key=None, offset=0):
+	size = frame_size(message, offset)
+	if size is None or len(message) - offset < size:
 		return (None, 0)
-	return (json.loads(str(message[4:4+size])), size + 4)
\ No newline at end of file
+	return (json.loads(memoryview(message)[offset + HEADER_SIZE:offset + size].tobytes()), size)
\ No newline at end of file
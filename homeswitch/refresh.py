@@ -0,0 +1,164 @@
+from collections import deque
+import heapq
+import itertools
+import random
+import time
+
+from .asyncorepp import set_timeout, cancel_timeout
+from . import metrics
+from .util import debugf
+
+
+REFRESHES = metrics.counter('homeswitch_device_refreshes_total', 'Periodic device status refreshes, by result', ('result',))
+
+SCHEDULED = 'scheduled'
+READY = 'ready'
+RUNNING = 'running'
+
+
+class RefreshScheduler(object):
+    """
+    Refreshes the status of devices every `refresh_status` seconds, from a single timer. The first refreshes are spread
+    over the interval and every interval gets some jitter, so devices with the same interval aren't polled in bursts.
+    At most `max_concurrent` refreshes run at once (the others wait for their turn).
+    Devices whose status doesn't change, or that fail to reply, are refreshed less and less often: their interval grows
+    `backoff` times each time, up to `max_backoff` times the configured one. A set or a status change brings a device
+    back to its configured interval and its next refresh is done `boost_delay` seconds later.
+    """
+    def __init__(self, max_concurrent=8, jitter=0.1, backoff=1.5, max_backoff=8, boost_delay=2):
+        self.max_concurrent = max_concurrent
+        self.jitter = jitter
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.boost_delay = boost_delay
+        self.entries = {}
+        self.running = 0
+        self._heap = []
+        self._ready = deque()
+        self._seq = itertools.count()
+        self._timer = None
+        self._timer_due = None
+        self._starting = False
+
+    def add(self, device, interval=None):
+        entry = RefreshEntry(device, interval or device.refresh_status)
+        self.entries[device.id] = entry
+        self._schedule(entry, time.time() + random.uniform(0, entry.interval))
+        return entry
+
+    def boost(self, device):
+        entry = self.entries.get(device.id, None)
+        if entry is None:
+            return
+        entry.unchanged = 0
+        entry.failures = 0
+        # Running or about to run, it will be rescheduled with the configured interval when it finishes
+        if entry.state != SCHEDULED:
+            return
+        due = time.time() + self.boost_delay
+        if due < entry.due:
+            self._schedule(entry, due)
+
+    def interval(self, entry):
+        steps = max(entry.failures, entry.device.connect_errors) or entry.unchanged
+        interval = entry.interval * min(self.backoff ** steps, self.max_backoff)
+        if self.jitter:
+            interval *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return interval
+
+    def _schedule(self, entry, due):
+        # Rescheduled entries are left in the heap and skipped when they come up
+        entry.state = SCHEDULED
+        entry.due = due
+        heapq.heappush(self._heap, (due, next(self._seq), entry))
+        self._arm()
+
+    def _peek(self):
+        while self._heap:
+            due, _, entry = self._heap[0]
+            if entry.state == SCHEDULED and entry.due == due:
+                return due
+            heapq.heappop(self._heap)
+        return None
+
+    def _arm(self):
+        # A single timer, for the earliest refresh
+        due = self._peek()
+        if due is None or (self._timer is not None and self._timer_due <= due):
+            return
+        if self._timer is not None:
+            cancel_timeout(self._timer)
+        self._timer_due = due
+        self._timer = set_timeout(self._on_timer, max(0, due - time.time()))
+
+    def _on_timer(self):
+        self._timer = None
+        now = time.time()
+        while True:
+            due = self._peek()
+            if due is None or due > now:
+                break
+            entry = heapq.heappop(self._heap)[2]
+            entry.state = READY
+            self._ready.append(entry)
+        try:
+            self._start_ready()
+        finally:
+            self._arm()
+
+    def _start_ready(self):
+        # Refreshes that finish right away would start the next one from inside this loop, so let the loop do it
+        if self._starting:
+            return
+        self._starting = True
+        try:
+            while self._ready and self.running < self.max_concurrent:
+                self._refresh(self._ready.popleft())
+        finally:
+            self._starting = False
+
+    def _refresh(self, entry):
+        dev = entry.device
+        if dev.discovery_status != 'online':
+            return self._schedule(entry, time.time() + self.interval(entry))
+
+        debugf("INFO", "Refreshing device {} status...", dev.id)
+        entry.state = RUNNING
+        self.running += 1
+        previous = dev.switch_status
+        finished = []
+        def _on_status(err, *args):
+            if finished:
+                return
+            finished.append(True)
+            self.running -= 1
+            if err:
+                result = 'error'
+                entry.failures += 1
+            elif dev.switch_status != previous:
+                result = 'changed'
+                entry.failures = entry.unchanged = 0
+            else:
+                result = 'unchanged'
+                entry.failures = 0
+                entry.unchanged += 1
+            REFRESHES.labels(result).inc()
+            self._schedule(entry, time.time() + self.interval(entry))
+            self._start_ready()
+        try:
+            dev.get_status(_on_status, ctx={'origin': 'refresh'}, ignore_cache=True)
+        except Exception as e:
+            debugf("ERRO", "Error refreshing device {} status: {}", dev.id, e)
+            _on_status(e)
+
+
+class RefreshEntry(object):
+    __slots__ = ('device', 'interval', 'due', 'state', 'unchanged', 'failures')
+
+    def __init__(self, device, interval):
+        self.device = device
+        self.interval = interval
+        self.due = None
+        self.state = None
+        self.unchanged = 0
+        self.failures = 0
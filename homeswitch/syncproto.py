@@ -1,21 +1,59 @@
+from collections import deque, OrderedDict
+from errno import EAGAIN, EWOULDBLOCK
+import itertools
 import json
 from pymitter import EventEmitter
 import socket
 import time
-import uuid
 
-from .asyncorepp import set_timeout, cancel_timeout
-from .util import DO_NOTHING, debug, dump, current_stack
+from .expirableq import ExpirableQueue, ExpirableItem
+from . import metrics
+from .util import DO_NOTHING, debug, debugf, current_stack
 
 
+# Sequence numbers are written as signed 32-bit integers
+MAX_SEQUENCE = 0x7fffffff
+# How many sequence numbers of commands that timed out are remembered (to recognise their late replies)
+EXPIRED_SEQUENCES = 32
+COMMAND_IDS = itertools.count(1)
+
+COMMAND_RTT = metrics.histogram('homeswitch_device_command_seconds', 'Time between sending a command to a device and getting its reply', ('device', 'command'))
+COMMAND_TIMEOUTS = metrics.counter('homeswitch_device_command_timeouts_total', 'Commands that got no reply in time', ('device',))
+QUEUE_DEPTH = metrics.gauge('homeswitch_device_queue_depth', 'Commands waiting to be sent or waiting for a reply', ('device',))
+
 class SyncProto(EventEmitter):
-    def __init__(self, async_socket, encoder_and_sender, reader_and_decoder, timeout=None):
+    """
+    Sends queued commands through a socket and matches the replies back to them.
+    By default only one command is in flight at a time (stop-and-wait). With a `window` bigger than 1, up to that
+    number of commands are sent without waiting for replies. Every command gets a sequence number and, if the decoder
+    sets `reply_sequence` with the sequence number of a reply, replies are matched by it (otherwise in sending order).
+    Messages the device sends on its own are emitted as 'push' (and never taken as replies): the ones arriving when no
+    command is waiting for a reply and, if the decoder sets `reply_command`, the ones with a command in `push_commands`
+    and a sequence number that isn't waiting for a reply.
+    Commands that time out after being sent free their slot in the window. Their late replies are dropped if they can
+    be recognised by their sequence number; otherwise the connection is reset (with a 'receive_error'), since a late
+    reply would be taken as the reply to the next command.
+    """
+    def __init__(self, async_socket, encoder_and_sender, reader_and_decoder, timeout=None, window=1, name=None, push_commands=()):
         EventEmitter.__init__(self)
         self.socket = async_socket
         self.id = None
+        self.name = name
         self.encode_and_send = encoder_and_sender
         self.receive_and_decode = reader_and_decoder
-        self.command_queue = []
+        self.command_queue = ExpirableQueue()
+        self.command_queue.on('expire', self._on_command_expire)
+        self.queued_by_key = {}
+        self.last_queued = None
+        self.in_flight = OrderedDict()
+        self.window = max(1, int(window))
+        self.sequence = 0
+        self.reply_sequence = None
+        self.reply_command = None
+        self.push_commands = push_commands
+        # Whether the decoder tells the sequence numbers of replies (we only know after getting one)
+        self.sequenced_replies = False
+        self.expired_sequences = deque(maxlen=EXPIRED_SEQUENCES)
         self.buffer = bytearray()
 
         async_socket.on('connect', self._on_connect)
@@ -23,102 +61,188 @@ class SyncProto(EventEmitter):
         async_socket.on('disconnect', self._on_disconnect)
         async_socket.on('data', self._on_data)
         self.on('_next', self._on_can_send_next_command)
+        if name is not None:
+            QUEUE_DEPTH.labels(name).set_function(self.__len__)
 
     def _on_connect(self):
         self.id = '{}:{}'.format(self.socket.ip, self.socket.port)
-        debug("DBUG", "Detected connect on socket {}".format(self.id))
+        debugf("DBUG", "Detected connect on socket {}", self.id)
+        # Nothing sent through a previous connection will be replied on this one
+        self._requeue_in_flight()
         self.emit('_next')
 
     def _on_disconnect(self):
-        # If the connection broke while we were waiting for a reply, change it's status to 'waiting' so it can be resent
-        debug("DBUG", "Detected disconnect on socket {}".format(self.id))
-        if len(self.command_queue) > 0 and self.command_queue[0].status == 'sent':
-            self.command_queue[0].status = 'waiting'
+        # If the connection broke while we were waiting for replies, put those commands back so they can be resent
+        debugf("DBUG", "Detected disconnect on socket {}", self.id)
+        self._requeue_in_flight()
+
+    def _requeue_in_flight(self):
+        if len(self.in_flight) == 0:
+            return
+        commands = list(self.in_flight.values())
+        self.in_flight.clear()
+        # Commands that expired meanwhile were already replied, so they're not resent
+        for cmd in reversed(commands):
+            if self.command_queue.unshift(cmd):
+                cmd.status = 'waiting'
+
+    def _on_command_expire(self, cmd, was_queued):
+        if was_queued:
+            debug("WARN", "Found an expired command that should be sent to {}. Ignoring: ".format(self.id), cmd)
+            self._forget_key(cmd)
+        COMMAND_TIMEOUTS.labels(self.name or self.id).inc()
+        cmd.reply({'error': 'command_timeout', 'descriptor': 'Waited too long for the device to respond'}, None)
+        if not was_queued and self.in_flight.get(cmd.sequence) is cmd:
+            self._on_in_flight_expire(cmd)
+
+    def _on_in_flight_expire(self, cmd):
+        # The command won't be replied anymore, so it stops taking a slot in the window
+        del self.in_flight[cmd.sequence]
+        if not self.sequenced_replies:
+            debugf("WARN", "Command {} sent to {} timed out and its reply can't be told apart. Resetting the connection", cmd.id, self.id)
+            self._requeue_in_flight()
+            return self.emit('receive_error', ValueError('Command {} timed out'.format(cmd.id)))
+        self.expired_sequences.append(cmd.sequence)
+        self.emit('_next')
 
     def _on_data(self):
         while self.socket.connected:
+            self.reply_sequence = None
+            self.reply_command = None
             try:
                 reply = self.receive_and_decode(self)
                 if reply is None:
                     return
-                if type(reply) is str and reply == '':
+                # Empty replies are skipped, unless that's what the command waits for (like a heartbeat)
+                if type(reply) is str and reply == '' and not self._expects_empty_reply():
                     continue
             except ValueError as e:
                 debug("ERRO", "Error reading and parsing message:", e)
-                if len(self.command_queue) > 0:
-                    cmd = self.command_queue[0]
-                    if cmd.status != 'sent':
-                        raise Exception('The first queue message object is NOT in "sent" state. State: {}. Oh god...'.format(cmdstatus))
-                    cmd.status = 'waiting'
+                self._requeue_in_flight()
                 self.emit('receive_error', e)
+                return
+
+            if self.reply_sequence is not None:
+                self.sequenced_replies = True
+                if self.reply_sequence in self.expired_sequences:
+                    self.expired_sequences.remove(self.reply_sequence)
+                    debugf("DBUG", "Got a late reply from {} to a command that timed out:", self.id, reply)
+                    if self.reply_command in self.push_commands:
+                        self.emit('push', reply)
+                    continue
+
+            if len(self.in_flight) == 0:
+                debugf("DBUG", "Got a message from {} with no command waiting for a reply:", self.id, reply)
+                self.emit('push', reply)
+                continue
+            if self.reply_command in self.push_commands and self.reply_sequence not in self.in_flight:
+                debugf("DBUG", "Got a message from {} that isn't a reply to any command:", self.id, reply)
+                self.emit('push', reply)
+                continue
 
             # Get the sent message object and call its callback
-            cmd = self.command_queue.pop(0)
-            if cmd.status != 'sent':
-                raise Exception('The first queue message object is NOT in "sent" state. State: {}'.format(cmd.status))
+            cmd = self._match_reply()
+            self.command_queue.done(cmd)
+            COMMAND_RTT.labels(self.name or self.id, cmd.message.get('command')).observe(time.time() - cmd.sent_at)
             cmd.reply(None, reply)
+            self.emit('reply')
             self.emit('_next')
 
+    def _expects_empty_reply(self):
+        if self.reply_sequence is not None and self.reply_sequence in self.in_flight:
+            cmd = self.in_flight[self.reply_sequence]
+        elif len(self.in_flight) > 0:
+            cmd = next(iter(self.in_flight.values()))
+        else:
+            return False
+        return cmd.message.get('empty_reply', False)
+
+    def _match_reply(self):
+        if self.reply_sequence is not None and self.reply_sequence in self.in_flight:
+            return self.in_flight.pop(self.reply_sequence)
+        if len(self.in_flight) > 0:
+            return self.in_flight.popitem(last=False)[1]
+        return None
 
     def _on_can_send_next_command(self):
-        debug("DBUG", "We can send next command to {}!!!".format(self.id))
-        cmd = self._get_next_command()
-        if cmd is None:
-            debug("DBUG", "No more commands in the queue for {}...".format(self.id))
-            return self.emit('drain')
-
-        debug("DBUG", "Sending '{}' command to {}...".format(cmd.message.get('command'), self.id))
-        if cmd.status == 'waiting':
+        debugf("DBUG", "We can send next command to {}!!!", self.id)
+        while len(self.in_flight) < self.window:
+            cmd = self.command_queue.peek()
+            if cmd is None:
+                if len(self.in_flight) == 0:
+                    debugf("DBUG", "No more commands in the queue for {}...", self.id)
+                    self.emit('drain')
+                return
+
+            debugf("DBUG", "Sending '{}' command to {}...", cmd.message.get('command'), self.id)
+            sequence = self._next_sequence()
+            cmd.message['sequenceN'] = sequence
             try:
                 self.encode_and_send(cmd.message)
-                cmd.status = 'sent'
             except socket.error as e:
-                debug("DBUG", "Error sending message to device {}: ".format(self.id), e)
+                debugf("DBUG", "Error sending message to device {}: ", self.id, e)
                 self.emit('send_error', e)
-        else:
-            debug("WARN", "I was told I could process the next queued item but the item is not in 'waiting' state")
-
-    def _get_next_command(self):
-        while len(self.command_queue) > 0:
-            cmd = self.command_queue[0]
-            if cmd.expires is not None:
-                if cmd.expires == -1: # already expired and replied
-                    debug("WARN", "Found an expired and replied command that should have been sent to {}. Ignoring: ".format(self.id), cmd)
-                    self.command_queue.pop(0)
-                    continue                    
-                if cmd.expires < time.time():
-                    debug("WARN", "Found an expired command that should be sent to {}. Ignoring: ".format(self.id), cmd)
-                    self.command_queue.pop(0)
-                    cmd.reply({'error': 'command_timeout', 'descriptor': 'Was about to process this command but it expired'}, None)
-                    continue
-            return cmd
-        return None
+                return
+            self.command_queue.shift()
+            self._forget_key(cmd)
+            cmd.status = 'sent'
+            cmd.sequence = sequence
+            cmd.sent_at = time.time()
+            self.in_flight[sequence] = cmd
+
+    def _next_sequence(self):
+        self.sequence = self.sequence + 1 if self.sequence < MAX_SEQUENCE else 1
+        return self.sequence
+
+    def _forget_key(self, cmd):
+        if cmd.key is not None and self.queued_by_key.get(cmd.key) is cmd:
+            del self.queued_by_key[cmd.key]
 
     def __len__(self):
-        return len(self.command_queue)
+        return len(self.command_queue) + len(self.in_flight)
 
     def is_dry(self):
-        return len(self.command_queue) == 0
+        return len(self.command_queue) == 0 and len(self.in_flight) == 0
 
     def go(self):
         return self.emit('_next')
 
     def flush(self, err, reply):
-        while len(self.command_queue) > 0:
-            cmd = self.command_queue.pop(0)
+        commands = list(self.in_flight.values()) + self.command_queue.clear()
+        self.in_flight.clear()
+        self.queued_by_key = {}
+        self.last_queued = None
+        for cmd in commands:
             if err is not None or reply is not None:
                 cmd.reply(err, reply)
 
-    def append(self, message, callback=DO_NOTHING, timeout=None):
+    def append(self, message, callback=DO_NOTHING, timeout=None, key=None, replace=False):
+        # Commands with a `key` are coalesced with a command with the same key that is still waiting to be sent, as long
+        # as it's the last one queued (so commands are never reordered, like a get jumping ahead of a set): the
+        # callback is attached to the queued command and, if `replace` is set, the queued message is replaced by this
+        # one, so every caller gets the result of the most recent message.
+        if key is not None:
+            queued = self.queued_by_key.get(key, None)
+            if queued is not None and queued is self.last_queued and not queued.responded:
+                debugf("DBUG", "Coalescing '{}' command to {} with a queued one", message.get('command'), self.id)
+                if replace:
+                    queued.message = message
+                queued.callback.append(callback)
+                return queued.id
+
         cmd = SyncProtoCommand(
             status = 'waiting',
             message = message,
             callback = callback,
-            timeout = timeout
+            timeout = timeout,
+            key = key,
         )
 
-        # Append the command
+        # Append the command (the queue takes care of expiring it)
         self.command_queue.append(cmd)
+        self.last_queued = cmd
+        if key is not None:
+            self.queued_by_key[key] = cmd
 
         return cmd.id
 
@@ -136,8 +260,9 @@ class SyncProto(EventEmitter):
         except socket.timeout as e:
             return None
         except socket.error as e:
-            if e.errno == 35: # Resource temporarily unavailable
+            if e.errno in (EAGAIN, EWOULDBLOCK): # Resource temporarily unavailable
                 return None
+            raise
         self.buffer.extend(data)
 
         # Check again
@@ -152,23 +277,25 @@ class SyncProto(EventEmitter):
         self.buffer = bytearray(data) + self.buffer
 
 
-class SyncProtoCommand(object):
-    def __init__(self, status='unknown', message='', callback=DO_NOTHING, timeout=None):
-        self.id = uuid.uuid4()
+class SyncProtoCommand(ExpirableItem):
+    __slots__ = ('id', 'key', 'sequence', 'status', 'message', 'callback', 'responded', 'sent_at')
+
+    def __init__(self, status='unknown', message='', callback=DO_NOTHING, timeout=None, key=None):
+        ExpirableItem.__init__(self, timeout=timeout)
+        self.id = next(COMMAND_IDS)
+        self.key = key
+        self.sequence = None
+        self.sent_at = None
         self.status = status
         self.message = message
         self.callback = [callback]
         self.responded = False
-        self.expires = time.time() + timeout if timeout is not None else None
-        self.timeout = None
-        self._responded = ''
-        if timeout:
-            self.timeout = set_timeout(lambda: self.reply({'error': 'command_timeout', 'descriptor': 'Waited too long for the device to respond'}, None), timeout)
 
     def __repr__(self):
         return json.dumps({
-            'id': str(self.id),
+            'id': self.id,
             'status': self.status,
+            'sequence': self.sequence,
             'message': self.message,
             'callback': '[Function]',
             'responded': self.responded,
@@ -178,16 +305,9 @@ class SyncProtoCommand(object):
     def reply(self, *args):
         if self.responded:
             debug("WARN", "Command's {} was already called. Stopping another reply here".format(self.id))
-            dump("DBUG", "FIRST CALL:\n{}\nSECOND CALL:\n{}\n".format(self._responded, current_stack()))
+            debugf("DBUG", "SECOND CALL:\n{}", current_stack())
             return
 
         self.responded = True
-        self._responded = current_stack()
-
-        # Stop the timeout
-        if self.timeout:
-            cancel_timeout(self.timeout)
-
-        callback = self.callback[0]
-        return callback(*args)
-
+        for callback in self.callback:
+            callback(*args)
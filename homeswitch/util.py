@@ -1,10 +1,22 @@
+import atexit
 import binascii
 import struct
 from datetime import datetime
+import threading
 import traceback
 import sys
 
 
+LOG_LEVELS = {
+    'DBUG': 10,
+    'INFO': 20,
+    'WARN': 30,
+    'ERRO': 40,
+}
+# Messages from these levels are written right away even if the log output is buffered
+URGENT_LOG_LEVEL = LOG_LEVELS['WARN']
+
+
 def bin2hex(data):
     return binascii.hexlify(data)
 
@@ -41,16 +53,123 @@ def ucfirst(value):
     return value[0].upper()+value[1:]
 
 
+class LogSink(object):
+    """
+    Where the log lines go. By default every line is written and flushed right away. With a `buffer_size`, lines are
+    kept until there are that many bytes of them, a WARN or ERRO line comes in or flush() is called (asyncorepp.loop()
+    does it after every iteration). With `background`, a thread does the writing every `flush_interval` seconds and the
+    loop leaves it alone.
+    """
+    def __init__(self, stream=None, buffer_size=0, flush_interval=1.0, background=False):
+        self.stream = stream
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.pending_size = 0
+        # `lock` guards the pending lines, `flush_lock` keeps flushes from different threads in order
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.writer = None
+        self.wakeup = None
+        if background:
+            self.wakeup = threading.Event()
+            self.writer = threading.Thread(target=self._write_in_background, name='log-writer')
+            self.writer.daemon = True
+            self.writer.start()
+
+    def write(self, line, urgent=False):
+        if self.writer is None and self.buffer_size <= 0:
+            stream = self.stream or sys.stdout
+            stream.write(line + '\n')
+            stream.flush()
+            return
+        with self.lock:
+            self.pending.append(line)
+            self.pending_size += len(line) + 1
+            full = self.pending_size >= self.buffer_size
+        if urgent or full:
+            if self.writer is not None:
+                self.wakeup.set()
+            else:
+                self.flush()
+
+    @property
+    def in_background(self):
+        return self.writer is not None
+
+    def flush(self):
+        with self.flush_lock:
+            # The lines are taken under the lock and written without it, so writing doesn't hold back new lines
+            with self.lock:
+                lines = self.pending
+                self.pending = []
+                self.pending_size = 0
+            if not lines:
+                return
+            stream = self.stream or sys.stdout
+            stream.write('\n'.join(lines) + '\n')
+            stream.flush()
+
+    def _write_in_background(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+
+_log_min_level = LOG_LEVELS['DBUG']
+_log_sink = LogSink()
+
+
+def configure_logging(level='DBUG', buffer_size=0, flush_interval=1.0, background=False, stream=None):
+    global _log_min_level, _log_sink
+    if level not in LOG_LEVELS:
+        raise ValueError('Unknown log level {} (use one of {})'.format(level, ', '.join(sorted(LOG_LEVELS, key=LOG_LEVELS.get))))
+    _log_sink.flush()
+    _log_min_level = LOG_LEVELS[level]
+    _log_sink = LogSink(stream=stream, buffer_size=buffer_size, flush_interval=flush_interval, background=background)
+
+
+def log_enabled(type):
+    return LOG_LEVELS.get(type, URGENT_LOG_LEVEL) >= _log_min_level
+
+
+def flush_log():
+    _log_sink.flush()
+
+
+def log_in_background():
+    return _log_sink.in_background
+
+
+atexit.register(flush_log)
+
+
 def debug(type, pattern, *args):
-    pattern = '{}: [{}] ' + pattern.replace('{', '{{').replace('}', '}}')
-    for arg in args:
-        pattern += ' {}'
-
-    values = [type]
-    values.extend(args)
-    values.insert(0, str(datetime.utcnow())+'Z')
-    print(pattern.format(*values))
-    sys.stdout.flush()
+    # Arguments are only turned into strings if the level is enabled
+    level = LOG_LEVELS.get(type, URGENT_LOG_LEVEL)
+    if level < _log_min_level:
+        return
+    line = '{}Z: [{}] {}'.format(datetime.utcnow(), type, pattern)
+    if args:
+        line += ''.join([' {}'.format(arg) for arg in args])
+    _log_sink.write(line, level >= URGENT_LOG_LEVEL)
+
+
+def debugf(type, pattern, *args):
+    # Like debug(), but the first arguments fill the {} in the pattern (only if the level is enabled).
+    # The arguments left are appended to the message, just like debug() does.
+    level = LOG_LEVELS.get(type, URGENT_LOG_LEVEL)
+    if level < _log_min_level:
+        return
+    placeholders = pattern.count('{}')
+    line = '{}Z: [{}] {}'.format(datetime.utcnow(), type, pattern.format(*args[:placeholders]))
+    if len(args) > placeholders:
+        line += ''.join([' {}'.format(arg) for arg in args[placeholders:]])
+    _log_sink.write(line, level >= URGENT_LOG_LEVEL)
 
 
 def dump(type, data):
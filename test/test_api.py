@@ -0,0 +1,118 @@
+import socket
+
+from homeswitch.api import HomeSwitchAPI, REQUEST_LATENCY
+from homeswitch.hybridserver import HybridServerClient
+from homeswitch.util import dict_to_obj
+
+
+def _request(proto, method, url=None):
+    return dict_to_obj({'proto': proto, 'method': method, 'url': url, 'received_at': 0})
+
+
+def test_only_known_routes_and_methods_are_request_labels():
+    api = HomeSwitchAPI(port=0)
+    REQUEST_LATENCY.clear()
+    api.on_reply(None, _request('http', 'GET', '/api/metrics?format=json'), {})
+    api.on_reply(None, _request('http', 'GET', '/random/12345'), {'error': 'not_found'})
+    api.on_reply(None, _request('http', 'BOGUS', '/api/metrics'), {'error': 'not_found'})
+    api.on_reply(None, _request('http', None, None), {'error': 'request_error'})
+    api.on_reply(None, _request('hs', 'whatever'), {'error': 'auth'})
+    api.on_reply(None, _request('hs', 'get'), {})
+    assert sorted(REQUEST_LATENCY.children.keys()) == [
+        ('hs', 'get', 'ok'),
+        ('hs', 'other', 'auth'),
+        ('http', 'GET', 'not_found'),
+        ('http', 'GET /api/metrics', 'ok'),
+        ('http', 'other', 'not_found'),
+        ('http', 'other', 'request_error'),
+    ]
+
+
+def test_metrics_requests_are_in_the_metrics():
+    api = HomeSwitchAPI(port=0)
+    REQUEST_LATENCY.clear()
+    a, b = socket.socketpair()
+    client = HybridServerClient(a, api.server)
+    b.send(b'GET /api/metrics HTTP/1.1\r\nHost: x\r\n\r\n')
+    client.handle_read()
+    client.handle_write()
+    assert b.recv(65536).startswith(b'HTTP/1.1 200 OK')
+    assert list(REQUEST_LATENCY.children.keys()) == [('http', 'GET /api/metrics', 'ok')]
+    client.close()
+    b.close()
+
+
+class FakeDevice(object):
+    def __init__(self, id, hooks):
+        self.id = id
+        self.hooks = hooks
+
+    def json(self):
+        return {'id': self.id}
+
+
+class FakeHooksClient(object):
+    def __init__(self):
+        self.sent = []
+
+    def notify_all(self, hook_name, notif_type, data_list):
+        self.sent.append((hook_name, notif_type, data_list))
+
+
+def test_every_status_change_is_broadcast_and_sent_to_the_hooks_together():
+    api = HomeSwitchAPI(port=0)
+    api.devices = {'a': FakeDevice('a', ['slack', 'opentsdb']), 'b': FakeDevice('b', ['opentsdb'])}
+    api.hooks_client = FakeHooksClient()
+    broadcasts = []
+    api.server.broadcast = broadcasts.append
+    api._queue_status_update('a', True, {'origin': 'user'})
+    api._queue_status_update('b', True, {'origin': 'device'})
+    api._queue_status_update('a', False, {'origin': 'refresh'})
+    api._queue_status_update('a', True, {'origin': 'user'})
+    api._flush_status_updates()
+
+    assert broadcasts == [
+        {'devices': {'a': {'status': True, 'ctx': {'origin': 'user'}}, 'b': {'status': True, 'ctx': {'origin': 'device'}}}},
+        {'devices': {'a': {'status': False, 'ctx': {'origin': 'refresh'}}}},
+        {'devices': {'a': {'status': True, 'ctx': {'origin': 'user'}}}},
+    ]
+    assert [(hook, len(data)) for hook, _, data in api.hooks_client.sent] == [('slack', 3), ('opentsdb', 4)]
+    opentsdb = api.hooks_client.sent[1][2]
+    assert [(d['device']['id'], d['status'], d['ctx']['origin']) for d in opentsdb] == [
+        ('a', True, 'user'), ('b', True, 'device'), ('a', False, 'refresh'), ('a', True, 'user'),
+    ]
+
+
+class BrokenDevice(FakeDevice):
+    read_mode = 'device'
+
+    def get_status(self, callback, ctx=None):
+        raise Exception('Device {} has NO IP address yet'.format(self.id))
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.replies = []
+
+    def reply(self, data, req=None):
+        self.replies.append(data)
+
+
+class FakeRequest(object):
+    proto = 'hs'
+
+    def __init__(self, method, body):
+        self.method = method
+        self.body = body
+
+    def get_ctx(self):
+        return {}
+
+
+def test_device_errors_are_replied_as_internal_errors():
+    api = HomeSwitchAPI(port=0)
+    api.devices = {'a': BrokenDevice('a', [])}
+    client = FakeClient()
+    req = FakeRequest('get', {'devices': ['a']})
+    api.on_hs_request(client, req, None)
+    assert client.replies == [{'error': 'internal', 'description': 'Device a has NO IP address yet'}]
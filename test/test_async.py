@@ -0,0 +1,84 @@
+import time
+
+from homeswitch import async, asyncorepp
+
+
+def test_limiter_respects_global_and_per_key_limits():
+    limiter = async.Limiter(limit=2, per_key_limit=1)
+    started = []
+    finish = {}
+
+    def task(name):
+        def run(done):
+            started.append(name)
+            finish[name] = done
+        return run
+
+    limiter.run('a', task('a1'))
+    limiter.run('a', task('a2'))
+    limiter.run('b', task('b1'))
+    limiter.run('c', task('c1'))
+    assert started == ['a1', 'b1']
+
+    finish['a1']()
+    assert started == ['a1', 'b1', 'a2']
+    finish['b1']()
+    finish['b1']()
+    assert started == ['a1', 'b1', 'a2', 'c1']
+    assert limiter.running == 2
+
+
+def test_each_limit_handles_synchronous_tasks_without_recursing():
+    limiter = async.Limiter(limit=1)
+    items = range(5000)
+    final = []
+    async.each_limit(items, lambda item, callback: callback(None, item * 2), lambda err, results: final.append(results),
+                     limiter=limiter, key=lambda item: item)
+    assert final == [[(item * 2,) for item in items]]
+    assert limiter.running == 0
+
+
+def test_each_limit_streams_results_and_stops_at_the_deadline():
+    asyncorepp.TIMERS.clear()
+    del asyncorepp._TIMER_HEAP[:]
+    limiter = async.Limiter(limit=1)
+    pending = []
+    streamed = []
+    final = []
+
+    def each(item, callback):
+        if item == 'fast':
+            return callback(None, item, 1)
+        pending.append(callback)
+
+    async.each_limit(['fast', 'slow', 'never'], each, lambda err, results: final.append(results), limiter=limiter,
+                     key=lambda item: item, deadline=0.01, on_result=lambda idx, *results: streamed.append(results))
+    assert streamed == [('fast', 1)]
+    assert final == []
+
+    time.sleep(0.02)
+    asyncorepp._check_timers()
+    assert final == [[('fast', 1), None, None]]
+    # The item that never started is cancelled, the one running finishes (and frees its slot) later
+    assert len(limiter.waiting) == 0
+    pending[0](None, 'slow', 2)
+    assert limiter.running == 0 and len(pending) == 1
+    assert final == [[('fast', 1), None, None]]
+
+
+def test_each_limit_fails_the_items_whose_task_raises():
+    limiter = async.Limiter(limit=1)
+    final = []
+
+    def each(item, callback):
+        if item == 'broken':
+            raise Exception('has NO IP address yet')
+        callback(None, item)
+
+    async.each_limit(['ok', 'broken', 'never'], each, lambda err, results: final.append((err, results)), limiter=limiter,
+                     key=lambda item: item)
+    assert len(final) == 1
+    err, results = final[0]
+    assert str(err) == 'has NO IP address yet'
+    assert results == [('ok',), None, None]
+    assert limiter.running == 0 and len(limiter.waiting) == 0
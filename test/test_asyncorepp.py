@@ -0,0 +1,128 @@
+import asyncore
+import select
+import socket
+import time
+
+from homeswitch import asyncorepp
+
+
+def _reset():
+    asyncorepp.TIMERS.clear()
+    del asyncorepp._TIMER_HEAP[:]
+
+
+def test_timers_fire_in_deadline_order():
+    _reset()
+    calls = []
+    asyncorepp.set_timeout(lambda: calls.append('b'), 0.02)
+    asyncorepp.set_timeout(lambda: calls.append('a'), 0.01)
+    time.sleep(0.03)
+    asyncorepp._check_timers()
+    assert calls == ['a', 'b']
+    assert len(asyncorepp.TIMERS) == 0
+
+
+def test_cancelled_timeout_does_not_fire():
+    _reset()
+    calls = []
+    timer_id = asyncorepp.set_timeout(lambda: calls.append(1), 0)
+    asyncorepp.cancel_timeout(timer_id)
+    asyncorepp._check_timers()
+    assert calls == []
+    assert asyncorepp.next_timer() is None
+
+
+def test_interval_is_rescheduled():
+    _reset()
+    calls = []
+    timer_id = asyncorepp.set_interval(lambda: calls.append(1), 0.01)
+    time.sleep(0.015)
+    asyncorepp._check_timers()
+    assert calls == [1]
+    assert timer_id in asyncorepp.TIMERS
+    assert asyncorepp.next_timer() > time.time()
+    asyncorepp.cancel_interval(timer_id)
+    assert timer_id not in asyncorepp.TIMERS
+
+
+def test_poll_timeout_follows_next_deadline():
+    _reset()
+    assert asyncorepp._poll_timeout(1) == 1
+    asyncorepp.set_timeout(lambda: None, 0.2)
+    assert 0 < asyncorepp._poll_timeout(1) <= 0.2
+    asyncorepp.set_timeout(lambda: None, -1)
+    assert asyncorepp._poll_timeout(1) == 0
+
+
+class _Reader(asyncore.dispatcher):
+    def __init__(self, sock, map):
+        asyncore.dispatcher.__init__(self, sock, map=map)
+        self.data = b''
+
+    def handle_read(self):
+        self.data += self.recv(1024)
+
+    def writable(self):
+        return False
+
+
+def test_epoll_poller_keeps_registrations():
+    if not hasattr(select, 'epoll'):
+        return
+    map = {}
+    a, b = socket.socketpair()
+    reader = _Reader(a, map)
+    poller = asyncorepp.EpollPoller()
+
+    poller.poll(0, map)
+    assert poller.registered[a.fileno()] == (reader, select.EPOLLIN | select.EPOLLPRI)
+
+    b.send(b'hello')
+    poller.poll(1, map)
+    assert reader.data == b'hello'
+
+    reader.close()
+    poller.poll(0, map)
+    assert poller.registered == {}
+    b.close()
+
+
+def test_every_poller_handles_events_and_measures_its_wait():
+    pollers = [asyncorepp.SelectPoller(), asyncorepp.PollPoller()]
+    if hasattr(select, 'epoll'):
+        pollers.append(asyncorepp.EpollPoller())
+    for poller in pollers:
+        map = {}
+        a, b = socket.socketpair()
+        reader = _Reader(a, map)
+        poller.poll(0.05, map)
+        assert poller.last_wait >= 0.04
+        b.send(b'hello')
+        poller.poll(1, map)
+        assert reader.data == b'hello'
+        assert poller.last_wait < 0.5
+        reader.close()
+        b.close()
+
+def test_monitor_reports_slow_and_late_timers():
+    _reset()
+    monitor = asyncorepp.MONITOR
+    monitor.lateness.clear()
+    slow = asyncorepp.SLOW_CALLBACKS
+    asyncorepp.set_timeout(lambda: time.sleep(0.02), 0)
+    time.sleep(0.01)
+    previous, monitor.slow_callback_threshold = monitor.slow_callback_threshold, 0.01
+    try:
+        asyncorepp._check_timers()
+    finally:
+        monitor.slow_callback_threshold = previous
+
+    assert len(monitor.lateness) == 1 and monitor.lateness[0] >= 0.01
+    names = [values[0] for values in slow.children]
+    assert any(name.split('.')[-2:-1] == ['test_asyncorepp'] and '<lambda>:' in name for name in names)
+
+
+def test_callable_names():
+    assert asyncorepp.callable_name(asyncorepp.set_timeout) == 'homeswitch.asyncorepp.set_timeout'
+    assert asyncorepp.callable_name(asyncorepp.MONITOR.stats) == 'homeswitch.asyncorepp.LoopMonitor.stats'
+    assert asyncorepp.callable_name(_Reader).endswith('test_asyncorepp._Reader')
@@ -0,0 +1,74 @@
+from pymitter import EventEmitter
+
+from homeswitch.async import Limiter
+from homeswitch.device import Device
+
+
+class FakeHW(EventEmitter):
+    def __init__(self):
+        EventEmitter.__init__(self)
+        self.callbacks = []
+
+    def get_status(self, callback, ctx):
+        self.callbacks.append(callback)
+
+
+def _device(**config):
+    dev = Device(id='dev1', config=config, discovery_status='online')
+    dev.hw = FakeHW()
+    return dev
+
+
+def test_snapshot_has_no_age_until_the_status_is_known():
+    dev = _device()
+    assert dev.snapshot() == (None, None)
+    assert dev.is_stale(None)
+
+    dev.get_status()
+    dev.hw.callbacks.pop()(None, True)
+    status, age = dev.snapshot()
+    assert status is True
+    assert 0 <= age < 1
+    assert not dev.is_stale(age)
+
+
+def test_snapshot_age_is_relative_to_the_last_known_status():
+    dev = _device(snapshot_max_age=5)
+    dev._on_status_update(False)
+    status, age = dev.snapshot(now=dev.status_known_at + 10)
+    assert status is False
+    assert age == 10
+    assert dev.is_stale(age)
+    assert not dev.is_stale(age, max_age=20)
+
+
+def test_revalidate_refreshes_only_once_at_a_time():
+    dev = _device()
+    tasks = []
+    assert dev.revalidate(tasks.append)
+    assert not dev.revalidate(tasks.append)
+    assert len(tasks) == 1
+
+    done = []
+    tasks[0](lambda: done.append(True))
+    dev.hw.callbacks.pop()(None, True)
+    assert done == [True]
+    assert dev.switch_status is True
+    assert dev.revalidate(tasks.append)
+
+
+def test_revalidate_can_run_again_after_a_failed_refresh():
+    dev = _device()
+    def _broken_get_status(callback, ctx):
+        raise Exception('NO IP address')
+    dev.hw.get_status = _broken_get_status
+    limiter = Limiter(limit=1)
+    assert dev.revalidate(lambda task: limiter.run(dev.id, task))
+    assert not dev.revalidating
+    assert limiter.running == 0
+    assert dev.revalidate(lambda task: limiter.run(dev.id, task))
+
+def test_offline_devices_are_not_revalidated():
+    dev = _device()
+    dev.discovery_status = 'offline'
+    assert not dev.revalidate()
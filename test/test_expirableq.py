@@ -0,0 +1,71 @@
+import time
+
+from homeswitch import asyncorepp
+from homeswitch.expirableq import ExpirableQueue, ExpirableItem
+
+
+def _reset():
+    asyncorepp.TIMERS.clear()
+    del asyncorepp._TIMER_HEAP[:]
+
+
+def test_items_are_shifted_in_order():
+    _reset()
+    q = ExpirableQueue()
+    q.push('a')
+    q.push('b')
+    assert len(q) == 2
+    assert q.shift().value == 'a'
+    assert q.shift().value == 'b'
+    assert q.shift() is None
+    assert len(q) == 0
+
+
+def test_queued_items_expire_with_a_single_timer():
+    _reset()
+    q = ExpirableQueue()
+    expired = []
+    q.on('expire', lambda item, was_queued: expired.append((item.value, was_queued)))
+    q.push('a', timeout=0.01)
+    q.push('b', timeout=0.02)
+    q.push('c')
+    assert len(asyncorepp.TIMERS) == 1
+
+    time.sleep(0.03)
+    asyncorepp._check_timers()
+    assert expired == [('a', True), ('b', True)]
+    assert len(q) == 1
+    assert q.shift().value == 'c'
+
+
+def test_shifted_items_expire_until_done():
+    _reset()
+    q = ExpirableQueue()
+    expired = []
+    q.on('expire', lambda item, was_queued: expired.append((item.value, was_queued)))
+    a = q.push('a', timeout=0.01)
+    b = q.push('b', timeout=0.01)
+    assert q.shift() is a
+    assert q.shift() is b
+    q.done(a)
+
+    time.sleep(0.02)
+    asyncorepp._check_timers()
+    assert expired == [('b', False)]
+    assert b.expired and not a.expired
+    # Expired items can't be put back in the queue
+    assert not q.unshift(b)
+
+
+def test_unshift_and_remove():
+    _reset()
+    q = ExpirableQueue()
+    a = q.append(ExpirableItem('a'))
+    b = q.append(ExpirableItem('b'))
+    assert q.shift() is a
+    assert q.unshift(a)
+    assert q.remove(b)
+    assert [item.value for item in q] == ['a']
+    assert len(q) == 1
+    assert q.clear() == [a]
+    assert len(q) == 0
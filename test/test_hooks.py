@@ -0,0 +1,440 @@
+import json
+import os
+import socket
+import threading
+import time
+
+from homeswitch import asyncorepp
+from homeswitch.hooks import HooksClient, HooksServer, HookMessage, MAX_DATAGRAM_SIZE, stream
+
+
+DEVICE = {
+    'id': 'dev1',
+    'switch_status': True,
+    'device_status': 'up',
+    'discovery_status': 'online',
+    'last_seen': 1,
+    'metadata': {'name': 'Lamp', 'room': 'x' * 100},
+    'hw_metadata': {'ip': '127.0.0.1'},
+}
+
+
+def _reset():
+    asyncorepp.TIMERS.clear()
+    del asyncorepp._TIMER_HEAP[:]
+
+
+def _receiver():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(1)
+    return sock
+
+
+def _recv_all(sock):
+    datagrams = []
+    sock.settimeout(0.1)
+    try:
+        while True:
+            datagrams.append(json.loads(sock.recv(MAX_DATAGRAM_SIZE)))
+    except socket.timeout:
+        return datagrams
+
+
+def test_notifications_are_sent_right_away_without_batching():
+    _reset()
+    sock = _receiver()
+    client = HooksClient({'port': sock.getsockname()[1]})
+    client.notify('slack', 'status_update', {'device': DEVICE, 'status': True})
+    datagrams = _recv_all(sock)
+    assert len(datagrams) == 1
+    assert datagrams[0]['data']['device'] == DEVICE
+
+
+def test_batched_notifications_keep_every_change():
+    _reset()
+    sock = _receiver()
+    client = HooksClient({'port': sock.getsockname()[1], 'batch_window': 0.05})
+    for status in (True, False, True):
+        client.notify('opentsdb', 'status_update', {'device': DEVICE, 'status': status})
+    client.flush()
+    datagrams = _recv_all(sock)
+    assert [n['data']['status'] for n in datagrams[0]['batch']] == [True, False, True]
+
+
+def test_batched_notifications_are_coalesced_and_compact():
+    _reset()
+    sock = _receiver()
+    client = HooksClient({'port': sock.getsockname()[1], 'batch_window': 0.05, 'coalesce_hooks': ['slack']})
+    client.notify('slack', 'status_update', {'device': DEVICE, 'status': True})
+    client.notify('slack', 'status_update', {'device': dict(DEVICE, id='dev2'), 'status': True})
+    client.notify('slack', 'status_update', {'device': DEVICE, 'status': False})
+    assert _recv_all(sock) == []
+
+    client.flush()
+    datagrams = _recv_all(sock)
+    assert len(datagrams) == 1
+    batch = datagrams[0]['batch']
+    assert [(n['data']['device']['id'], n['data']['status']) for n in batch] == [('dev2', True), ('dev1', False)]
+    assert batch[1]['data']['device'] == {
+        'id': 'dev1', 'name': 'Lamp', 'switch_status': True, 'device_status': 'up', 'discovery_status': 'online', 'last_seen': 1,
+    }
+    assert len(set(n['id'] for n in batch)) == 2
+    assert len(asyncorepp.TIMERS) == 0
+
+
+def test_batches_stay_under_the_datagram_size():
+    _reset()
+    sock = _receiver()
+    client = HooksClient({'port': sock.getsockname()[1], 'batch_window': 1, 'max_batch_size': 1000})
+    for i in range(40):
+        client.notify('slack', 'status_update', {'device': dict(DEVICE, id='dev{}'.format(i)), 'status': True})
+    client.flush()
+    sock.settimeout(0.1)
+    sizes = []
+    try:
+        while True:
+            sizes.append(len(sock.recv(MAX_DATAGRAM_SIZE)))
+    except socket.timeout:
+        pass
+    assert len(sizes) > 1
+    assert max(sizes) <= 1000
+
+
+def test_server_unpacks_batches():
+    _reset()
+    server = HooksServer(port=0)
+    server.socket.bind(('127.0.0.1', 0))
+    client = HooksClient({'port': server.socket.getsockname()[1], 'batch_window': 1})
+    client.notify('slack', 'status_update', {'device': DEVICE, 'status': True})
+    client.notify('slack', 'status_update', {'device': dict(DEVICE, id='dev2'), 'status': False})
+    client.flush()
+
+    msgs, _ = server._read_messages()
+    assert [m['data']['device']['id'] for m in msgs] == ['dev1', 'dev2']
+    msg = HookMessage(msgs[0])
+    assert msg.data.device.name == 'Lamp'
+    assert msg.data.device.metadata == {'name': 'Lamp'}
+
+
+def _writing_server(tmpdir, **database):
+    database['file'] = str(tmpdir.join('hooks.db'))
+    server = HooksServer(port=0, database=database)
+    db = server._database_connect(init=True)
+    server.writer.start()
+    return server, db
+
+
+def test_server_stores_batches_in_one_go(tmpdir):
+    server, db = _writing_server(tmpdir)
+    committed = []
+    server._store_raw_messages([{'id': 'a', 'hook': 'slack'}, {'id': 'b', 'hook': 'slack'}], on_commit=committed.append)
+    # Stored twice (like messages sent again through the stream), they're only kept once
+    server._store_raw_messages([{'id': 'a', 'hook': 'slack'}])
+    assert server.writer.flush(5)
+    assert committed == [None]
+    assert [row[0] for row in db.execute('SELECT id FROM notifications ORDER BY id')] == ['a', 'b']
+    server.writer.stop()
+
+
+def test_writes_are_committed_in_groups(tmpdir):
+    server, db = _writing_server(tmpdir, commit_interval=0.2)
+    for i in range(50):
+        server._store_raw_messages([{'id': str(i), 'hook': 'slack'}])
+    assert server.writer.flush(5)
+    assert server.writer.committed == 50
+    assert db.execute('SELECT COUNT(*) FROM notifications').fetchone()[0] == 50
+    assert db.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    server.writer.stop()
+
+
+def test_failing_writes_dont_undo_the_rest_of_the_group(tmpdir):
+    server, db = _writing_server(tmpdir, commit_interval=0.2)
+    errors = []
+    server.writer.execute('INSERT INTO missing_table VALUES (1)', on_commit=errors.append)
+    server._store_raw_messages([{'id': 'a', 'hook': 'slack'}], on_commit=errors.append)
+    assert server.writer.flush(5)
+    assert errors[0] is not None and errors[1] is None
+    assert db.execute('SELECT COUNT(*) FROM notifications').fetchone()[0] == 1
+    server.writer.stop()
+
+
+def test_messages_in_flight_are_not_picked_again(tmpdir):
+    server, db = _writing_server(tmpdir)
+    server._store_raw_messages([{'id': 'a', 'hook': 'slack'}])
+    assert server.writer.flush(5)
+    server.in_flight.add('a')
+    assert server._claim_queue_messages(db, time.time(), 10) == []
+    server.in_flight.discard('a')
+    assert [m[0] for m in server._claim_queue_messages(db, time.time(), 10)] == ['a']
+    server.writer.stop()
+
+
+def test_claimed_messages_are_leased(tmpdir):
+    server, db = _writing_server(tmpdir)
+    server.lease_time = 60
+    server._store_raw_messages([{'id': 'a', 'hook': 'slack'}])
+    assert server.writer.flush(5)
+    now = time.time()
+    assert [m[0] for m in server._claim_queue_messages(db, now, 10)] == ['a']
+    # Another server (or this one, after a restart) only gets it when the lease expires
+    other = HooksServer(port=0, database={'file': str(tmpdir.join('hooks.db'))})
+    other_db = other._database_connect()
+    assert other._claim_queue_messages(other_db, now, 10) == []
+    assert other._next_due_time(other_db) == int(now) + 60
+    assert [m[0] for m in other._claim_queue_messages(other_db, now + 61, 10)] == ['a']
+    server.writer.stop()
+
+
+def test_due_messages_are_claimed_in_batches_from_the_index(tmpdir):
+    server, db = _writing_server(tmpdir)
+    server._store_raw_messages([{'id': str(i), 'hook': 'slack'} for i in range(5)])
+    assert server.writer.flush(5)
+    db.execute('UPDATE notifications SET process_at_ts = process_at_ts + 60 WHERE id = "0"')
+    db.commit()
+    now = time.time()
+    assert [m[0] for m in server._claim_queue_messages(db, now, 3)] == ['1', '2', '3']
+    assert [m[0] for m in server._claim_queue_messages(db, now + 120, 10)] == ['4', '0']
+    plan = ' '.join(row[-1] for row in db.execute('EXPLAIN QUERY PLAN SELECT id FROM notifications WHERE process_at_ts <= 1 ORDER BY process_at_ts, arrived_ts'))
+    assert 'notifications_due' in plan
+    server.writer.stop()
+
+
+def test_existing_databases_are_migrated(tmpdir):
+    import sqlite3
+    db_file = str(tmpdir.join('hooks.db'))
+    db = sqlite3.connect(db_file)
+    db.execute('''
+        CREATE TABLE notifications (
+            id VARCHAR(64) NOT NULL PRIMARY KEY, arrived DATETIME NOT NULL, process_at DATETIME NOT NULL,
+            attempts INT NOT NULL, data TEXT
+        )
+    ''')
+    db.execute('INSERT INTO notifications VALUES ("a", DATETIME(100, "unixepoch"), DATETIME(130, "unixepoch"), 1, "{}")')
+    db.commit()
+    db.close()
+    server = HooksServer(port=0, database={'file': db_file})
+    db = server._database_connect(init=True)
+    assert db.execute('PRAGMA user_version').fetchone()[0] == 3
+    assert db.execute('SELECT arrived_ts, process_at_ts FROM notifications').fetchone() == (100, 130)
+    # Migrating again does nothing
+    server._database_init(db)
+    assert server._next_due_time(db) == 130
+
+
+def test_the_scheduler_sleeps_until_a_message_is_due(tmpdir):
+    server, db = _writing_server(tmpdir)
+    server.running = True
+    woken = []
+    def _wait():
+        woken.append(server._wait_for_due_messages())
+    thread = threading.Thread(target=_wait)
+    thread.daemon = True
+    thread.start()
+    time.sleep(0.1)
+    assert woken == []
+    server._store_raw_messages([{'id': 'a', 'hook': 'slack'}])
+    thread.join(2)
+    assert woken == [True]
+    assert server.due_times == []
+    server.writer.stop()
+
+
+def _stream_server(tmpdir, address):
+    server = HooksServer(port=0, database={'file': str(tmpdir.join('hooks.db'))}, stream=address)
+    db = server._database_connect(init=True)
+    server.writer.start()
+    server.running = True
+    server.stream_socket = stream.listen(address)
+    thread = threading.Thread(target=server._run_stream_listener)
+    thread.daemon = True
+    thread.start()
+    return server, db
+
+
+def _run_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        asyncorepp.loop(timeout=0.01, use_poll=True, count=1)
+        asyncorepp._check_timers()
+        time.sleep(0.001)
+    return condition()
+
+
+def test_stream_notifications_are_acknowledged_once_stored(tmpdir):
+    _reset()
+    address = 'unix:' + str(tmpdir.join('hooks.sock'))
+    server, db = _stream_server(tmpdir, address)
+    client = HooksClient({'stream': address})
+    for i in range(300):
+        client.notify('slack', 'status_update', {'device': dict(DEVICE, id='dev{}'.format(i)), 'status': True})
+    transport = client.transport
+    assert _run_until(lambda: transport.connected and not transport.outbox and not transport.unacked)
+    assert db.execute('SELECT COUNT(*) FROM notifications').fetchone()[0] == 300
+
+
+def test_stream_notifications_are_spooled_while_the_server_is_down(tmpdir):
+    _reset()
+    address = 'unix:' + str(tmpdir.join('hooks.sock'))
+    spool_file = str(tmpdir.join('hooks.spool'))
+    transport = stream.StreamTransport(address, outbox_size=2, spool_file=spool_file, reconnect_min=0.01, reconnect_max=0.05)
+    client = HooksClient({})
+    client.transport = transport
+    for i in range(5):
+        client.notify('slack', 'status_update', {'device': dict(DEVICE, id='dev{}'.format(i)), 'status': True})
+    assert len(transport.outbox) == 2
+    assert len(transport.spool) == 3
+
+    server, db = _stream_server(tmpdir, address)
+    assert _run_until(lambda: transport.connected and not transport.outbox and not transport.unacked and not len(transport.spool))
+    rows = [json.loads(row[0]) for row in db.execute('SELECT data FROM notifications ORDER BY rowid')]
+    assert [row['data']['device']['id'] for row in rows] == ['dev{}'.format(i) for i in range(5)]
+    assert os.path.getsize(spool_file) == 0
+
+
+def test_frames_are_split_across_reads():
+    frames = stream.FrameBuffer()
+    data = stream.encode_frame('{"a":1}') + stream.encode_frame('{"b":2}')
+    assert frames.feed(data[:5]) == []
+    assert frames.feed(data[5:14]) == ['{"a":1}']
+    assert frames.feed(data[14:]) == ['{"b":2}']
+
+
+def _delivering_server(tmpdir, hook, **options):
+    devices = dict(('dev{}'.format(i), {'test': {}}) for i in range(10))
+    server = HooksServer(port=0, database={'file': str(tmpdir.join('hooks.db'))}, devices=devices, **options)
+    server.modules = {'test': hook}
+    server.running = True
+    db = server._database_connect(init=True)
+    server.writer.start()
+    threads = [threading.Thread(target=server._run_scheduler)]
+    threads += [threading.Thread(target=server._run_worker) for _ in range(server.workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    return server, db, threads
+
+
+def _stop_delivering_server(server, threads):
+    server.running = False
+    with server.queue_cond:
+        server.queue_cond.notify_all()
+    with server.work_cond:
+        server.work_cond.notify_all()
+    for thread in threads:
+        thread.join(2)
+    server.writer.stop()
+
+
+def _notification(id, dev_id, hook='test'):
+    return {'id': id, 'hook': hook, 'type': 'status_update', 'data': {'device': {'id': dev_id}, 'status': id}}
+
+
+def _wait_until_delivered(server, db, timeout=5):
+    assert server.writer.flush(timeout)
+    deadline = time.time() + timeout
+    while time.time() < deadline and db.execute('SELECT COUNT(*) FROM notifications').fetchone()[0]:
+        time.sleep(0.01)
+    return db.execute('SELECT COUNT(*) FROM notifications').fetchone()[0] == 0
+
+
+class RecordingHook(object):
+    def __init__(self, delay=0, fail=()):
+        self.delay = delay
+        self.fail = set(fail)
+        self.calls = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def notify(self, notif_type, settings, data):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            self.calls.append((data.device.id, data.status))
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+        if data.status in self.fail:
+            self.fail.discard(data.status)
+            raise Exception('Unavailable')
+
+
+def test_the_scheduler_delivers_and_retries_messages(tmpdir):
+    hook = RecordingHook(fail=['b'])
+    server, db, threads = _delivering_server(tmpdir, hook, retry_wait=0, workers=1)
+    server._store_raw_messages([_notification('a', 'dev1'), _notification('b', 'dev2')])
+    assert _wait_until_delivered(server, db)
+    _stop_delivering_server(server, threads)
+    assert sorted(hook.calls) == [('dev1', 'a'), ('dev2', 'b'), ('dev2', 'b')]
+
+
+def test_a_failed_message_is_retried_before_the_next_ones_in_its_lane(tmpdir):
+    hook = RecordingHook(fail=['a'])
+    server, db, threads = _delivering_server(tmpdir, hook, retry_wait=1, workers=2)
+    server._store_raw_messages([_notification('a', 'dev1'), _notification('b', 'dev1'), _notification('c', 'dev2')])
+    assert _wait_until_delivered(server, db)
+    _stop_delivering_server(server, threads)
+    assert [status for dev_id, status in hook.calls if dev_id == 'dev1'] == ['a', 'a', 'b']
+    # Other lanes don't wait for it
+    assert hook.calls.index(('dev2', 'c')) < 2
+
+
+def test_lanes_waiting_for_a_retry_leave_room_for_the_others(tmpdir):
+    hook = RecordingHook(fail=['a', 'b', 'c'])
+    server, db, threads = _delivering_server(tmpdir, hook, retry_wait=60, workers=2, claim_batch=3)
+    server._store_raw_messages([_notification(id, dev) for id, dev in (('a', 'dev1'), ('a2', 'dev1'), ('b', 'dev2'), ('c', 'dev3'))])
+    assert server.writer.flush(5)
+    server._store_raw_messages([_notification('d', 'dev4')])
+    deadline = time.time() + 5
+    while time.time() < deadline and ('dev4', 'd') not in hook.calls:
+        time.sleep(0.01)
+    assert server.writer.flush(5)
+    _stop_delivering_server(server, threads)
+    assert ('dev4', 'd') in hook.calls
+    assert ('dev1', 'a2') not in hook.calls
+    assert server.queued == 0
+    # The messages of the failed lanes wait in the queue, the one behind 'a' after it
+    assert db.execute('SELECT id FROM notifications ORDER BY process_at_ts, arrived_ts, rowid').fetchall() == [
+        (u'a',), (u'a2',), (u'b',), (u'c',)]
+
+def test_destinations_are_delivered_concurrently_and_in_order(tmpdir):
+    hook = RecordingHook(delay=0.05)
+    server, db, threads = _delivering_server(tmpdir, hook, workers=4)
+    server._store_raw_messages([_notification('{}-{}'.format(dev, n), 'dev{}'.format(dev)) for n in range(3) for dev in range(4)])
+    started = time.time()
+    assert _wait_until_delivered(server, db)
+    elapsed = time.time() - started
+    _stop_delivering_server(server, threads)
+    # 4 lanes of 3 messages each, delivered 4 at a time
+    assert hook.max_active == 4
+    assert elapsed < 12 * 0.05
+    for dev in range(4):
+        assert [status for dev_id, status in hook.calls if dev_id == 'dev{}'.format(dev)] == ['{}-{}'.format(dev, n) for n in range(3)]
+
+
+def test_modules_can_limit_their_concurrency(tmpdir):
+    hook = RecordingHook(delay=0.02)
+    server, db, threads = _delivering_server(tmpdir, hook, workers=4)
+    server.module_concurrency['test'] = 2
+    server._store_raw_messages([_notification(str(dev), 'dev{}'.format(dev)) for dev in range(8)])
+    assert _wait_until_delivered(server, db)
+    _stop_delivering_server(server, threads)
+    assert len(hook.calls) == 8
+    assert hook.max_active == 2
+
+
+def test_notifications_sent_together_go_in_as_few_datagrams_as_possible():
+    _reset()
+    sock = _receiver()
+    client = HooksClient({'port': sock.getsockname()[1]})
+    client.notify_all('opentsdb', 'status_update', [{'device': DEVICE, 'status': status} for status in (True, False, True)])
+    datagrams = _recv_all(sock)
+    assert len(datagrams) == 1
+    assert [n['data']['status'] for n in datagrams[0]['batch']] == [True, False, True]
+
+    client = HooksClient({'port': sock.getsockname()[1], 'max_batch_size': 1000})
+    client.notify_all('opentsdb', 'status_update', [{'device': dict(DEVICE, id='dev{}'.format(i)), 'status': True} for i in range(20)])
+    datagrams = _recv_all(sock)
+    assert len(datagrams) > 1
+    assert sum(len(d['batch']) for d in datagrams) == 20
@@ -0,0 +1,159 @@
+import select
+import socket
+
+from pymitter import EventEmitter
+
+from homeswitch import proto
+from homeswitch.hybridserver import HybridServer, HybridServerClient, HomeSwitchRequest
+from homeswitch.util import writeUInt32BE
+
+
+class _Server(EventEmitter):
+    def __init__(self):
+        EventEmitter.__init__(self)
+        self.requests = []
+        self.on('request', lambda client, req, error: self.requests.append((req, error)))
+
+    def remove_user(self, client):
+        pass
+
+
+def _client(read_buffer_size=16):
+    server = _Server()
+    a, b = socket.socketpair()
+    client = HybridServerClient(a, server, read_buffer_size=read_buffer_size)
+    return client, server, b
+
+
+def _pump(client):
+    while client.status == "alive" and select.select([client.socket], [], [], 0.05)[0]:
+        client.handle_read()
+
+
+def test_native_messages_split_and_batched():
+    client, server, peer = _client()
+    first = proto.serialise({'id': 1, 'method': 'get'})
+    second = proto.serialise({'id': 2, 'method': 'set', 'devices': {'x' * 40: True}})
+    data = bytes(first + second)
+
+    # One byte at a time, then everything at once
+    for i in range(len(data)):
+        peer.send(data[i:i + 1])
+        client.handle_read()
+    peer.send(data)
+    _pump(client)
+
+    assert [req.id for req, _ in server.requests] == [1, 2, 1, 2]
+    assert server.requests[1][0].body['devices'] == {'x' * 40: True}
+    assert client._read_buffer_len == 0
+    client.close()
+    peer.close()
+
+
+def test_native_messages_with_invalid_json_are_dropped():
+    client, server, peer = _client(read_buffer_size=64)
+    invalid = bytearray(b'    {"id": 1, "method":')
+    writeUInt32BE(invalid, 0, len(invalid) - proto.HEADER_SIZE)
+    invalid[0] = 3
+    peer.send(bytes(invalid + proto.serialise({'id': 2, 'method': 'get'})))
+    _pump(client)
+
+    assert [error for _, error in server.requests] == ['Invalid JSON body', None]
+    assert server.requests[1][0].id == 2
+    assert client._read_buffer_len == 0
+    client.close()
+    peer.close()
+
+def test_request_push_data_accepts_fragments():
+    req = HomeSwitchRequest()
+    ready = []
+    req.on('ready', lambda: ready.append(True))
+    data = bytes(proto.serialise({'id': 3, 'method': 'ping'}))
+    used = 0
+    for i in range(len(data)):
+        used += req.push_data(data[i:i + 1])
+    assert used == len(data)
+    assert ready == [True]
+    assert req.method == 'ping'
+
+
+def _read_responses(peer):
+    peer.settimeout(0.5)
+    data = b''
+    try:
+        while True:
+            chunk = peer.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    except socket.timeout:
+        pass
+    return data
+
+
+def test_http_pipelined_keep_alive_requests():
+    client, server, peer = _client()
+    server.on('request', lambda client, req, error: client.reply({'url': req.url, 'body': req.body}))
+    body = '{"a": 1}'
+    peer.send(
+        b'GET /one HTTP/1.1\r\nHost: x\r\n\r\n'
+        b'POST /two HTTP/1.1\r\nContent-Type: application/json\r\nTransfer-Encoding: chunked\r\n\r\n'
+        b'3\r\n{"a\r\n5\r\n": 1}\r\n0\r\n\r\n'
+        b'POST /three HTTP/1.1\r\nContent-Type: application/json\r\nContent-Length: 8\r\n\r\n' + body
+    )
+    _pump(client)
+    responses = _read_responses(peer)
+
+    assert responses.count(b'HTTP/1.1 200 OK') == 3
+    assert responses.count(b'Connection: keep-alive') == 3
+    assert responses.index(b'/one') < responses.index(b'/two') < responses.index(b'/three')
+    assert [req.body for req, _ in server.requests] == [None, {'a': 1}, {'a': 1}]
+    assert client.status == "alive"
+    client.close()
+    peer.close()
+
+
+def test_http_pipelined_requests_wait_for_async_replies():
+    client, server, peer = _client()
+    peer.send(b'GET /one HTTP/1.1\r\n\r\nGET /two HTTP/1.1\r\n\r\n')
+    _pump(client)
+    assert [req.url for req, _ in server.requests] == ['/one']
+    client.reply({'ok': True})
+    assert [req.url for req, _ in server.requests] == ['/one', '/two']
+    client.close()
+    peer.close()
+
+
+def test_http_10_connection_is_closed_after_response():
+    client, server, peer = _client()
+    server.on('request', lambda client, req, error: client.reply({'ok': True}))
+    peer.send(b'GET /x HTTP/1.0\r\n\r\n')
+    _pump(client)
+    responses = _read_responses(peer)
+    assert responses.startswith(b'HTTP/1.0 200 OK')
+    assert b'Connection: close' in responses
+    assert client.status == "gone"
+    peer.close()
+
+
+def test_broadcast_respects_subscriptions():
+    server = HybridServer(host='127.0.0.1', port=0)
+    peers = {}
+    for name, devices in (('all', None), ('a', ['a']), ('b', ['b', 'z'])):
+        a, b = socket.socketpair()
+        client = HybridServerClient(a, server)
+        client.proto = 3
+        client.subscribe(devices)
+        server.clients[name] = client
+        peers[name] = b
+
+    server.broadcast({'devices': {'a': {'status': True}, 'b': {'status': False}}})
+
+    received = dict((name, list(proto.parse_messages(bytearray(_read_responses(peer))))) for name, peer in peers.items())
+    assert sorted(received['all'][0]['devices'].keys()) == ['a', 'b']
+    assert received['a'][0]['devices'] == {'a': {'status': True}}
+    assert received['b'][0]['devices'] == {'b': {'status': False}}
+    for name in peers:
+        server.clients[name].close()
+        peers[name].close()
+    server.close()
@@ -0,0 +1,42 @@
+import json
+
+from homeswitch import metrics
+
+
+def test_counters_and_gauges():
+    registry = metrics.Registry()
+    requests = registry.counter('requests_total', 'Requests', ('method',))
+    requests.labels('get').inc()
+    requests.labels('get').inc(2)
+    requests.labels('set').inc()
+    depth = registry.gauge('depth', 'Queue depth')
+    depth.set_function(lambda: 7)
+
+    assert registry.counter('requests_total', 'Requests', ('method',)) is requests
+    assert registry.prometheus().split('\n') == [
+        '# HELP requests_total Requests',
+        '# TYPE requests_total counter',
+        'requests_total{method="get"} 3',
+        'requests_total{method="set"} 1',
+        '# HELP depth Queue depth',
+        '# TYPE depth gauge',
+        'depth 7',
+        '',
+    ]
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = metrics.Registry()
+    latency = registry.histogram('latency_seconds', 'Latency', ('device',), buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 2):
+        latency.labels('a"b').observe(value)
+
+    lines = registry.prometheus().split('\n')
+    assert 'latency_seconds_bucket{device="a\\"b",le="0.1"} 2' in lines
+    assert 'latency_seconds_bucket{device="a\\"b",le="1"} 3' in lines
+    assert 'latency_seconds_bucket{device="a\\"b",le="+Inf"} 4' in lines
+    assert 'latency_seconds_count{device="a\\"b"} 4' in lines
+
+    sample = json.loads(json.dumps(registry.json()))['latency_seconds']['samples'][0]
+    assert sample['count'] == 4
+    assert sample['buckets'] == {'0.1': 2, '1': 3, '+Inf': 4}
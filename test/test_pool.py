@@ -0,0 +1,140 @@
+import time
+
+from homeswitch import asyncorepp
+from homeswitch.asyncsocket.pool import ConnectionPool
+
+
+def _reset():
+    asyncorepp.TIMERS.clear()
+    del asyncorepp._TIMER_HEAP[:]
+
+
+class FakeMember(object):
+    def __init__(self, id):
+        self.id = id
+        self.connected = False
+        self.connecting = False
+        self.busy = False
+        self.opens = 0
+        self.heartbeats = []
+
+    def is_idle(self):
+        return not self.busy
+
+    def open(self):
+        self.opens += 1
+        self.connecting = True
+
+    def close(self):
+        self.connected = False
+
+    def heartbeat(self, callback):
+        self.heartbeats.append(callback)
+
+
+def _open(pool, member):
+    member.connected = True
+    member.connecting = False
+    pool.touch(member)
+    pool.opened(member)
+
+
+def test_least_recently_used_idle_connections_are_closed_over_the_limit():
+    _reset()
+    pool = ConnectionPool(max_open=2)
+    a, b, c = FakeMember('a'), FakeMember('b'), FakeMember('c')
+    _open(pool, a)
+    _open(pool, b)
+    pool.touch(a)
+    _open(pool, c)
+    assert list(pool.open.keys()) == ['a', 'c']
+    assert not b.connected and a.connected and c.connected
+
+
+def test_busy_connections_are_closed_once_idle():
+    _reset()
+    pool = ConnectionPool(max_open=1)
+    a, b = FakeMember('a'), FakeMember('b')
+    a.busy = b.busy = True
+    _open(pool, a)
+    _open(pool, b)
+    assert len(pool.open) == 2
+
+    a.busy = False
+    pool.idle(a)
+    assert list(pool.open.keys()) == ['b']
+    assert not a.connected
+
+
+def test_idle_connections_get_heartbeats_and_are_closed_after_idle_timeout():
+    _reset()
+    pool = ConnectionPool(idle_timeout=60, heartbeat_interval=10)
+    a = FakeMember('a')
+    _open(pool, a)
+    entry = pool.entries['a']
+
+    entry.last_used = entry.last_traffic = time.time() - 11
+    pool._tick()
+    assert len(a.heartbeats) == 1
+    a.heartbeats.pop()(None)
+    pool._tick()
+    assert len(a.heartbeats) == 0
+
+    entry.last_used = time.time() - 61
+    pool._tick()
+    assert not a.connected
+    assert len(pool.open) == 0
+
+
+def test_broken_connections_of_recently_used_members_reconnect_with_backoff():
+    _reset()
+    pool = ConnectionPool(backoff_base=1, backoff_max=4)
+    a = FakeMember('a')
+    _open(pool, a)
+    entry = pool.entries['a']
+
+    delays = []
+    for _ in range(4):
+        a.connected = False
+        pool.closed(a, broken=True)
+        delays.append(asyncorepp.TIMERS[entry.reconnect_timer][2] - time.time())
+    assert 0.4 < delays[0] <= 1
+    assert 1.9 < delays[2] <= 4
+    assert 1.9 < delays[3] <= 4
+    assert len(asyncorepp.TIMERS) == 2
+
+    pool._reconnect(entry)
+    assert a.opens == 1
+
+    # Reconnecting resets the backoff
+    _open(pool, a)
+    assert entry.failures == 0
+    assert entry.reconnect_timer is None
+
+
+def test_broken_connections_of_unused_members_are_left_closed():
+    _reset()
+    pool = ConnectionPool(idle_timeout=60)
+    a = FakeMember('a')
+    _open(pool, a)
+    pool.entries['a'].last_used = time.time() - 61
+    pool.closed(a, broken=True)
+    assert pool.entries['a'].reconnect_timer is None
+
+
+def test_connections_busy_for_too_long_without_replies_are_reopened():
+    _reset()
+    pool = ConnectionPool(busy_timeout=30)
+    a, b = FakeMember('a'), FakeMember('b')
+    a.busy = b.busy = True
+    _open(pool, a)
+    _open(pool, b)
+    pool._tick()
+    long_ago = time.time() - 31
+    pool.entries['a'].busy_since = pool.entries['b'].busy_since = long_ago
+    # b is still getting replies
+    pool.progress(b)
+    pool._tick()
+    assert not a.connected and b.connected
+    assert list(pool.open.keys()) == ['b']
+    assert pool.entries['a'].reconnect_timer is not None
@@ -0,0 +1,136 @@
+import time
+
+from homeswitch import asyncorepp
+from homeswitch.refresh import RefreshScheduler, SCHEDULED, RUNNING
+
+
+def _reset():
+    asyncorepp.TIMERS.clear()
+    del asyncorepp._TIMER_HEAP[:]
+
+
+class FakeDevice(object):
+    def __init__(self, id, refresh_status=10):
+        self.id = id
+        self.refresh_status = refresh_status
+        self.discovery_status = 'online'
+        self.switch_status = False
+        self.connect_errors = 0
+        self.callbacks = []
+
+    def get_status(self, callback, ctx, ignore_cache=False):
+        self.callbacks.append(callback)
+
+
+def _run_all(scheduler):
+    # Makes every scheduled refresh due and runs the timer
+    for entry in scheduler.entries.values():
+        if entry.state == SCHEDULED:
+            scheduler._schedule(entry, 0)
+    scheduler._on_timer()
+
+
+def test_first_refreshes_are_spread_over_the_interval_with_a_single_timer():
+    _reset()
+    scheduler = RefreshScheduler()
+    now = time.time()
+    devices = [FakeDevice('dev{}'.format(i)) for i in range(50)]
+    for dev in devices:
+        scheduler.add(dev)
+    dues = sorted(entry.due for entry in scheduler.entries.values())
+    assert now <= dues[0] and dues[-1] <= now + 10 + 1
+    assert dues[-1] - dues[0] > 5
+    assert len(asyncorepp.TIMERS) == 1
+
+
+def test_concurrent_refreshes_are_capped():
+    _reset()
+    scheduler = RefreshScheduler(max_concurrent=2)
+    devices = [FakeDevice('dev{}'.format(i)) for i in range(5)]
+    for dev in devices:
+        scheduler.add(dev)
+    _run_all(scheduler)
+    assert scheduler.running == 2
+    assert [len(dev.callbacks) for dev in devices].count(1) == 2
+
+    # Finishing one starts the next
+    running = [dev for dev in devices if dev.callbacks]
+    running[0].callbacks.pop()(None, False, {})
+    assert scheduler.running == 2
+    assert sum(len(dev.callbacks) for dev in devices) == 2
+
+
+def test_unchanged_and_failing_devices_back_off():
+    _reset()
+    scheduler = RefreshScheduler(jitter=0, backoff=2, max_backoff=4)
+    dev = FakeDevice('dev1', refresh_status=10)
+    entry = scheduler.add(dev)
+
+    intervals = []
+    for _ in range(4):
+        _run_all(scheduler)
+        dev.callbacks.pop()(None, False, {})
+        intervals.append(round(entry.due - time.time()))
+    assert intervals == [20, 40, 40, 40]
+
+    # A change brings it back to the configured interval
+    _run_all(scheduler)
+    dev.switch_status = True
+    dev.callbacks.pop()(None, True, {})
+    assert round(entry.due - time.time()) == 10
+
+    _run_all(scheduler)
+    dev.callbacks.pop()({'error': 'command_timeout'}, None, {})
+    assert round(entry.due - time.time()) == 20
+
+
+def test_boost_brings_the_next_refresh_forward():
+    _reset()
+    scheduler = RefreshScheduler(jitter=0, backoff=2, boost_delay=1)
+    dev = FakeDevice('dev1', refresh_status=10)
+    entry = scheduler.add(dev)
+    entry.unchanged = 3
+    scheduler._schedule(entry, time.time() + 80)
+
+    scheduler.boost(dev)
+    assert entry.unchanged == 0
+    assert round(entry.due - time.time()) == 1
+
+    # Boosting a running refresh leaves it alone
+    _run_all(scheduler)
+    assert entry.state == RUNNING
+    scheduler.boost(dev)
+    assert entry.state == RUNNING
+
+
+class BrokenDevice(FakeDevice):
+    def get_status(self, callback, ctx, ignore_cache=False):
+        FakeDevice.get_status(self, callback, ctx, ignore_cache)
+        raise Exception('Device {} has NO IP address yet'.format(self.id))
+
+
+def test_a_refresh_that_raises_is_a_failure():
+    _reset()
+    scheduler = RefreshScheduler(jitter=0, max_concurrent=1)
+    broken = BrokenDevice('dev1', refresh_status=10)
+    dev = FakeDevice('dev2', refresh_status=10)
+    broken_entry = scheduler.add(broken)
+    scheduler.add(dev)
+    scheduler._schedule(broken_entry, 0)
+    _run_all(scheduler)
+    assert broken_entry.state == SCHEDULED
+    assert broken_entry.failures == 1
+    assert round(broken_entry.due - time.time()) == 15
+    # The other devices are still refreshed and the timer is armed
+    assert scheduler.running == 1 and len(dev.callbacks) == 1
+    assert scheduler._timer is not None
+
+def test_offline_devices_are_not_polled():
+    _reset()
+    scheduler = RefreshScheduler(jitter=0)
+    dev = FakeDevice('dev1')
+    dev.discovery_status = 'offline'
+    entry = scheduler.add(dev)
+    _run_all(scheduler)
+    assert dev.callbacks == []
+    assert entry.state == SCHEDULED
@@ -0,0 +1,214 @@
+from pymitter import EventEmitter
+import time
+
+from homeswitch import asyncorepp
+from homeswitch.syncproto import SyncProto
+
+
+class _Socket(EventEmitter):
+    def __init__(self):
+        EventEmitter.__init__(self)
+        self.connected = False
+        self.ip = '127.0.0.1'
+        self.port = 6668
+
+    def connect(self):
+        self.connected = True
+        self.emit('connect')
+
+
+class _Device(object):
+    """ Records what's sent and replies with whatever is queued in `replies` as (sequence, payload) """
+    def __init__(self, window=1):
+        self.socket = _Socket()
+        self.sent = []
+        self.replies = []
+        self.proto = SyncProto(self.socket, self.sent.append, self._decode, window=window)
+
+    def _decode(self, proto):
+        if len(self.replies) == 0:
+            return None
+        proto.reply_sequence, payload = self.replies.pop(0)
+        return payload
+
+    def reply(self, *replies):
+        self.replies.extend(replies)
+        self.socket.emit('data')
+
+
+def _results():
+    results = []
+    return results, lambda name: (lambda err, reply: results.append((name, err, reply)))
+
+
+def test_stop_and_wait_by_default():
+    dev = _Device()
+    results, cb = _results()
+    dev.proto.append({'command': 'a'}, cb('a'))
+    dev.proto.append({'command': 'b'}, cb('b'))
+    dev.socket.connect()
+    assert [m['command'] for m in dev.sent] == ['a']
+
+    dev.reply((0, {'r': 1}))
+    assert [m['command'] for m in dev.sent] == ['a', 'b']
+    assert results == [('a', None, {'r': 1})]
+
+
+def test_pipelined_replies_are_matched_by_sequence():
+    dev = _Device(window=3)
+    results, cb = _results()
+    for name in 'abcd':
+        dev.proto.append({'command': name}, cb(name))
+    dev.socket.connect()
+    assert [m['command'] for m in dev.sent] == ['a', 'b', 'c']
+
+    seqs = dict((m['command'], m['sequenceN']) for m in dev.sent)
+    dev.reply((seqs['c'], 'C'), (seqs['a'], 'A'))
+    assert results == [('c', None, 'C'), ('a', None, 'A')]
+    assert [m['command'] for m in dev.sent] == ['a', 'b', 'c', 'd']
+    assert len(dev.proto) == 2
+
+
+def test_in_flight_commands_are_resent_after_disconnect():
+    dev = _Device(window=2)
+    results, cb = _results()
+    dev.proto.append({'command': 'a'}, cb('a'))
+    dev.proto.append({'command': 'b'}, cb('b'))
+    dev.socket.connect()
+    dev.socket.connected = False
+    dev.socket.emit('break')
+    assert [cmd.message['command'] for cmd in dev.proto.command_queue] == ['a', 'b']
+
+    dev.socket.connect()
+    assert [m['command'] for m in dev.sent] == ['a', 'b', 'a', 'b']
+
+
+def test_queued_commands_are_coalesced():
+    dev = _Device()
+    results, cb = _results()
+    dev.proto.append({'command': 'get'}, cb('get1'), key='get')
+    dev.socket.connect()
+    # The first ones are in flight already, these ones are still queued
+    dev.proto.append({'command': 'get'}, cb('get2'), key='get')
+    dev.proto.append({'command': 'get'}, cb('get3'), key='get')
+    dev.proto.append({'command': 'set', 'value': 1}, cb('set1'), key='set', replace=True)
+    dev.proto.append({'command': 'set', 'value': 2}, cb('set2'), key='set', replace=True)
+    assert len(dev.proto) == 3
+
+    dev.reply((None, 'status'), (None, 'status'), (None, 'set'))
+    assert [m['command'] for m in dev.sent] == ['get', 'get', 'set']
+    assert dev.sent[2]['value'] == 2
+    assert [name for name, _, _ in results] == ['get1', 'get2', 'get3', 'set1', 'set2']
+    assert dev.proto.is_dry()
+
+
+def test_empty_replies_only_match_commands_expecting_them():
+    dev = _Device()
+    results, cb = _results()
+    dev.proto.append({'command': 'get'}, cb('get'))
+    dev.socket.connect()
+    dev.reply((dev.sent[0]['sequenceN'], ''))
+    assert results == []
+
+    dev.reply((dev.sent[0]['sequenceN'], {'dps': {}}))
+    dev.proto.append({'command': 'heartbeat', 'empty_reply': True}, cb('heartbeat'))
+    dev.proto.go()
+    dev.reply((dev.sent[1]['sequenceN'], ''))
+    assert results == [('get', None, {'dps': {}}), ('heartbeat', None, '')]
+
+
+def test_messages_with_no_command_waiting_are_pushed():
+    dev = _Device()
+    pushed = []
+    dev.proto.on('push', pushed.append)
+    dev.socket.connect()
+    dev.reply((0, {'dps': {'1': True}}))
+    assert pushed == [{'dps': {'1': True}}]
+
+
+def test_push_commands_with_unknown_sequences_are_only_pushed():
+    dev = _Device()
+    dev.proto.push_commands = (8,)
+    pushed = []
+    dev.proto.on('push', pushed.append)
+    results, cb = _results()
+    dev.proto.append({'command': 'set'}, cb('set'))
+    dev.socket.connect()
+
+    # Decoders set reply_command, so do it from the reply queue
+    decode = dev._decode
+    def _decode(proto):
+        reply = decode(proto)
+        proto.reply_command = 8
+        return reply
+    dev.proto.receive_and_decode = _decode
+    dev.reply((0, {'dps': {'1': False}}))
+    assert pushed == [{'dps': {'1': False}}]
+    # The command is still waiting for its own reply
+    assert results == []
+    assert len(dev.proto.in_flight) == 1
+
+    dev.reply((dev.sent[0]['sequenceN'], {'dps': {'1': True}}))
+    assert pushed == [{'dps': {'1': False}}]
+    assert results == [('set', None, {'dps': {'1': True}})]
+
+
+def _expire_commands():
+    time.sleep(0.02)
+    asyncorepp._check_timers()
+
+
+def test_commands_are_sent_after_a_reply_is_dropped():
+    dev = _Device()
+    results, cb = _results()
+    dev.socket.connect()
+    dev.proto.append({'command': 'get'}, cb('get'))
+    dev.proto.go()
+    dev.reply((dev.sent[0]['sequenceN'], 'first'))
+
+    # The reply to 'a' never arrives
+    dev.proto.append({'command': 'a'}, cb('a'), timeout=0.01)
+    dev.proto.append({'command': 'b'}, cb('b'))
+    dev.proto.go()
+    _expire_commands()
+    assert [m['command'] for m in dev.sent] == ['get', 'a', 'b']
+    assert results[1][0] == 'a' and results[1][1]['error'] == 'command_timeout'
+
+    # A late reply to 'a' is dropped instead of being taken as the reply to 'b'
+    dev.reply((dev.sent[1]['sequenceN'], 'late'), (dev.sent[2]['sequenceN'], 'B'))
+    assert results[2] == ('b', None, 'B')
+    assert dev.proto.is_dry()
+
+
+def test_connections_are_reset_when_late_replies_cant_be_told_apart():
+    dev = _Device()
+    errors = []
+    dev.proto.on('receive_error', errors.append)
+    results, cb = _results()
+    dev.proto.append({'command': 'a'}, cb('a'), timeout=0.01)
+    dev.proto.append({'command': 'b'}, cb('b'))
+    dev.socket.connect()
+    _expire_commands()
+    assert len(errors) == 1
+    assert [cmd.message['command'] for cmd in dev.proto.command_queue] == ['b']
+
+    dev.socket.connect()
+    dev.reply((None, 'B'))
+    assert [m['command'] for m in dev.sent] == ['a', 'b']
+    assert results[1] == ('b', None, 'B')
+
+
+def test_commands_are_only_coalesced_with_the_last_queued_one():
+    dev = _Device()
+    results, cb = _results()
+    dev.proto.append({'command': 'get'}, cb('get0'), key='get')
+    dev.socket.connect()
+    dev.proto.append({'command': 'get'}, cb('get1'), key='get')
+    dev.proto.append({'command': 'set', 'value': 1}, cb('set'), key='set', replace=True)
+    # This get comes after the set, so it can't get the status from before it
+    dev.proto.append({'command': 'get'}, cb('get2'), key='get')
+    assert len(dev.proto) == 4
+
+    dev.reply((None, 'off'), (None, 'off'), (None, 'on'), (None, 'on'))
+    assert [m['command'] for m in dev.sent] == ['get', 'get', 'set', 'get']
+    assert results == [('get0', None, 'off'), ('get1', None, 'off'), ('set', None, 'on'), ('get2', None, 'on')]
@@ -0,0 +1,97 @@
+import binascii
+import struct
+
+from homeswitch.aes import AESCipher, BACKENDS
+from homeswitch.hw.tuya import TuyaCodec, TuyaDevice
+
+
+KEY = b'0123456789abcdef'
+
+
+def test_aes_round_trip_on_every_backend():
+    for backend in BACKENDS:
+        cipher = AESCipher(KEY, backend=backend)
+        for text in (b'', b'{"dps":{"1":true}}', b'x' * 32):
+            assert cipher.decrypt(cipher.encrypt(text)) == text
+            assert cipher.decrypt(cipher.encrypt(text, False), False) == text
+
+
+def test_codec_frames_messages():
+    codec = TuyaCodec(KEY, 3.3)
+    frame = codec.encode(7, {'dps': {'1': True}, 't': '1'}, 42)
+
+    prefix, sequence, command, size = struct.unpack('>IIII', frame[:16])
+    assert (prefix, sequence, command) == (0x55aa, 42, 7)
+    assert size == len(frame) - 16
+    crc, suffix = struct.unpack('>II', frame[-8:])
+    assert crc == binascii.crc32(frame[:-8]) & 0xffffffff
+    assert suffix == 0xaa55
+
+    payload = frame[16:-8]
+    assert payload.startswith(b'3.3' + b'\0' * 12)
+    assert codec.decrypt_json(payload[15:], False) == {'dps': {'1': True}, 't': '1'}
+
+
+def _frame(dev, sequence, command, payload):
+    # A frame sent by a 3.3 device (with a return code before the payload)
+    if payload:
+        payload = b'3.3' + b'\0' * 12 + dev.codec.cipher.encrypt(payload, False)
+    payload = b'\0\0\0\0' + payload
+    header = struct.pack('>IIII', 0x55aa, sequence, command, len(payload) + 8)
+    return header + payload + struct.pack('>II', binascii.crc32(header + payload) & 0xffffffff, 0xaa55)
+
+
+def _receive(dev, *frames):
+    dev.connection.connected = True
+    dev.connection.receive = lambda num_bytes: b''
+    for frame in frames:
+        dev.sync_proto.buffer.extend(frame)
+    dev.sync_proto._on_data()
+
+
+def test_device_turns_pushed_status_frames_into_status_updates():
+    dev = TuyaDevice(id='dev1', config={'key': KEY})
+    updates = []
+    dev.on('status_update', lambda status, ctx: updates.append((status, ctx)))
+    _receive(dev, _frame(dev, 0, 8, b'{"devId":"dev1","dps":{"1":true}}'))
+    assert updates == [(True, {'origin': 'device'})]
+
+
+def test_sets_acknowledged_without_a_status_are_not_updated_twice():
+    dev = TuyaDevice(id='dev1', config={'key': KEY})
+    updates = []
+    dev.on('status_update', lambda status, ctx: updates.append((status, ctx['origin'])))
+    results = []
+    dev.ip = '127.0.0.1'
+    dev.connected = dev.connection.connected = True
+    dev.connection.send = lambda data: None
+    dev.set_status(True, ctx={'origin': 'set'}, callback=lambda err, status: results.append((err, status)))
+    sequence = next(iter(dev.sync_proto.in_flight))
+
+    # An empty acknowledgement, then the status it was set to
+    _receive(dev, _frame(dev, sequence, 7, b''), _frame(dev, 0, 8, b'{"devId":"dev1","dps":{"1":true}}'))
+    assert results == [(None, True)]
+    assert updates == [(True, 'set')]
+
+
+def test_coalesced_sets_get_the_value_that_was_sent():
+    dev = TuyaDevice(id='dev1', config={'key': KEY})
+    updates = []
+    dev.on('status_update', lambda status, ctx: updates.append((status, ctx['origin'])))
+    results = []
+    dev.ip = '127.0.0.1'
+    dev.connected = dev.connection.connected = True
+    dev.connection.send = lambda data: None
+    # The get takes the only slot in the window, so both sets wait in the queue and are coalesced
+    dev.get_status(ctx={'origin': 'get'})
+    dev.set_status(True, ctx={'origin': 'set'}, callback=lambda err, status: results.append(('A', status)))
+    dev.set_status(False, ctx={'origin': 'set'}, callback=lambda err, status: results.append(('B', status)))
+
+    sequence = next(iter(dev.sync_proto.in_flight))
+    _receive(dev, _frame(dev, sequence, 7, b'{"devId":"dev1","dps":{"1":true}}'))
+    sequence = next(iter(dev.sync_proto.in_flight))
+    assert dev.sync_proto.in_flight[sequence].message['payload']['dps'] == {'1': False}
+    _receive(dev, _frame(dev, sequence, 7, b''))
+    assert results == [('A', False), ('B', False)]
+    assert [update for update in updates if update[1] == 'set'] == [(False, 'set')]
+    assert dev._set_values == {}
@@ -0,0 +1,53 @@
+from StringIO import StringIO
+
+from homeswitch import util
+
+
+class _Loud(object):
+    def __str__(self):
+        raise AssertionError('Should not be formatted')
+
+
+def test_disabled_levels_are_not_formatted():
+    out = StringIO()
+    util.configure_logging(level='INFO', stream=out)
+    try:
+        util.debug("DBUG", "Got {}", _Loud())
+        util.debugf("DBUG", "Got {}", _Loud())
+        util.debugf("INFO", "Device {} is {}", 'lamp', True, {'ctx': 1})
+        util.debug("WARN", "Careful {with} braces", 1)
+    finally:
+        util.configure_logging()
+
+    lines = out.getvalue().splitlines()
+    assert len(lines) == 2
+    assert lines[0].endswith("Z: [INFO] Device lamp is True {'ctx': 1}")
+    assert lines[1].endswith("Z: [WARN] Careful {with} braces 1")
+
+
+def test_buffered_output_is_written_on_flush_or_urgent_lines():
+    out = StringIO()
+    util.configure_logging(level='DBUG', buffer_size=4096, stream=out)
+    try:
+        util.debug("DBUG", "one")
+        util.debug("INFO", "two")
+        assert out.getvalue() == ''
+        util.flush_log()
+        assert len(out.getvalue().splitlines()) == 2
+        util.debug("INFO", "three")
+        util.debug("ERRO", "four")
+        assert len(out.getvalue().splitlines()) == 4
+    finally:
+        util.configure_logging()
+
+
+def test_a_background_log_is_written_by_its_own_thread():
+    out = StringIO()
+    sink = util.LogSink(stream=out, buffer_size=4096, flush_interval=60, background=True)
+    assert sink.in_background
+    assert not util.log_in_background()
+    sink.write("one")
+    sink.write("two", urgent=True)
+    sink.writer.join(0.5)
+    assert out.getvalue() == "one\ntwo\n"
+    assert sink.pending == [] and sink.pending_size == 0